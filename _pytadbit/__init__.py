@@ -107,10 +107,11 @@ def get_dependencies_version(dico=False):
                           sorted(versions.keys())])
 
 
-from pytadbit.hic_data             import HiC_data
+from pytadbit.hic_data             import HiC_data, SparseHiC_data
 from pytadbit.tadbit               import tadbit, batch_tadbit
 from pytadbit.chromosome           import Chromosome
 from pytadbit.experiment           import Experiment, load_experiment_from_reads
+from pytadbit.experiment           import load_experiment_from_hic_data
 from pytadbit.chromosome           import load_chromosome
 from pytadbit.modelling.structuralmodels import StructuralModels
 from pytadbit.modelling.structuralmodels import load_structuralmodels
@@ -12,11 +12,13 @@ from sys                          import stderr
 from warnings                     import warn
 from pytadbit                     import HiC_data
 from pytadbit.parsers.hic_parser  import read_matrix
+from pytadbit.parsers.genome_store import chromosome_lengths
 from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.extraviews    import tadbit_savefig
 from pytadbit.utils.tadmaths      import zscore, nozero_log_matrix
 from pytadbit.utils.normalize_hic import iterative
 from pytadbit.utils.hic_filtering import hic_filtering_for_modelling
+from pytadbit.utils.hic_tiles     import HiCTiles, zoom_level
 from pytadbit.parsers.tad_parser  import parse_tads
 from pytadbit.modelling.structuralmodels import StructuralModels
 
@@ -42,6 +44,9 @@ def load_experiment_from_reads(name, fnam, genome_seq, resolution,
 
     :param fnam: tsv file with reads1 and reads2
     :param name: name of the experiment
+    :param genome_seq: a dictionary generated by
+       :func:`pytadbit.parsers.genome_parser.parse_fasta`, or a genome store
+       loaded with :func:`pytadbit.parsers.genome_store.load_genome_store`
     :param resolution: the resolution of the experiment (size of a bin in
        bases)
     :param None identifier: some identifier relative to the Hi-C data
@@ -76,8 +81,8 @@ def load_experiment_from_reads(name, fnam, genome_seq, resolution,
     size = 0
     section_sizes = {}
     sections = []
-    for crm in genome_seq:
-        len_crm = int(float(len(genome_seq[crm])) / resolution + 1)
+    for crm, crm_len in chromosome_lengths(genome_seq).iteritems():
+        len_crm = int(float(crm_len) / resolution + 1)
         section_sizes[(crm,)] = len_crm
         size += len_crm + 1
         sections.extend([(crm, '%04d' % i) for i in xrange(len_crm + 1)])
@@ -95,6 +100,62 @@ def load_experiment_from_reads(name, fnam, genome_seq, resolution,
                       cell_type=cell_type, enzyme=enzyme, exp_type=exp_type,
                       **kw_descr)
 
+
+def load_experiment_from_hic_data(name, hic_data, crm, start=1, end=None,
+                                  **kw_descr):
+    """
+    Loads an experiment object restricted to a window of a chromosome from a
+    normalized HiC_data object. Only the cells of the window are read, thus
+    with a memory-mapped HiC_data (see
+    :func:`pytadbit.parsers.hic_store.load_hic_store`) only the rows of the
+    window are loaded from disk.
+
+    Normalization uses the biases of the HiC_data (computed over the full
+    genome), and the columns filtered in the HiC_data are kept as zeros.
+
+    :param name: name of the experiment
+    :param hic_data: normalized HiC_data object
+    :param crm: name of the chromosome
+    :param 1 start: first bin of the window, in chromosome bins (starting at
+       1)
+    :param None end: last bin of the window (inclusive), by default the last
+       bin of the chromosome
+    :param None kw_descr: any other argument passed would be stored as
+       complementary descriptive field (see :class:`Experiment`)
+
+    :returns: an Experiment object of end - start + 1 bins. As bin numbers
+       passed to the modelling functions (e.g. :func:`Experiment.model_region`)
+       are still relative to the chromosome, start should be used as first
+       bin
+    """
+    if not hic_data.bias:
+        raise Exception('ERROR: Hi-C data should be normalized')
+    beg, last = hic_data.section_pos[crm]
+    end = end or last - beg
+    if not 1 <= start <= end <= last - beg:
+        raise Exception('ERROR: window %d-%d out of chromosome %s (%d bins)' % (
+            start, end, crm, last - beg))
+    size = end - start + 1
+    # genome-wide bin of the first bin of the window
+    beg += start - 1
+    matrix = hic_data.get_matrix(focus=(beg + 1, beg + size))
+    bias = [hic_data.bias.get(i, 0) for i in xrange(beg, beg + size)]
+    exp = Experiment(name, resolution=hic_data.resolution, hic_data=[matrix],
+                     **kw_descr)
+    exp._offset = start - 1
+    exp._zeros = dict((i - beg, None) for i in hic_data.bads
+                      if beg <= i < beg + size)
+    exp._zeros.update((i, None) for i in xrange(size) if not bias[i])
+    exp._filtered_cols = True
+    exp.bias = dict((i, b) for i, b in enumerate(bias) if b)
+    exp.norm = [HiC_data([(i + j * size,
+                           float(matrix[j][i]) / exp.bias[i] / exp.bias[j])
+                          for i in exp.bias for j in exp.bias
+                          if matrix[j][i]], size)]
+    exp._normalization = 'visibility'
+    return exp
+
+
 class Experiment(object):
     """
     Hi-C experiment.
@@ -183,6 +244,7 @@ class Experiment(object):
         self._filtered_cols  = False
         self._zeros          = {}
         self._zscores        = {}
+        self._offset         = 0
         if hic_data:
             self.load_hic_data(hic_data, parser, **kw_descr)
         if norm_data:
@@ -783,7 +845,7 @@ class Experiment(object):
             stderr.write('WARNING: not normalized data, should run ' +
                          'Experiment.normalize_hic()\n')
         if not end:
-            end = self.size
+            end = self.size + self._offset
         zscores, values, zeros = self._sub_experiment_zscore(start, end)
         coords = {'crm'  : self.crm.name,
                   'start': start,
@@ -872,7 +934,7 @@ class Experiment(object):
             stderr.write('WARNING: not normalized data, should run ' +
                          'Experiment.normalize_hic()\n')
         if not end:
-            end = self.size
+            end = self.size + self._offset
         optimizer = IMPoptimizer(self, start, end, n_keep=n_keep,
                                  n_models=n_models, close_bins=close_bins,
                                  container=container)
@@ -905,14 +967,19 @@ class Experiment(object):
             stderr.write('WARNING: normalizing according to visibility method\n')
             self.normalize_hic()
         from pytadbit import Chromosome
-        if start < 1:
-            raise ValueError('ERROR: start should be higher than 0\n')
+        if start - self._offset < 1:
+            raise ValueError('ERROR: start should be higher than %d\n' %
+                             self._offset)
         start -= 1 # things starts at 0 for python. we keep the end coordinate
                    # at its original value because it is inclusive
         siz = self.size
+        # experiments loaded from a window of a chromosome
+        start -= self._offset
+        end   -= self._offset
+        # only the cells of the region are accessed
         try:
-            matrix = self.get_hic_matrix()
-            new_matrix = [[matrix[i][j] for i in xrange(start, end)]
+            hic = self.hic_data[0]
+            new_matrix = [[hic[j + siz * i] for i in xrange(start, end)]
                           for j in xrange(start, end)]
             tmp = Chromosome('tmp')
             tmp.add_experiment('exp1', hic_data=[new_matrix],
@@ -922,8 +989,8 @@ class Experiment(object):
             exp.norm = [[self.norm[0][i + siz * j] for i in xrange(start, end)
                          for j in xrange(start, end)]]
         except TypeError: # no Hi-C data provided
-            matrix = self.get_hic_matrix(normalized=True)
-            new_matrix = [[matrix[i][j] for i in xrange(start, end)]
+            hic = self.norm[0]
+            new_matrix = [[hic[j + siz * i] for i in xrange(start, end)]
                            for j in xrange(start, end)]
             tmp = Chromosome('tmp')
             tmp.add_experiment('exp1', norm_data=[new_matrix],
@@ -1136,7 +1203,7 @@ class Experiment(object):
     def view(self, tad=None, focus=None, paint_tads=False, axe=None,
              show=True, logarithm=True, normalized=False, relative=True,
              decorate=True, savefig=None, where='both', clim=None,
-             cmap='jet'):
+             cmap='jet', max_pixels=None):
         """
         Visualize the matrix of Hi-C interactions
 
@@ -1173,6 +1240,11 @@ class Experiment(object):
            scale. I.e. clim=(-4, 10)
         :param 'jet' cmap: color map from matplotlib. Can also be a
            preconfigured cmap object.
+        :param None max_pixels: maximum number of rows (or columns) of the
+           matrix displayed. Larger regions are displayed at a lower
+           resolution, each cell being the mean interaction of a block of bins
+           (computed by tiles from the sparse data, without building the dense
+           matrix)
         """
         if logarithm==True:
             fun = log2
@@ -1231,7 +1303,18 @@ class Experiment(object):
         if axe is None:
             plt.figure(figsize=(8, 6))
             axe = plt.subplot(111)
-        if tad or focus:
+        nbins = None
+        if (max_pixels and start is not None
+            and int(end) - int(start) + 1 > max_pixels):
+            nbins = int(end) - int(start) + 1
+            if normalized:
+                tiles = HiCTiles(norm_data[0], masked=self._zeros)
+            else:
+                tiles = HiCTiles(hic_data[0])
+            level = zoom_level(nbins, max_pixels)
+            matrix = tiles.region(int(start) - 1, int(end), int(start) - 1,
+                                  int(end), level, mean=True).tolist()
+        elif tad or focus:
             if start > -1:
                 if normalized:
                     matrix = [
@@ -1264,15 +1347,16 @@ class Experiment(object):
                 matrix = [[hic_data[0][i+size*j]\
                            for i in xrange(size)] \
                           for j in xrange(size)]
+        nbins = nbins or len(matrix)
         if where == 'up':
-            for i in xrange(int(end - start)):
-                for j in xrange(i, int(end - start)):
+            for i in xrange(len(matrix) - 1):
+                for j in xrange(i, len(matrix) - 1):
                     matrix[i][j] = vmin
             alphas = array([0, 0] + [1] * 256 + [0])
             jet._init()
             jet._lut[:, -1] = alphas
         elif where == 'down':
-            for i in xrange(int(end - start)):
+            for i in xrange(len(matrix) - 1):
                 for j in xrange(i + 1):
                     matrix[i][j] = vmin
             alphas = array([0, 0] + [1] * 256 + [0])
@@ -1286,16 +1370,16 @@ class Experiment(object):
             img = axe.imshow(nozero_log_matrix(matrix, fun), origin='lower', vmin=vmin, vmax=vmax,
                              interpolation="nearest", cmap=cmap,
                              extent=(int(start or 1) - 0.5,
-                                     int(start or 1) + len(matrix) - 0.5,
+                                     int(start or 1) + nbins - 0.5,
                                      int(start or 1) - 0.5,
-                                     int(start or 1) + len(matrix) - 0.5))
+                                     int(start or 1) + nbins - 0.5))
         else:
             img = axe.imshow(nozero_log_matrix(matrix, fun), origin='lower',
                              interpolation="nearest", cmap=cmap,
                              extent=(int(start or 1) - 0.5,
-                                     int(start or 1) + len(matrix) - 0.5,
+                                     int(start or 1) + nbins - 0.5,
                                      int(start or 1) - 0.5,
-                                     int(start or 1) + len(matrix) - 0.5))
+                                     int(start or 1) + nbins - 0.5))
         if decorate:
             cbar = axe.figure.colorbar(img)
             cbar.ax.set_ylabel('%sHi-C %sinteraction count' % (
@@ -1311,9 +1395,9 @@ class Experiment(object):
                     self.resolution))
         if not paint_tads:
             axe.set_ylim(int(start or 1) - 0.5,
-                         int(start or 1) + len(matrix) - 0.5)
+                         int(start or 1) + nbins - 0.5)
             axe.set_xlim(int(start or 1) - 0.5,
-                         int(start or 1) + len(matrix) - 0.5)
+                         int(start or 1) + nbins - 0.5)
             if show:
                 plt.show()
             return img
@@ -1342,9 +1426,9 @@ class Experiment(object):
                     axe.plot((t_end      , t_end   - j),
                              (t_start + j, t_start    ), color='k')
         axe.set_ylim(int(start or 1) - 0.5,
-                     int(start or 1) + len(matrix) - 0.5)
+                     int(start or 1) + nbins - 0.5)
         axe.set_xlim(int(start or 1) - 0.5,
-                     int(start or 1) + len(matrix) - 0.5)
+                     int(start or 1) + nbins - 0.5)
         if paint_tads:
             ticks = []
             labels = []
@@ -8,6 +8,8 @@ from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
 from pytadbit.utils.normalize_hic   import iterative, expected
 from pytadbit.parsers.genome_parser import parse_fasta
+from pytadbit.parsers.genome_store  import load_genome_store, is_genome_store
+from pytadbit.parsers.genome_store  import chromosome_lengths
 from pytadbit.parsers.bed_parser    import parse_bed
 from pytadbit.utils.file_handling   import mkdir
 from pytadbit.utils.hmm             import gaussian_prob, best_path, train
@@ -15,7 +17,11 @@ from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
-from numpy                          import nanmax
+from numpy                          import nanmax, zeros, fromiter, in1d
+from numpy                          import concatenate, argsort, repeat, diff
+from numpy                          import bincount, cumsum, int32, int64
+from numpy                          import arange, empty, ix_, save, triu
+from numpy                          import issubdtype, integer
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
 from scipy.sparse.linalg            import eigsh
@@ -24,7 +30,10 @@ from scipy.stats                    import ttest_ind
 from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, triu as sp_triu
+from itertools                      import imap, izip
+import multiprocessing as mu
+import copy_reg
 import os
 
 class HiC_data(dict):
@@ -33,6 +42,9 @@ class HiC_data(dict):
     """
     def __init__(self, items, size, chromosomes=None, dict_sec=None,
                  resolution=1, masked=None, symmetricized=False):
+        if isinstance(items, SparseHiC_data):
+            # its values are not in the underlying dictionary
+            items = items.iteritems()
         super(HiC_data, self).__init__(items)
         self.__size = size
         self._size2 = size**2
@@ -43,6 +55,7 @@ class HiC_data(dict):
         self.section_pos = {}
         self.resolution = resolution
         self.expected = None
+        self._expected_key = None  # parameters of the cached expected counts
         self.symmetricized = symmetricized
         self.compartments = {}
         if self.chromosomes:
@@ -106,15 +119,9 @@ class HiC_data(dict):
 
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.iteritems():
-            row, col = round(key / self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
-
+        keys = fromiter(self.iterkeys(), dtype=int64, count=dict.__len__(self))
+        values = fromiter(self.itervalues(), dtype=float, count=len(keys))
+        rows, cols = keys // self.__size, keys % self.__size
         return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
 
     def add_sections_from_fasta(self, fasta):
@@ -122,14 +129,21 @@ class HiC_data(dict):
         Add genomic coordinate to HiC_data object by getting them from a FASTA
         file containing chromosome sequences
 
-        :param fasta: path to a FASTA file
+        :param fasta: path to a FASTA file, or to a genome store (see
+           :func:`pytadbit.parsers.genome_store.write_genome_store`). Can also
+           be an already loaded genome.
         """
-        genome = parse_fasta(fasta, verbose=False)
+        if not isinstance(fasta, (basestring, list)):
+            genome = fasta
+        elif isinstance(fasta, basestring) and is_genome_store(fasta):
+            genome = load_genome_store(fasta)
+        else:
+            genome = parse_fasta(fasta, verbose=False)
         sections = []
         genome_seq = OrderedDict()
         size = 0
-        for crm in  genome:
-            genome_seq[crm] = int(len(genome[crm])) / self.resolution + 1
+        for crm, crm_len in  chromosome_lengths(genome).iteritems():
+            genome_seq[crm] = int(crm_len) / self.resolution + 1
             size += genome_seq[crm]
         section_sizes = {}
         for crm in genome_seq:
@@ -320,7 +334,8 @@ class HiC_data(dict):
         It fills the Experiment.norm variable with the Hi-C values divided by
         the calculated weight.
 
-        :param 0 iteration: number of iterations
+        :param 0 iteration: number of iterations ('max' to iterate until
+           convergence, as defined by max_dev)
         :param 0.1 max_dev: iterative process stops when the maximum deviation
            between the sum of row is equal to this number (0.1 means 10%)
         :param False silent: does not warn when overwriting weights
@@ -566,7 +581,8 @@ class HiC_data(dict):
     def find_compartments(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', how='',
                           label_compartments='hmm', log=None, max_mean_size=10000,
-                          ev_index=None, rich_in_A=None, max_ev=3, **kwargs):
+                          ev_index=None, rich_in_A=None, max_ev=3, ncpus=1,
+                          **kwargs):
         """
         Search for A/B compartments in each chromosome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -590,7 +606,8 @@ class HiC_data(dict):
         :param None savedata: path to a new file to store compartment
            predictions, one file only.
         :param None savecorr: path to a directory where to save correlation
-           matrices of each chromosome
+           matrices of each chromosome (as tab separated text and as NumPy
+           array, '.npy')
         :param -1 vmin: for the color scale of the plotted map (use vmin='auto',
            and vmax='auto' to color according to the absolute maximum found).
         :param 1 vmax: for the color scale of the plotted map (use vmin='auto',
@@ -617,9 +634,8 @@ class HiC_data(dict):
            cluster.
         :param 'ratio' how: ratio divide by column, subratio divide by
            compartment, diagonal only uses diagonal
-
-
-        TODO: this is really slow...
+        :param 1 ncpus: number of chromosomes processed in parallel (to
+           compute expected counts and correlation matrices)
 
         Notes: building the distance matrix using the amount of interactions
                instead of the mean correlation, gives generally worse results.
@@ -639,7 +655,8 @@ class HiC_data(dict):
         if not self.expected:
             if kwargs.get('verbose', False):
                 print 'Normalizing by expected values'
-            self.expected = expected(self, bads=self.bads, **kwargs)
+            self.expected = expected(self, bads=self.bads, ncpus=ncpus,
+                                     **kwargs)
         if not self.bias:
             if kwargs.get('verbose', False):
                 print 'Normalizing by ICE (1 round)'
@@ -660,170 +677,159 @@ class HiC_data(dict):
         ev_nums = {}
         count = 0
 
-        for sec in self.section_pos:
-            if crms and sec not in crms:
-                continue
-            if kwargs.get('verbose', False):
-                print 'Processing chromosome', sec
-            matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                       / self.bias[i] / self.bias[j])
-                      for i in xrange(*self.section_pos[sec])
-                       if not i in self.bads]
-                     for j in xrange(*self.section_pos[sec])
-                      if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
-                continue
-            for i in xrange(len(matrix)):
-                for j in xrange(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
-            try:
-                matrix = [list(m) for m in corrcoef(matrix)]
-            except TypeError:
-                # very small chromosome?
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
-                continue
-            # write correlation matrix to file. replaces filtered row/columns by NaN
-            if savecorr:
-                out = open(os.path.join(savecorr, '%s_corr-matrix.tsv' % (sec)),
-                           'w')
-                start1, end1 = self.section_pos[sec]
-                out.write('# MASKED %s\n' % (' '.join([str(k - start1)
-                                                       for k in self.bads.keys()
-                                                       if start1 <= k <= end1])))
-                rownam = ['%s\t%d-%d' % (k[0],
-                                         k[1] * self.resolution,
-                                         (k[1] + 1) * self.resolution)
-                          for k in sorted(self.sections,
-                                          key=lambda x: self.sections[x])
-                          if k[0] == sec]
-                length = self.section_pos[sec][1] - self.section_pos[sec][0]
-                empty = 'NaN\t' * (length - 1) + 'NaN\n'
-                badrows = 0
-                for row, posx in enumerate(xrange(self.section_pos[sec][0],
-                                                  self.section_pos[sec][1])):
-                    if posx in self.bads:
-                        out.write(rownam.pop(0) + '\t' + empty)
-                        badrows += 1
-                        continue
-                    vals = []
-                    badcols = 0
-                    for col, posy in enumerate(xrange(self.section_pos[sec][0],
-                                                      self.section_pos[sec][1])):
-                        if posy in self.bads:
-                            vals.append('NaN')
-                            badcols += 1
-                            continue
-                        vals.append(str(matrix[row-badrows][col-badcols]))
-                    out.write(rownam.pop(0) + '\t' +'\t'.join(vals) + '\n')
-                out.close()
+        # observed/expected, correlation and eigenvectors of each chromosome,
+        # computed in parallel
+        secs = [sec for sec in self.section_pos if not (crms and sec not in crms)]
+        csr = self.get_hic_data_as_csr()
+        jobs = (self._compartment_job(csr, sec, max_ev) for sec in secs)
+        pool = None
+        if ncpus > 1:
+            pool = mu.Pool(ncpus)
+            results = pool.imap(_correlation_eigenvectors, jobs)
+        else:
+            results = imap(_correlation_eigenvectors, jobs)
 
-            try:
-                # This eighs is very very fast, only ask for one eigvector
-                _, evect = eigsh(array(matrix), k=max_ev)
-            except (LinAlgError, ValueError):
-                warn('Chromosome %s too small to compute PC1' % (sec))
-                cmprts[sec] = [] # Y chromosome, or so...
-                count += 1
-                continue
-            index = ev_index[count] if ev_index else 1
-            n_first = [list(evect[:, -i]) for i in xrange(1, max_ev + 1)]
-            for ev_num in range(index, max_ev + 1):
+        try:
+            for sec, (matrix, evect) in izip(secs, results):
+                if kwargs.get('verbose', False):
+                    print 'Processing chromosome', sec
+                if matrix is None: # MT chromosome will fall there
+                    warn('Chromosome %s is probably MT :)' % (sec))
+                    cmprts[sec] = []
+                    count += 1
+                    continue
+                beg, end = self.section_pos[sec]
+                good = array([i not in self.bads for i in xrange(beg, end)])
+                # correlation matrix with filtered row/columns replaced by NaN
+                full = empty((end - beg, end - beg))
+                full.fill(float('nan'))
+                full[ix_(good, good)] = matrix
+                # write correlation matrix to file (as text and as numpy array)
+                if savecorr:
+                    save(os.path.join(savecorr, '%s_corr-matrix.npy' % (sec)), full)
+                    out = open(os.path.join(savecorr, '%s_corr-matrix.tsv' % (sec)),
+                               'w')
+                    start1, end1 = self.section_pos[sec]
+                    out.write('# MASKED %s\n' % (' '.join([str(k - start1)
+                                                           for k in self.bads.keys()
+                                                           if start1 <= k <= end1])))
+                    rownam = ['%s\t%d-%d' % (k[0],
+                                             k[1] * self.resolution,
+                                             (k[1] + 1) * self.resolution)
+                              for k in sorted(self.sections,
+                                              key=lambda x: self.sections[x])
+                              if k[0] == sec]
+                    length = self.section_pos[sec][1] - self.section_pos[sec][0]
+                    empty_row = 'NaN\t' * (length - 1) + 'NaN\n'
+                    goods = good.tolist()
+                    for name, row, is_good in izip(rownam, full.tolist(), goods):
+                        if not is_good:
+                            out.write(name + '\t' + empty_row)
+                            continue
+                        out.write(name + '\t' + '\t'.join(
+                            [repr(v) if g else 'NaN' for v, g in izip(row, goods)])
+                                  + '\n')
+                    out.close()
+
+                if evect is None:
+                    warn('Chromosome %s too small to compute PC1' % (sec))
+                    cmprts[sec] = [] # Y chromosome, or so...
+                    count += 1
+                    continue
+                index = ev_index[count] if ev_index else 1
+                n_first = [list(evect[:, -i]) for i in xrange(1, max_ev + 1)]
+                for ev_num in range(index, max_ev + 1):
+                    first = list(evect[:, -ev_num])
+                    breaks = [i for i, (a, b) in
+                              enumerate(zip(first[1:], first[:-1]))
+                              if a * b < 0] + [len(first) - 1]
+                    breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
+                              for i, b in enumerate(breaks)]
+                    if (self.resolution * (len(breaks) - 1.0) / len(matrix)
+                        > max_mean_size):
+                        warn('WARNING: number of compartments found with the '
+                             'EigenVector number %d is too low (%d compartments '
+                             'in %d rows), for chromosome %s' % (
+                                 ev_num, len(breaks), len(matrix), sec))
+                    else:
+                        break
+                if (self.resolution * (len(breaks) - 1.0) / len(matrix)
+                    > max_mean_size):
+                    warn('WARNING: keeping first eigenvector, for chromosome %s' % (
+                        sec))
+                    ev_num = 1
+                if ev_index:
+                    ev_num = ev_index[count]
                 first = list(evect[:, -ev_num])
                 breaks = [i for i, (a, b) in
                           enumerate(zip(first[1:], first[:-1]))
                           if a * b < 0] + [len(first) - 1]
                 breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
                           for i, b in enumerate(breaks)]
-                if (self.resolution * (len(breaks) - 1.0) / len(matrix)
-                    > max_mean_size):
-                    warn('WARNING: number of compartments found with the '
-                         'EigenVector number %d is too low (%d compartments '
-                         'in %d rows), for chromosome %s' % (
-                             ev_num, len(breaks), len(matrix), sec))
-                else:
-                    break
-            if (self.resolution * (len(breaks) - 1.0) / len(matrix)
-                > max_mean_size):
-                warn('WARNING: keeping first eigenvector, for chromosome %s' % (
-                    sec))
-                ev_num = 1
-            if ev_index:
-                ev_num = ev_index[count]
-            first = list(evect[:, -ev_num])
-            breaks = [i for i, (a, b) in
-                      enumerate(zip(first[1:], first[:-1]))
-                      if a * b < 0] + [len(first) - 1]
-            breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
-                      for i, b in enumerate(breaks)]
-            ev_nums[sec] = ev_num
-            beg, end = self.section_pos[sec]
-            bads = [k - beg for k in self.bads if beg <= k <= end]
-            for evect in n_first:
-                _ = [evect.insert(b, float('nan')) for b in bads]
-            _ = [first.insert(b, 0) for b in bads]
-            _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
-                 for b in bads]
-            _ = [matrix[i].insert(b, float('nan'))
-                 for b in bads for i in xrange(len(first))]
-            breaks = [i for i, (a, b) in
-                      enumerate(zip(first[1:], first[:-1]))
-                      if a * b < 0] + [len(first) - 1]
-            breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
-                      for i, b in enumerate(breaks)]
-            cmprts[sec] = breaks
-            firsts[sec] = n_first
-            # needed for the plotting
-            self._apply_metric(cmprts, sec, rich_in_A, how=how)
-
-            if label_compartments == 'cluster':
-                if log:
-                    logf = os.path.join(log, sec + suffix + '.log')
-                else:
-                    logf = None
-
-                gammas = {}
-                for n_clust in range(2, 4):
-                    for gamma in range(0, 101, 1):
-                        scorett, tt, prop = _cluster_ab_compartments(
-                            float(gamma)/100, matrix, breaks, cmprts[sec],
-                            rich_in_A, ev_num=ev_num, log=logf, save=False,
-                            verbose=kwargs.get('verbose', False),
-                            n_clust=n_clust)
-                        gammas[gamma] = scorett, tt, prop
-                    gamma = min(gammas.keys(), key=lambda k: gammas[k][0])
-                    if gammas[gamma][0] - gammas[gamma][1] > 7:
-                        print (' WARNING: minimum showing very low '
-                               'intermeagling of A/B compartments, trying '
-                               'with 3 clusters, for chromosome %s', sec)
-                        gammas = {}
-                        continue
-                    if kwargs.get('verbose', False):
-                        print '   ====>  minimum:', gamma
-                    break
-                _ = _cluster_ab_compartments(float(gamma)/100, matrix, breaks,
-                                          cmprts[sec], rich_in_A, save=True,
-                                          log=logf, ev_num=ev_num, n_clust=n_clust)
-
-            if savefig or show:
-                vmin = kwargs.get('vmin', -1)
-                vmax = kwargs.get('vmax',  1)
-                if vmin == 'auto' == vmax:
-                    vmax = max([abs(npperc(matrix, 99.5)),
-                                abs(npperc(matrix, 0.5))])
-                    vmin = -vmax
-                plot_compartments(
-                    sec, first, cmprts, matrix, show,
-                    savefig + '/chr' + str(sec) + suffix + '.pdf' if savefig else None,
-                    vmin=vmin, vmax=vmax, whichpc=ev_num)
-                plot_compartments_summary(
-                    sec, cmprts, show,
-                    savefig + '/chr' + str(sec) + suffix + '_summ.pdf' if savefig else None)
-            count += 1
+                ev_nums[sec] = ev_num
+                bads = sorted(k - beg for k in self.bads if beg <= k < end)
+                for evect in n_first:
+                    _ = [evect.insert(b, float('nan')) for b in bads]
+                _ = [first.insert(b, 0) for b in bads]
+                matrix = full
+                breaks = [i for i, (a, b) in
+                          enumerate(zip(first[1:], first[:-1]))
+                          if a * b < 0] + [len(first) - 1]
+                breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
+                          for i, b in enumerate(breaks)]
+                cmprts[sec] = breaks
+                firsts[sec] = n_first
+                # needed for the plotting
+                self._apply_metric(cmprts, sec, rich_in_A, how=how, csr=csr)
+
+                if label_compartments == 'cluster':
+                    if log:
+                        logf = os.path.join(log, sec + suffix + '.log')
+                    else:
+                        logf = None
+
+                    gammas = {}
+                    for n_clust in range(2, 4):
+                        for gamma in range(0, 101, 1):
+                            scorett, tt, prop = _cluster_ab_compartments(
+                                float(gamma)/100, matrix, breaks, cmprts[sec],
+                                rich_in_A, ev_num=ev_num, log=logf, save=False,
+                                verbose=kwargs.get('verbose', False),
+                                n_clust=n_clust)
+                            gammas[gamma] = scorett, tt, prop
+                        gamma = min(gammas.keys(), key=lambda k: gammas[k][0])
+                        if gammas[gamma][0] - gammas[gamma][1] > 7:
+                            print (' WARNING: minimum showing very low '
+                                   'intermeagling of A/B compartments, trying '
+                                   'with 3 clusters, for chromosome %s', sec)
+                            gammas = {}
+                            continue
+                        if kwargs.get('verbose', False):
+                            print '   ====>  minimum:', gamma
+                        break
+                    _ = _cluster_ab_compartments(float(gamma)/100, matrix, breaks,
+                                              cmprts[sec], rich_in_A, save=True,
+                                              log=logf, ev_num=ev_num, n_clust=n_clust)
+
+                if savefig or show:
+                    vmin = kwargs.get('vmin', -1)
+                    vmax = kwargs.get('vmax',  1)
+                    if vmin == 'auto' == vmax:
+                        vmax = max([abs(npperc(matrix, 99.5)),
+                                    abs(npperc(matrix, 0.5))])
+                        vmin = -vmax
+                    plot_compartments(
+                        sec, first, cmprts, matrix, show,
+                        savefig + '/chr' + str(sec) + suffix + '.pdf' if savefig else None,
+                        vmin=vmin, vmax=vmax, whichpc=ev_num)
+                    plot_compartments_summary(
+                        sec, cmprts, show,
+                        savefig + '/chr' + str(sec) + suffix + '_summ.pdf' if savefig else None)
+                count += 1
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
 
         if label_compartments == 'hmm':
             x = {}
@@ -863,7 +869,7 @@ class HiC_data(dict):
                 results[sec] = n_states, breaks
                 cmprts[sec] = breaks
                 # print 'CMPRTS after hmm', sec, cmprts[sec]
-                self._apply_metric(cmprts, sec, rich_in_A, how=how)
+                self._apply_metric(cmprts, sec, rich_in_A, how=how, csr=csr)
 
                 if rich_in_A:
                     test = lambda x: x >= 1
@@ -916,11 +922,47 @@ class HiC_data(dict):
                                     ev_nums=ev_nums)
         return firsts
 
-    def _apply_metric(self, cmprts, sec, rich_in_A, how='ratio'):
+    def _chromosome_oe(self, csr, sec):
+        """
+        :param csr: the Hi-C matrix in Compressed Sparse Row format
+        :param sec: chromosome name
+
+        :returns: the observed/expected matrix of a chromosome normalized by
+           biases (sparse, without the values of filtered columns), and a
+           boolean array marking the columns that are not filtered
+        """
+        beg, end = self.section_pos[sec]
+        good = array([i not in self.bads for i in xrange(beg, end)])
+        matrix = csr[beg:end, beg:end].tocoo()
+        keep = good[matrix.row] & good[matrix.col]
+        rows = matrix.row[keep]
+        cols = matrix.col[keep]
+        bias = array([self.bias.get(i, 1.) for i in xrange(beg, end)])
+        expc = array([self.expected[i] for i in xrange(end - beg)])
+        vals = (matrix.data[keep] / expc[abs(cols - rows)]
+                / bias[rows] / bias[cols])
+        return csr_matrix((vals, (rows, cols)),
+                          shape=(end - beg, end - beg)), good
+
+    def _compartment_job(self, csr, sec, max_ev):
+        """
+        Arguments of :func:`_correlation_eigenvectors` for a given chromosome:
+        the upper triangle of its observed/expected matrix, without filtered
+        columns.
+        """
+        matrix, good = self._chromosome_oe(csr, sec)
+        idx = good.nonzero()[0]
+        return sp_triu(matrix[idx][:, idx]).tocsr(), max_ev
+
+    def _apply_metric(self, cmprts, sec, rich_in_A, how='ratio', csr=None):
         """
         calculate compartment internal density if no rich_in_A, otherwise
         sum this list
+
+        :param None csr: the Hi-C matrix in Compressed Sparse Row format (built
+           from the HiC_data if not given)
         """
+        matrix = None
         # print 'SEGMENTS'
         # print sec, self.section_pos[sec]
         # for i in range(0, len(cmprts[sec]), 20):
@@ -937,36 +979,26 @@ class HiC_data(dict):
                 except ZeroDivisionError:
                     cmprt['dens'] = 0.
             else:
-                beg, end = self.section_pos[sec]
-                beg1, end1 = cmprt['start'] + beg, cmprt['end'] + beg + 1
-                # print 'BEG:%7d, END:%7d, LEN bias:%7d, LEN self:%7d, LEN expected:%7d' % (beg1, end1, len(self.bias),
-                                                                                          # len(self), len(self.expected))
+                if matrix is None:
+                    matrix, _ = self._chromosome_oe(
+                        self.get_hic_data_as_csr() if csr is None else csr, sec)
+                    diagonal = matrix.diagonal()
+                beg1, end1 = cmprt['start'], cmprt['end'] + 1
                 if 'diagonal' in how:
-                    sec_matrix = [(self[i,i] / self.expected[0] / self.bias[i]**2)
-                                  for i in xrange(beg1, end1) if not i in self.bads]
+                    sec_matrix = diagonal[beg1:end1].sum()
                 else: #if 'compartment' in how:
-                    sec_matrix = [(self[i,j] / self.expected[abs(j-i)]
-                                   / self.bias[i] / self.bias[j])
-                                  for i in xrange(beg1, end1) if not i in self.bads
-                                  for j in xrange(beg1, end1) if not j in self.bads]
+                    sec_matrix = matrix[beg1:end1, beg1:end1].sum()
                 if '/compartment' in how: # diagonal / compartment
-                    sec_column = [(self[i,j] / self.expected[abs(j-i)]
-                                   / self.bias[i] / self.bias[j])
-                                  for i in xrange(beg1, end1) if not i in self.bads
-                                  for j in xrange(beg1, end1) if not j in self.bads]
+                    sec_column = matrix[beg1:end1, beg1:end1].sum()
                 elif '/column' in how:
-                    sec_column = [(self[i,j] / self.expected[abs(j-i)]
-                                   / self.bias[i] / self.bias[j])
-                                  for i in xrange(beg1, end1) if not i in self.bads
-                                  for j in range(beg, end)
-                                  if not j in self.bads]
+                    sec_column = matrix[beg1:end1].sum()
                 else:
-                    sec_column = [1.]
+                    sec_column = 1.
                 try:
                     if 'type' in cmprt and isnan(cmprt['type']):
                         cmprt['dens'] = 1.
                     else:
-                        cmprt['dens'] = float(sum(sec_matrix)) / sum(sec_column)
+                        cmprt['dens'] = float(sec_matrix) / float(sec_column)
                 except ZeroDivisionError:
                     cmprt['dens'] = 1.
         # normalize to 1.0
@@ -1094,6 +1126,395 @@ class HiC_data(dict):
                            [self[i, j] for j in xrange(i + 1, end1)])
 
 
+class SparseHiC_data(HiC_data):
+    """
+    Array backed HiC_data. Instead of storing one dictionary entry per
+    interacting cell, contacts are stored in Compressed Sparse Row format
+    (int32 column indices, uint32 or float32 values), which reduces about 5 to
+    10 times the memory used by genome-wide matrices.
+
+    The same interface as HiC_data is available (get, [i, j], iteritems,
+    get_matrix, yield_matrix, get_hic_data_as_csr...).
+
+    Values set with self[i, j] = v are kept in a small buffer that is merged
+    into the arrays when it gets bigger than 'buffer_size', or whenever the
+    whole matrix is needed. Null values are not stored. If values that can not
+    be stored with the given dtype are set (e.g. non-integer values in a
+    'uint32' matrix), values are stored as float64.
+
+    :param items: an iterable of (position, value) (positions being
+       row * size + col as in HiC_data), or a scipy sparse matrix
+    :param size: number of rows (or columns) in the matrix
+    :param uint32 dtype: type of the values stored, use float32 for
+       normalized data
+    :param 1000000 buffer_size: maximum number of cells modified before
+       merging them into the arrays
+    :param None csr_arrays: tuple with the indptr, indices and data arrays of
+       a matrix in Compressed Sparse Row format, used directly as storage
+       (e.g. memory-mapped arrays). If given, items are ignored
+
+    Note: the underlying dictionary is empty, functions reading it directly
+    (like dict(hic_data)) do not see the stored values, use
+    dict(hic_data.iteritems()) instead.
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False,
+                 dtype='uint32', buffer_size=1000000, csr_arrays=None):
+        super(SparseHiC_data, self).__init__(
+            (), size, chromosomes=chromosomes, dict_sec=dict_sec,
+            resolution=resolution, masked=masked, symmetricized=symmetricized)
+        self.dtype = dtype
+        self.buffer_size = buffer_size
+        self._buffer = {}
+        self._indptr  = zeros(size + 1, dtype=int64)
+        self._indices = zeros(0, dtype=int32)
+        self._data    = zeros(0, dtype=dtype)
+        if csr_arrays is not None:
+            self._indptr, self._indices, self._data = csr_arrays
+        elif hasattr(items, 'tocsr'):
+            items = items.tocsr().tocoo()  # sums duplicated cells
+            self._set_arrays(items.row.astype(int64) * size + items.col,
+                             items.data)
+        else:
+            items = iter(items)
+            while True:
+                chunk = dict((k, v) for _, (k, v) in izip(xrange(buffer_size),
+                                                          items))
+                if not chunk:
+                    break
+                self._buffer = chunk
+                self._flush()
+
+    def _set_arrays(self, keys, values):
+        """
+        replace the content of the matrix by the given flat positions and values
+        """
+        size = len(self)
+        keep = (values != 0) & (keys < size * size)
+        keys = keys[keep]
+        values = values[keep]
+        if (issubdtype(self.dtype, integer)
+            and (values != values.astype(self.dtype)).any()):
+            self.dtype = 'float64'
+        order = argsort(keys, kind='mergesort')
+        keys = keys[order]
+        rows = keys // size
+        self._indices = (keys - rows * size).astype(int32)
+        self._data = values[order].astype(self.dtype)
+        self._indptr = zeros(size + 1, dtype=int64)
+        self._indptr[1:] = cumsum(bincount(rows, minlength=size)[:size])
+
+    def _flat_keys(self):
+        """
+        :returns: the flat positions (row * size + col) of stored values
+        """
+        rows = repeat(arange(len(self._indptr) - 1, dtype=int64),
+                      diff(self._indptr))
+        return rows * len(self) + self._indices
+
+    def _flush(self):
+        """
+        merges buffered values into the arrays (also adjusts the arrays to the
+        size of the matrix, keeping row and column of stored values)
+        """
+        if not self._buffer and len(self._indptr) == len(self) + 1:
+            return
+        new_keys = fromiter(self._buffer.iterkeys(), dtype=int64,
+                            count=len(self._buffer))
+        new_vals = fromiter(self._buffer.itervalues(), dtype=float,
+                            count=len(self._buffer))
+        self._buffer = {}
+        old_keys = self._flat_keys()
+        keep = ~in1d(old_keys, new_keys)
+        self._set_arrays(concatenate((old_keys[keep], new_keys)),
+                         concatenate((self._data[keep], new_vals)))
+
+    def _update_size(self, size):
+        self._flush()
+        super(SparseHiC_data, self)._update_size(size)
+        self._flush()
+
+    def add_sections_from_fasta(self, fasta):
+        self._flush()
+        super(SparseHiC_data, self).add_sections_from_fasta(fasta)
+        self._flush()
+
+    add_sections_from_fasta.__doc__ = HiC_data.add_sections_from_fasta.__doc__
+
+    def add_sections(self, lengths, chr_names=None, binned=False):
+        self._flush()
+        super(SparseHiC_data, self).add_sections(lengths, chr_names=chr_names,
+                                                 binned=binned)
+        self._flush()
+
+    add_sections.__doc__ = HiC_data.add_sections.__doc__
+
+    def get(self, pos, default=None):
+        """
+        Value stored at a flat position (row * size + col)
+        """
+        try:
+            # null values in the buffer are removed cells
+            return self._buffer[pos] or default
+        except KeyError:
+            pass
+        row, col = divmod(pos, len(self))
+        try:
+            beg, end = self._indptr[row], self._indptr[row + 1]
+        except IndexError:
+            return default
+        idx = beg + self._indices[beg:end].searchsorted(col)
+        if idx < end and self._indices[idx] == col:
+            return self._data[idx].item()
+        return default
+
+    def __getitem__(self, row_col):
+        try:
+            row, col = row_col
+            pos = row * len(self) + col
+        except TypeError:
+            pos = row_col
+        if pos > self._size2:
+            raise IndexError(
+                'ERROR: position %d larger than %s^2' % (pos, len(self)))
+        return self.get(pos, 0)
+
+    def __setitem__(self, row_col, val):
+        try:
+            row, col = row_col
+            pos = row * len(self) + col
+        except TypeError:
+            pos = row_col
+        if pos > self._size2:
+            raise IndexError(
+                'ERROR: position %d larger than %s^2' % (pos, len(self)))
+        self._buffer[pos] = val
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def __delitem__(self, row_col):
+        try:
+            row, col = row_col
+            pos = row * len(self) + col
+        except TypeError:
+            pos = row_col
+        if self.get(pos) is None:
+            raise KeyError(row_col)
+        self._buffer[pos] = 0
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    has_key = __contains__
+
+    def pop(self, pos, *default):
+        val = self.get(pos)
+        if val is None:
+            if default:
+                return default[0]
+            raise KeyError(pos)
+        del self[pos]
+        return val
+
+    def popitem(self):
+        self._flush()
+        if not len(self._data):
+            raise KeyError('popitem(): dictionary is empty')
+        pos = self._flat_keys()[-1].item()
+        return pos, self.pop(pos)
+
+    def setdefault(self, pos, default=None):
+        val = self.get(pos)
+        if val is None:
+            self[pos] = default
+            return default
+        return val
+
+    def update(self, other=(), **kwargs):
+        if kwargs:
+            raise TypeError('ERROR: keys should be flat positions (integers)')
+        if hasattr(other, 'iteritems'):
+            other = other.iteritems()
+        for pos, val in other:
+            self[pos] = val
+
+    def clear(self):
+        self._buffer = {}
+        self._indptr  = zeros(len(self) + 1, dtype=int64)
+        self._indices = zeros(0, dtype=int32)
+        self._data    = zeros(0, dtype=self.dtype)
+
+    def copy(self):
+        """
+        :returns: a SparseHiC_data object with a copy of the stored values
+           (other attributes are shared, as in a shallow copy)
+        """
+        self._flush()
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._buffer  = {}
+        new._indptr  = self._indptr.copy()
+        new._indices = self._indices.copy()
+        new._data    = self._data.copy()
+        return new
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __reduce__(self):
+        # the default reduction of dict subclasses would store the (empty)
+        # underlying dictionary
+        return copy_reg.__newobj__, (self.__class__,), self.__getstate__()
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.iteritems()) == dict(other.iteritems())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def iteritems(self):
+        self._flush()
+        for k, v in izip(self._flat_keys().tolist(), self._data.tolist()):
+            yield k, v
+
+    def iterkeys(self):
+        self._flush()
+        return iter(self._flat_keys().tolist())
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        self._flush()
+        return iter(self._data.tolist())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    # the views of the underlying dictionary would be empty, stored values are
+    # returned instead (as lists, not updated when the matrix is modified)
+    viewitems  = items
+    viewkeys   = keys
+    viewvalues = values
+
+    def get_hic_data_as_csr(self):
+        """
+        Returns a scipy sparse matrix in Compressed Sparse Row format of the
+        HiC data, sharing the arrays of this object (no copy)
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format
+        """
+        self._flush()
+        return csr_matrix((self._data, self._indices, self._indptr),
+                          shape=(len(self), len(self)))
+
+    def sum(self, bias=None, bads=None):
+        bads = bads or self.bads
+        self._flush()
+        rows = repeat(arange(len(self)), diff(self._indptr))
+        vals = self._data.astype(float)
+        if bias:
+            bias = array([bias.get(i, 1.) for i in xrange(len(self))])
+            vals /= bias[rows] * bias[self._indices]
+        if bads:
+            bads = array([i in bads for i in xrange(len(self))])
+            vals = vals[~(bads[rows] | bads[self._indices])]
+        return vals.sum().item()
+
+    sum.__doc__ = HiC_data.sum.__doc__
+
+    def _dense_region(self, start1, start2, end1, end2, normalized):
+        """
+        :returns: a numpy array with rows from start2 to end2, and columns from
+           start1 to end1
+        """
+        self._flush()
+        # only rows of the region are accessed
+        beg, end = self._indptr[start2], self._indptr[end2]
+        matrix = csr_matrix((self._data[beg:end], self._indices[beg:end],
+                             self._indptr[start2:end2 + 1] - beg),
+                            shape=(end2 - start2, len(self)))
+        matrix = matrix[:, start1:end1].toarray()
+        if normalized:
+            matrix = matrix / array([self.bias[i] for i in xrange(start2, end2)]
+                                    )[:, None]
+            matrix /= array([self.bias[j] for j in xrange(start1, end1)])
+        return matrix
+
+    def get_matrix(self, focus=None, diagonal=True, normalized=False):
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        mtrx = self._dense_region(start1, start2, end1, end2, normalized).T
+        if not diagonal and start1 == start2:
+            for i in xrange(len(mtrx)):
+                mtrx[i, i] = 1 if mtrx[i, i] and not normalized else 0
+        return mtrx.tolist()
+
+    get_matrix.__doc__ = HiC_data.get_matrix.__doc__
+
+    def yield_matrix(self, focus=None, diagonal=True, normalized=False):
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        start1, start2, end1, end2 = self._focus_coords(focus)
+        null = 0.0 if normalized else 0
+        # one chunk of rows at a time to keep memory low
+        for beg in xrange(start2, end2, 1000):
+            end = min(beg + 1000, end2)
+            region = self._dense_region(start1, beg, end1, end, normalized)
+            for i, row in enumerate(region.tolist(), beg):
+                if i in self.bads:
+                    yield [null] * (end1 - start1)
+                    continue
+                if not diagonal and start1 == start2:
+                    row[i - start1] = null
+                yield row
+
+    yield_matrix.__doc__ = HiC_data.yield_matrix.__doc__
+
+
+def _correlation_eigenvectors(args):
+    """
+    Computes the correlation matrix of the observed/expected matrix of a
+    chromosome, and its eigenvectors. Used with multiprocessing map.
+
+    :param args: upper triangle of the observed/expected matrix (sparse, with
+       filtered columns removed), and the number of eigenvectors to compute
+
+    :returns: the correlation matrix (None if the chromosome is too small) and
+       the eigenvectors (None if they can not be computed)
+    """
+    matrix, max_ev = args
+    if matrix.shape[0] < 2:
+        return None, None
+    matrix = matrix.toarray()
+    matrix += triu(matrix, 1).T
+    matrix = corrcoef(matrix)
+    try:
+        # This eighs is very very fast, only ask for one eigvector
+        _, evect = eigsh(matrix, k=max_ev)
+    except (LinAlgError, ValueError):
+        evect = None
+    return matrix, evect
+
+
 def _hmm_refine_compartments(xsec, models, bads, verbose):
     prevll = float('-inf')
     prevdf = 0
@@ -1,8 +1,10 @@
 from pytadbit.utils.file_handling         import mkdir, magic_open
+from pytadbit.utils.extsort               import merge_runs
 from itertools                            import combinations
 from os                                   import path, system
 from sys                                  import stdout
-from collections import OrderedDict
+from collections                          import OrderedDict, deque
+import multiprocessing as mu
 
 def eq_reads(rd1, rd2):
     """
@@ -93,7 +95,8 @@ def merge_2d_beds(path1, path2, outpath):
     out.close()
     return nreads
     
-def get_intersection(fname1, fname2, out_path, verbose=False):
+def get_intersection(fname1, fname2, out_path, verbose=False,
+                     max_size=1000000, ncpus=1):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -108,12 +111,19 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
           - otherwise, they are merged into one longer (as if they were mapped
             in the positive strand)
 
+    Pairs of reads are distributed in buckets of genomic positions, that are
+    sorted and written to a temporary file (a sorted run) each max_size pairs.
+    Runs are finally merged into the output file.
+
     :param fname1: path to a tab separated file generated by the function
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param fname2: path to a tab separated file generated by the function
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param out_path: path to an outfile. It will written in a similar format as
        the inputs
+    :param 1000000 max_size: maximum number of pairs of reads kept in memory
+    :param 1 ncpus: number of processes sorting the runs (while reads are
+       being paired). All available CPUs if 0 or None
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
@@ -128,7 +138,6 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
         if line1.startswith('# CRM'):
             header1 += line1
         line1 = reads1.next()
-    read1 = line1.split('\t', 1)[0]
 
     reads2 = magic_open(fname2)
     line2 = reads2.next()
@@ -137,11 +146,10 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
         if line2.startswith('# CRM'):
             header2 += line2
         line2 = reads2.next()
-    read2 = line2.split('\t', 1)[0]
     if header1 != header2:
         raise Exception('seems to be mapped onover different chromosomes\n')
 
-    # prepare to write read pairs into different files
+    # prepare to write read pairs into different buckets
     # depending on genomic position
     nchunks = 1024
     global CHROM_START
@@ -153,83 +161,125 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
             CHROM_START[crm] = cum_pos
             cum_pos += int(pos)
     lchunk = cum_pos / nchunks
-    buf = dict([(i, []) for i in xrange(nchunks + 1)])
-    # prepare temporary directories
+    buf = [[] for _ in xrange(nchunks + 1)]
+    # prepare temporary directory
     tmp_dir = out_path + '_tmp_files'
     mkdir(tmp_dir)
-    for i in xrange(nchunks / int(nchunks**0.5) + 1):
-        mkdir(path.join(tmp_dir, 'rep_%03d' % i))
 
-    # iterate over reads in each of the two input files
-    # and store them into a dictionary and then into temporary files
-    # dicitonary ois emptied each 1 milion entries
+    # iterate over reads in each of the two input files, store them into
+    # buckets, sorted and written to a temporary file each max_size pairs
     if verbose:
         print ('Getting intersection of reads 1 and reads 2:')
-    count = 0
-    count_dots = -1
-    multiples = {}
+        stdout.write('  ')
+    ncpus = max(1, ncpus or mu.cpu_count())
+    pool = mu.Pool(ncpus) if ncpus > 1 else None
     try:
-        while True:
-            if verbose:
-                if not count_dots % 10:
-                    stdout.write(' ')
-                if not count_dots % 50:
-                    stdout.write('%s\n  ' % (
-                        ('  %4d milion reads' % (count_dots)) if
-                        count_dots else ''))
-                if count_dots >= 0:
+        runs = []
+        pending = deque()
+        count = 0
+        multiples = {}
+        for line1, line2 in _join_reads(reads1, line1, reads2, line2):
+            count += 1
+            _process_lines(line1, line2, buf, multiples, lchunk)
+            if not count % max_size:
+                # keep at most one pending run per process
+                while pool and len(pending) >= ncpus:
+                    pending.popleft().get()
+                buf = _spill_buckets(buf, tmp_dir, runs, pool, pending)
+                if verbose:
                     stdout.write('.')
                     stdout.flush()
-                count_dots += 1
-            for _ in xrange(1000000): # iterate 1 million times, write to files
-                # same read id in both lianes, we store put the more upstream
-                # before and store them
-                if eq_reads(read1, read2):
-                    count += 1
-                    _process_lines(line1, line2, buf, multiples, lchunk)
-                    line1 = reads1.next()
-                    read1 = line1.split('\t', 1)[0]
-                    line2 = reads2.next()
-                    read2 = line2.split('\t', 1)[0]
-                # if first element of line1 is greater than the one of line2:
-                elif gt_reads(read1, read2):
-                    line2 = reads2.next()
-                    read2 = line2.split('\t', 1)[0]
-                else:
-                    line1 = reads1.next()
-                    read1 = line1.split('\t', 1)[0]
-            write_to_files(buf, tmp_dir, nchunks)
-    except StopIteration:
         reads1.close()
         reads2.close()
-    write_to_files(buf, tmp_dir, nchunks)
-    if verbose:
-        print '\nFound %d pair of reads mapping uniquely' % count
-
-    # sort each tmp file according to first element (idx) and write them
-    # to output file (without the idx)
-    # sort also according to read 2 (to filter duplicates)
-    #      and also according to strand
-    if verbose:
-        print 'Sorting each temporary file by genomic coordinate'
+        _spill_buckets(buf, tmp_dir, runs, pool, pending)
+        while pending:
+            pending.popleft().get()
+        if pool:
+            pool.close()
+            pool.join()
+        if verbose:
+            print '\nFound %d pair of reads mapping uniquely' % count
 
-    out = open(out_path, 'w')
-    out.write(header1)
-    for b in buf:
+        # merge sorted runs according to genomic position (bucket and idx), and
+        # write them to output file (without the idx)
+        # sort also according to read 2 (to filter duplicates)
+        #      and also according to strand
+        if verbose:
+            print 'Merging %d sorted temporary files by genomic coordinate' % (
+                len(runs))
+        out = open(out_path, 'w')
+        out.write(header1)
+        key = lambda x: (int(x.split('\t', 1)[0]) / lchunk, ) + _bucket_key(x)
+        for line in merge_runs(runs, key=key):
+            out.write(line.split('\t', 1)[1])
+        out.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
         if verbose:
-            stdout.write('\r    %4d/%d sorted files' % (b + 1, len(buf)))
-            stdout.flush()
-        out.write(''.join(['\t'.join(l[1:]) for l in sorted(
-            [l.split('\t') for l in open(
-                path.join(tmp_dir, 'rep_%03d' % (b / int(nchunks**0.5)),
-                          'tmp_%05d.tsv' % b))],
-            key=lambda x: (x[0], x[8], x[9], x[6]))]))
+            print 'Removing temporary files...'
+        system('rm -rf ' + tmp_dir)
+    return count, multiples
+
+def _join_reads(reads1, line1, reads2, line2):
+    """
+    Merge-join of two files sorted by read name, yields the pairs of lines of
+    the reads found in both files
+    """
+    read1 = line1.split('\t', 1)[0]
+    read2 = line2.split('\t', 1)[0]
+    try:
+        while True:
+            # same read id in both lines
+            if eq_reads(read1, read2):
+                yield line1, line2
+                line1 = reads1.next()
+                read1 = line1.split('\t', 1)[0]
+                line2 = reads2.next()
+                read2 = line2.split('\t', 1)[0]
+            # if first element of line1 is greater than the one of line2:
+            elif gt_reads(read1, read2):
+                line2 = reads2.next()
+                read2 = line2.split('\t', 1)[0]
+            else:
+                line1 = reads1.next()
+                read1 = line1.split('\t', 1)[0]
+    except StopIteration:
+        return
+
+def _bucket_key(line):
+    """
+    sort key of a pair of reads inside a bucket: idx, and position of read 2
+    (to filter duplicates) and of read 1
+    """
+    elts = line.split('\t', 10)
+    return elts[0], elts[8], elts[9], elts[6]
+
+def _write_buckets((buf, fnam)):
+    """
+    Sorts each bucket and writes them, one after the other, to a file
+    """
+    out = open(fnam, 'w')
+    for bucket in buf:
+        bucket.sort(key=_bucket_key)
+        out.write(''.join(bucket))
     out.close()
 
-    if verbose:
-        print '\nRemoving temporary files...'
-    system('rm -rf ' + tmp_dir)
-    return count, multiples
+def _spill_buckets(buf, tmp_dir, runs, pool, pending):
+    """
+    Writes the buckets in a new sorted run, in a background process if a pool
+    is given (the result being appended to pending)
+
+    :returns: new empty buckets
+    """
+    fnam = path.join(tmp_dir, 'run_%05d.tsv' % len(runs))
+    runs.append(fnam)
+    if pool:
+        pending.append(pool.apply_async(_write_buckets, ((buf, fnam), )))
+    else:
+        _write_buckets((buf, fnam))
+    return [[] for _ in buf]
 
 def _loc_reads(r1, r2):
     """
@@ -242,16 +292,6 @@ def _loc_reads(r1, r2):
         pos1, pos2 = pos2, pos1
     return r1, r2, pos1
 
-def write_to_files(buf, tmp_dir, nchunks):
-    for b in buf:
-        out = open(path.join(tmp_dir, 'rep_%03d' % (b / int(nchunks**0.5)),
-                             'tmp_%05d.tsv' % b), 'a')
-        out.write('\n'.join(buf[b]))
-        if buf[b]: # case the file was empty
-            out.write('\n')
-        out.close()
-        del(buf[b][:])
-
 def _process_lines(line1, line2, buf, multiples, lchunk):
     # case we have potential multicontacts
     if '|||' in line1 or '|||' in line2:
@@ -307,16 +347,16 @@ def _process_lines(line1, line2, buf, multiples, lchunk):
             prod_cont = contacts * (contacts + 1) / 2
             for i, (r1, r2) in enumerate(combinations(elts.values(), 2)):
                 r1, r2, idx = _loc_reads(r1, r2)
-                buf[idx / lchunk].append('%d\t%s#%d/%d\t%s\t%s' % (
+                buf[idx / lchunk].append('%d\t%s#%d/%d\t%s\t%s\n' % (
                     idx, r1[0], i + 1, prod_cont, '\t'.join(r1[1:]),
                     '\t'.join(r2[1:])))
         elif contacts == 1:
             r1, r2, idx = _loc_reads(elts.values()[0], elts.values()[1])
-            buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            buf[idx / lchunk].append('%d\t%s\t%s\n' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
         else:
             r1, r2, idx = _loc_reads(elts1.values()[0], elts2.values()[0])
-            buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+            buf[idx / lchunk].append('%d\t%s\t%s\n' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
     else:
         r1, r2, idx = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
-        buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+        buf[idx / lchunk].append('%d\t%s\t%s\n' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
 
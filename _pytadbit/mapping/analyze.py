@@ -5,10 +5,12 @@
 from pytadbit                     import HiC_data
 from pytadbit.utils.extraviews    import tadbit_savefig, setup_plot
 from pytadbit.utils.tadmaths      import nozero_log_matrix as nozero_log
-from pytadbit.utils.tadmaths      import right_double_mad as mad
 from warnings                     import warn
 from collections                  import OrderedDict
 from pytadbit.parsers.hic_parser  import load_hic_data_from_reads
+from pytadbit.parsers.pairs_store import load_pairs_store, is_pairs_store
+from pytadbit.mapping.read_stats  import ReadStats
+from pytadbit.utils.hic_tiles     import HiCTiles, zoom_level
 from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.file_handling import mkdir
 from scipy.stats                  import norm as sc_norm, skew, kurtosis
@@ -28,7 +30,8 @@ except ImportError:
 def hic_map(data, resolution=None, normalized=False, masked=None,
             by_chrom=False, savefig=None, show=False, savedata=None,
             focus=None, clim=None,  perc_clim=None, cmap='jet', pdf=False, decay=True,
-            perc=20, name=None, decay_resolution=None, **kwargs):
+            perc=20, name=None, decay_resolution=None, max_pixels=1000,
+            **kwargs):
     """
     function to retrieve data from HiC-data object. Data can be stored as
     a square matrix, or drawn using matplotlib
@@ -61,8 +64,12 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
        chromosomes
     :param True decay: plot the correlation between genomic distance and
        interactions (usually a decay).
-    :param False force_image: force to generate an image even if resolution is
-       crazy...
+    :param 1000 max_pixels: maximum number of rows (or columns) of the matrix
+       drawn. Larger matrices are drawn at a lower resolution, summing
+       interactions in blocks of bins (computed by tiles from the sparse
+       data, without building the dense matrix)
+    :param False force_image: force to generate an image at the full
+       resolution of the data, even if resolution is crazy...
     :param None clim: cutoff for the upper and lower bound in the coloring scale
        of the heatmap. (perc_clim should be set to None)
     :param None perc_clim: cutoff for the upper and lower bound in the coloring scale
@@ -89,6 +96,9 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
         decay_resolution = resolution
     if hic_data.bads and not masked:
         masked = hic_data.bads
+    force_image = kwargs.get('force_image', False)
+    # tiles are shared by all the chromosomes drawn
+    tiles = None
     # save and draw the data
     if by_chrom:
         if focus:
@@ -104,7 +114,16 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
                 if by_chrom == 'inter' and crm1 == crm2:
                     continue
                 try:
-                    subdata = hic_data.get_matrix(focus=(crm1, crm2), normalized=normalized)
+                    coords = hic_data._focus_coords((crm1, crm2))
+                    if (show or savefig) and not force_image and max(
+                        coords[2] - coords[0], coords[3] - coords[1]) > max_pixels:
+                        tiles = tiles or HiCTiles(hic_data, normalized=normalized,
+                                                  masked=masked)
+                        subdata, fact = _tiled_matrix(tiles, coords, max_pixels)
+                    else:
+                        subdata = hic_data.get_matrix(focus=(crm1, crm2),
+                                                      normalized=normalized)
+                        fact = 1
                     start1, _ = hic_data.section_pos[crm1]
                     start2, _ = hic_data.section_pos[crm2]
                     masked1 = {}
@@ -115,7 +134,7 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
                                         for m in hic_data.bads])
                         masked2 = dict([(m - start2, hic_data.bads[m])
                                         for m in hic_data.bads])
-                    if masked1 or masked2:
+                    if (masked1 or masked2) and fact == 1:
                         for i in xrange(len(subdata)):
                             if i in masked1:
                                 subdata[i] = [float('nan')
@@ -129,21 +148,17 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
                                               focus=(crm1, crm2),
                                               normalized=normalized)
                     if show or savefig:
-                        if (len(subdata) > 10000
-                            and not kwargs.get('force_image', False)):
-                            warn('WARNING: Matrix image not created, more than '
-                                 '10000 rows, use a lower resolution to create images')
-                            continue
                         draw_map(subdata,
                                  OrderedDict([(k, hic_data.chromosomes[k])
                                               for k in hic_data.chromosomes.keys()
                                               if k in [crm1, crm2]]),
-                                 hic_data.section_pos,
+                                 _scale_sections(hic_data.section_pos, fact),
                                  '%s/%s.%s' % (savefig,
                                                '_'.join(set((crm1, crm2))),
                                                'pdf' if pdf else 'png'),
                                  show, one=True, clim=clim, perc_clim=perc_clim,
-                                 cmap=cmap, decay_resolution=decay_resolution,
+                                 cmap=cmap,
+                                 decay_resolution=decay_resolution * fact,
                                  perc=perc, name=name, cistrans=float('NaN'))
                 except ValueError, e:
                     print 'Value ERROR: problem with chromosome %s' % crm1
@@ -156,12 +171,19 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
             hic_data.write_matrix(savedata, focus=focus,
                                   normalized=normalized)
         if show or savefig:
-            subdata = hic_data.get_matrix(focus=focus, normalized=normalized)
-            if (len(subdata) > 10000 and not kwargs.get('force_image', False)):
-                warn('WARNING: Matrix image not created, more than '
-                     '10000 rows, use a lower resolution to create images')
-                return
-            start1 = hic_data._focus_coords(focus)[0]
+            coords = hic_data._focus_coords(focus)
+            max_diff = kwargs.get('max_diff', None)
+            if not force_image and max(coords[2] - coords[0],
+                                       coords[3] - coords[1]) > max_pixels:
+                tiles = HiCTiles(hic_data, normalized=normalized, masked=masked)
+                subdata, fact = _tiled_matrix(tiles, coords, max_pixels)
+                if max_diff:
+                    max_diff = -(-max_diff // fact)
+                masked = None
+            else:
+                subdata = hic_data.get_matrix(focus=focus, normalized=normalized)
+                fact = 1
+            start1 = coords[0]
             if focus and masked:
                 # rescale masked
                 masked = dict([(m - start1, masked[m]) for m in masked])
@@ -174,13 +196,13 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
                         if j in masked:
                             subdata[i][j] = float('nan')
             draw_map(subdata,
-                     {} if focus else hic_data.chromosomes,
-                     hic_data.section_pos, savefig, show,
+                     {} if focus else _scale_chromosomes(hic_data, fact),
+                     _scale_sections(hic_data.section_pos, fact), savefig, show,
                      one = True if focus else False, decay=decay,
                      clim=clim, perc_clim=perc_clim, cmap=cmap,
-                     decay_resolution=decay_resolution,
+                     decay_resolution=decay_resolution * fact,
                      perc=perc, normalized=normalized,
-                     max_diff=kwargs.get('max_diff', None),
+                     max_diff=max_diff,
                      name=name, cistrans=float('NaN') if focus else
                      hic_data.cis_trans_ratio(normalized,
                                               kwargs.get('exclude', None),
@@ -188,6 +210,46 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
                                               kwargs.get('equals', None)))
 
 
+def _tiled_matrix(tiles, coords, max_pixels):
+    """
+    :param tiles: HiCTiles object
+    :param coords: start and end bins of the region, as returned by
+       HiC_data._focus_coords
+    :param max_pixels: maximum number of rows (or columns) of the matrix
+
+    :returns: the matrix of the region (list of lists, oriented as returned by
+       HiC_data.get_matrix) with interactions summed in blocks of bins, and
+       the number of bins per block
+    """
+    start1, start2, end1, end2 = coords
+    level = zoom_level(max(end1 - start1, end2 - start2), max_pixels)
+    matrix = tiles.region(start2, end2, start1, end1, level).T
+    return matrix.tolist(), 2 ** level
+
+
+def _scale_sections(section_pos, fact):
+    """
+    :returns: the start and end position of each chromosome in a matrix with
+       blocks of fact bins
+    """
+    if fact == 1:
+        return section_pos
+    return dict((crm, (float(beg) / fact, float(end) / fact))
+                for crm, (beg, end) in section_pos.iteritems())
+
+
+def _scale_chromosomes(hic_data, fact):
+    """
+    :returns: the number of blocks of fact bins of each chromosome, blocks
+       overlapping two chromosomes being counted in the first one
+    """
+    if fact == 1:
+        return hic_data.chromosomes
+    return OrderedDict((crm, -(-hic_data.section_pos[crm][1] // fact) -
+                        -(-hic_data.section_pos[crm][0] // fact))
+                       for crm in hic_data.chromosomes)
+
+
 def draw_map(data, genome_seq, cumcs, savefig, show, one=False, clim=None,
              perc_clim=None, cmap='jet', decay=False, perc=20, name=None,
              cistrans=None, decay_resolution=10000, normalized=False,
@@ -589,13 +651,18 @@ def plot_distance_vs_interactions(data, min_diff=1, max_diff=1000, show=False,
         plt.close('all')
     return (a1, b1, r21), (a2, b2, r22), (a3, b3, r23)
 
-def plot_iterative_mapping(fnam1, fnam2, total_reads=None, axe=None, savefig=None):
+def plot_iterative_mapping(fnam1, fnam2=None, total_reads=None, axe=None,
+                           savefig=None):
     """
     Plots the number of reads mapped at each step of the mapping process (in the
     case of the iterative mapping, each step is mapping process with a given
     size of fragments).
 
-    :param fnam: input file name
+    :param fnam1: input file name of the first read-ends (or statistics
+       computed by :func:`pytadbit.mapping.read_stats.read_stats`, in which
+       case the mapped lengths are those of the read pairs mapped on both
+       ends)
+    :param None fnam2: input file name of the second read-ends
     :param total_reads: total number of reads in the initial FASTQ file
     :param None axe: a matplotlib.axes.Axes object to define the plot
        appearance
@@ -612,27 +679,12 @@ def plot_iterative_mapping(fnam1, fnam2, total_reads=None, axe=None, savefig=Non
     colors = ['olive', 'darkcyan']
     iteration = False
     for i, fnam in enumerate([fnam1, fnam2]):
-        fhandler = open(fnam)
-        line = fhandler.next()
-        count_by_len[i] = {}
-        while line.startswith('#'):
-            if line.startswith('# MAPPED '):
-                itr, num = line.split()[2:]
-                count_by_len[i][int(itr)] = int(num)
-            line = fhandler.next()
-        if not count_by_len[i]:
+        if isinstance(fnam1, ReadStats):
+            count_by_len[i] = _nonzero(fnam1.lengths[i])
             iteration = True
-            try:
-                while True:
-                    _, length, _, _ = line.rsplit('\t', 3)
-                    try:
-                        count_by_len[i][int(length)] += 1
-                    except KeyError:
-                        count_by_len[i][int(length)] = 1
-                    line = fhandler.next()
-            except StopIteration:
-                pass
-        fhandler.close()
+        else:
+            count_by_len[i] = _mapped_lengths(fnam)
+            iteration |= count_by_len[i].pop('iteration')
         lengths = sorted(count_by_len[i].keys())
         for k in lengths[::-1]:
             count_by_len[i][k] += sum([count_by_len[i][j]
@@ -657,12 +709,51 @@ def plot_iterative_mapping(fnam1, fnam2, total_reads=None, axe=None, savefig=Non
     return count_by_len
 
 
+def _mapped_lengths(fnam):
+    """
+    :returns: a dictionary with the number of reads mapped at each iteration
+       (or with each length), 'iteration' being True if counted by length
+    """
+    count_by_len = {'iteration': False}
+    fhandler = open(fnam)
+    line = fhandler.next()
+    while line.startswith('#'):
+        if line.startswith('# MAPPED '):
+            itr, num = line.split()[2:]
+            count_by_len[int(itr)] = int(num)
+        line = fhandler.next()
+    if len(count_by_len) == 1:
+        count_by_len['iteration'] = True
+        try:
+            while True:
+                _, length, _, _ = line.rsplit('\t', 3)
+                try:
+                    count_by_len[int(length)] += 1
+                except KeyError:
+                    count_by_len[int(length)] = 1
+                line = fhandler.next()
+        except StopIteration:
+            pass
+    fhandler.close()
+    return count_by_len
+
+
+def _nonzero(counts):
+    """
+    :returns: a dictionary with the non-null values of an array of counts
+    """
+    return dict((i, counts[i]) for i in np.flatnonzero(counts).tolist())
+
+
 def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
                  show=False, xlog=False, stats=('median', 'perc_max'),
                  too_large=10000):
     """
     Plots the distribution of dangling-ends lengths
-    :param fnam: input file name
+    :param fnam: input file name (or path to a pairs store, see
+       :func:`pytadbit.parsers.pairs_store.write_pairs_store`, or statistics
+       computed by :func:`pytadbit.mapping.read_stats.read_stats`, in which
+       case nreads is ignored)
     :param None savefig: path where to store the output images.
     :param 99.9 max_size: top percentage of distances to consider, within the
        top 0.01% are usually found very long outliers.
@@ -680,44 +771,46 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
 
     :returns: the median value and the percentile inputed as max_size.
     """
-    distr = {}
-    genome_seq = OrderedDict()
-    pos = 0
-    fhandler = open(fnam)
-    for line in fhandler:
-        if line.startswith('#'):
-            if line.startswith('# CRM '):
-                crm, clen = line[6:].split('\t')
-                genome_seq[crm] = int(clen)
-        else:
-            break
-        pos += len(line)
-    fhandler.seek(pos)
-    des = []
     if nreads:
         nreads /= 2
-    for line in fhandler:
-        (crm1, pos1, dir1, _, re1, _,
-         crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
-        if re1==re2 and crm1 == crm2 and dir1 != dir2:
-            pos1, pos2 = int(pos1), int(pos2)
-            if (pos2 > pos1) == int(dir1):
-                des.append(abs(pos2 - pos1))
-            if len(des) == nreads:
+    if isinstance(fnam, ReadStats):
+        des = fnam.dangling_ends
+    elif is_pairs_store(fnam):
+        des = _dangling_end_sizes(fnam, nreads)
+    else:
+        pos = 0
+        fhandler = open(fnam)
+        for line in fhandler:
+            if not line.startswith('#'):
                 break
-    des = [i for i in des if i <= too_large]
-    fhandler.close()
-    max_perc = np.percentile(des, max_size)
-    perc99   = np.percentile(des, 99)
-    perc01   = np.percentile(des, 1)
-    perc50   = np.percentile(des, 50)
-    perc95   = np.percentile(des, 95)
-    perc05   = np.percentile(des, 5)
+            pos += len(line)
+        fhandler.seek(pos)
+        des = []
+        for line in fhandler:
+            (crm1, pos1, dir1, _, re1, _,
+             crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
+            if re1==re2 and crm1 == crm2 and dir1 != dir2:
+                pos1, pos2 = int(pos1), int(pos2)
+                if (pos2 > pos1) == int(dir1):
+                    des.append(abs(pos2 - pos1))
+                if len(des) == nreads:
+                    break
+        fhandler.close()
+    if not isinstance(des, np.ndarray):
+        des = np.bincount(np.array(des, dtype=np.int64))
+    # number of dangling-ends of each size
+    des = des[:too_large + 1]
+    max_perc = _percentile(des, max_size)
+    perc99   = _percentile(des, 99)
+    perc01   = _percentile(des, 1)
+    perc50   = _percentile(des, 50)
+    perc95   = _percentile(des, 95)
+    perc05   = _percentile(des, 5)
     to_return = {'median': perc50}
-    cutoff = len(des) / 100000.
+    cutoff = des.sum() / 100000.
     count  = 0
-    for v in xrange(int(perc50), int(max(des))):
-        if des.count(v) < cutoff:
+    for v in xrange(int(perc50), int(np.flatnonzero(des)[-1])):
+        if des[v] < cutoff:
             count += 1
         else:
             count = 0
@@ -727,7 +820,9 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
     else:
         raise Exception('ERROR: not found')
     to_return['perc_max'] = max_perc
-    to_return['MAD'] = mad(des)
+    sizes = np.arange(len(des))
+    sel = sizes > perc50
+    to_return['MAD'] = _percentile(des[sel], 50, sizes[sel] - perc50)
     if not savefig and not axe and not show:
         return [to_return[k] for k in stats]
 
@@ -737,7 +832,7 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
     ax.axvspan(perc01, perc05, facecolor='darkolivegreen', alpha=.3)
     desapan = ax.axvspan(perc05, perc95, facecolor='darkseagreen', alpha=.3,
                          label='5-95%% DEs\n(%.0f-%.0f nts)' % (perc05, perc95))
-    deshist = ax.hist(des, bins=100, range=(0, max_perc),
+    deshist = ax.hist(sizes, weights=des, bins=100, range=(0, max_perc),
                       alpha=.7, color='darkred', label='Dangling-ends')
     ylims   = ax.get_ylim()
     plots   = []
@@ -759,6 +854,50 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
     return [to_return[k] for k in stats]
 
 
+def _percentile(counts, perc, values=None):
+    """
+    Same as numpy.percentile, from the number of times each value is found.
+
+    :param counts: number of times each value is found
+    :param perc: percentile
+    :param None values: sorted values (by default 0, 1, 2...)
+    """
+    cumul = np.cumsum(counts)
+    if values is None:
+        values = np.arange(len(counts))
+    if not len(cumul) or not cumul[-1]:
+        return np.nan
+    index = np.true_divide(perc, 100) * (cumul[-1] - 1)
+    below = int(np.floor(index))
+    above = min(below + 1, cumul[-1] - 1)
+    weight = index - below
+    below, above = values[np.searchsorted(cumul, [below, above], side='right')]
+    return below * (1 - weight) + above * weight
+
+
+def _dangling_end_sizes(fnam, nreads=None):
+    """
+    :returns: the list of the lengths of dangling-ends read pairs in a pairs
+       store
+    """
+    des = []
+    store = load_pairs_store(fnam)
+    for _, block in store.blocks(['crm1', 'pos1', 'beg1',
+                                  'crm2', 'pos2', 'beg2', 'strands']):
+        dir1 = (block['strands'] & 1).astype(bool)
+        dir2 = (block['strands'] & 2).astype(bool)
+        pos1 = block['pos1'].astype(np.int64)
+        pos2 = block['pos2'].astype(np.int64)
+        keep = ((block['beg1'] == block['beg2']) &
+                (block['crm1'] == block['crm2']) &
+                (dir1 != dir2) & ((pos2 > pos1) == dir1))
+        des.extend(np.abs(pos2 - pos1)[keep].tolist())
+        if nreads and len(des) >= nreads:
+            del des[nreads:]
+            break
+    return des
+
+
 def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
                               ylim=None, yscale=None, savefig=None, show=False,
                               savedata=None, chr_names=None, nreads=None):
@@ -766,7 +905,9 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
     Plot the number of reads in bins along the genome (or along a given
     chromosome).
 
-    :param fnam: input file name
+    :param fnam: input file name (or statistics computed by
+       :func:`pytadbit.mapping.read_stats.read_stats`, with a resolution
+       dividing this one)
     :param True first_read: uses first read.
     :param 100 resolution: group reads that are closer than this resolution
        parameter
@@ -781,48 +922,13 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
        them the need to be plotted (this option may last even more than default)
 
     """
-    distr = {}
-    idx1, idx2 = (1, 3) if first_read else (7, 9)
-    genome_seq = OrderedDict()
-    if chr_names:
-        chr_names = set(chr_names)
-        cond1 = lambda x: x not in chr_names
-    else:
-        cond1 = lambda x: False
-    if nreads:
-        cond2 = lambda x: x >= nreads
+    if isinstance(fnam, ReadStats):
+        distr, genome_seq = _stats_genomic_distribution(fnam, first_read,
+                                                        resolution)
     else:
-        cond2 = lambda x: False
-    cond = lambda x, y: cond1(x) and cond2(y)
-    count = 0
-    pos = 0
-    fhandler = open(fnam)
-    for line in fhandler:
-        if line.startswith('#'):
-            if line.startswith('# CRM '):
-                crm, clen = line[6:].split('\t')
-                genome_seq[crm] = int(clen)
-        else:
-            break
-        pos += len(line)
-    fhandler.seek(pos)
-    for line in fhandler:
-        crm, pos = line.strip().split('\t')[idx1:idx2]
-        count += 1
-        if cond(crm, count):
-            line = fhandler.next()
-            if cond2(count):
-                break
-            continue
-        pos = int(pos) / resolution
-        try:
-            distr[crm][pos] += 1
-        except KeyError:
-            try:
-                distr[crm][pos] = 1
-            except KeyError:
-                distr[crm] = {pos: 1}
-    fhandler.close()
+        distr, genome_seq = _genomic_distribution(fnam, first_read,
+                                                  resolution, chr_names,
+                                                  nreads)
     if savefig or show:
         _ = plt.figure(figsize=(15, 1 + 3 * len(
             chr_names if chr_names else distr.keys())))
@@ -870,6 +976,72 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
         out.write('\n')
         out.close()
 
+def _genomic_distribution(fnam, first_read, resolution, chr_names, nreads):
+    """
+    :returns: a dictionary with the number of reads in each bin of each
+       chromosome, and a dictionary with the length of each chromosome
+    """
+    distr = {}
+    idx1, idx2 = (1, 3) if first_read else (7, 9)
+    genome_seq = OrderedDict()
+    if chr_names:
+        chr_names = set(chr_names)
+        cond1 = lambda x: x not in chr_names
+    else:
+        cond1 = lambda x: False
+    if nreads:
+        cond2 = lambda x: x >= nreads
+    else:
+        cond2 = lambda x: False
+    cond = lambda x, y: cond1(x) and cond2(y)
+    count = 0
+    pos = 0
+    fhandler = open(fnam)
+    for line in fhandler:
+        if line.startswith('#'):
+            if line.startswith('# CRM '):
+                crm, clen = line[6:].split('\t')
+                genome_seq[crm] = int(clen)
+        else:
+            break
+        pos += len(line)
+    fhandler.seek(pos)
+    for line in fhandler:
+        crm, pos = line.strip().split('\t')[idx1:idx2]
+        count += 1
+        if cond(crm, count):
+            line = fhandler.next()
+            if cond2(count):
+                break
+            continue
+        pos = int(pos) / resolution
+        try:
+            distr[crm][pos] += 1
+        except KeyError:
+            try:
+                distr[crm][pos] = 1
+            except KeyError:
+                distr[crm] = {pos: 1}
+    fhandler.close()
+    return distr, genome_seq
+
+
+def _stats_genomic_distribution(stats, first_read, resolution):
+    """
+    :returns: same as _genomic_distribution, from the statistics of a file of
+       reads
+    """
+    if resolution % stats.params['resolution']:
+        raise Exception('ERROR: resolution should be a multiple of %d' % (
+            stats.params['resolution']))
+    factor = resolution / stats.params['resolution']
+    distr = {}
+    for crm, counts in stats.genomic[0 if first_read else 1].iteritems():
+        bins = np.arange(len(counts)) / factor
+        distr[crm] = _nonzero(np.bincount(bins, weights=counts).astype(int))
+    return distr, stats.chromosomes
+
+
 def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
                        savefig=None, show=False, savedata=None,
                        normalized=False, remove_bad_columns=True, **kwargs):
@@ -1072,8 +1244,11 @@ def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False,
     else:
         return corr
 
-def plot_rsite_reads_distribution(reads_file, outprefix, window=20,
-        maxdist=1000):
+def _rsite_distances(reads_file, window, maxdist):
+    """
+    :returns: the number of facing read pairs at each distance from the
+       closest RE site, for the first and the second read-ends
+    """
     de_right={}
     de_left={}
     print "process reads"
@@ -1136,6 +1311,30 @@ def plot_rsite_reads_distribution(reads_file, outprefix, window=20,
     except StopIteration:
         pass
     print "   finished processing {} reads".format(nreads)
+    return de_right, de_left
+
+
+
+def plot_rsite_reads_distribution(reads_file, outprefix, window=20,
+        maxdist=1000):
+    """
+    Plots the distribution of the distances of facing read-ends to their
+    closest RE site.
+
+    :param reads_file: input file name (or statistics computed by
+       :func:`pytadbit.mapping.read_stats.read_stats`, with the same window and
+       maxdist)
+    :param outprefix: prefix of the output files (counts and plot)
+    :param 20 window: maximum distance to RE sites
+    :param 1000 maxdist: maximum distance between read-ends
+    """
+    if isinstance(reads_file, ReadStats):
+        reads_file.check_params(window=window, rsite_maxdist=maxdist)
+        de_right, de_left = [dict((i - window, v) for i, v in
+                                  _nonzero(counts).iteritems())
+                             for counts in reads_file.rsite]
+    else:
+        de_right, de_left = _rsite_distances(reads_file, window, maxdist)
 
     #transform to arrays
     ind = range(-window,window+1)
@@ -1171,8 +1370,11 @@ def moving_average(a, n=3):
     return ret[n - 1:] / n
 
 
-def plot_diagonal_distributions(reads_file, outprefix, ma_window=20,
-        maxdist=800, de_left=[-2,3], de_right=[0,5]):
+def _diagonal_distances(reads_file, maxdist, de_left, de_right):
+    """
+    :returns: the number of random breaks, rejoined read pairs and
+       dangling-ends at each distance between facing read-ends
+    """
     rbreaks={}
     rejoined={}
     des={}
@@ -1250,6 +1452,35 @@ def plot_diagonal_distributions(reads_file, outprefix, ma_window=20,
     except StopIteration:
         pass
     print "   finished processing {} reads".format(nreads)
+    return rbreaks, rejoined, des
+
+
+
+def plot_diagonal_distributions(reads_file, outprefix, ma_window=20,
+        maxdist=800, de_left=[-2,3], de_right=[0,5]):
+    """
+    Plots the distribution of the distances between facing read-ends close to
+    the diagonal, for random breaks, dangling-ends and rejoined read pairs.
+
+    :param reads_file: input file name (or statistics computed by
+       :func:`pytadbit.mapping.read_stats.read_stats`, with the same maxdist,
+       de_left and de_right)
+    :param outprefix: prefix of the output files (counts and plot)
+    :param 20 ma_window: size of the window of the moving average
+    :param 800 maxdist: maximum distance between read-ends
+    :param [-2,3] de_left: distances of the second read-end to its closest RE
+       site defining dangling-ends
+    :param [0,5] de_right: distances of the first read-end to its closest RE
+       site defining dangling-ends
+    """
+    if isinstance(reads_file, ReadStats):
+        reads_file.check_params(diag_maxdist=maxdist, de_left=de_left,
+                                de_right=de_right)
+        rbreaks, des, rejoined = [_nonzero(counts)
+                                  for counts in reads_file.diagonal]
+    else:
+        rbreaks, rejoined, des = _diagonal_distances(reads_file, maxdist,
+                                                     de_left, de_right)
 
     #transform to arrays
     maxlen = max(max(rejoined),max(des),max(rbreaks))
@@ -1296,34 +1527,11 @@ def plot_diagonal_distributions(reads_file, outprefix, ma_window=20,
 
 
 
-def plot_strand_bias_by_distance(fnam, nreads=None, half_step=20, half_len=2000,
-                                 full_step=500, full_len=50000, savefig=None):
+def _strands_by_distance(fnam, nreads, max_len):
     """
-    Classify reads into for categories depending on the strand on which each end
-    is mapped, and plots the proportion of each of these categories in function
-    of the genomic distance between them.
-    The four categories are:
-
-       - Both read-ends mapped in the forward strand
-       - Both read-ends mapped in the reverse strand
-       - First read-end in the forward strand1, second in the reverse
-       - First read-end in the reverse strand1, second in the forward
-
-    Note: First/second read-ends are according to their genomic coordinates.
-
-    The plot is divided in two halves, in order to use different zooms for
-    read-ends mapped very close, and read-ends further (by default the first
-    half goes from a distance of 0 to 2 kb, and the second from 2 kb to 50 kb).
-
-    :param fnam: input file name with the intersection of the two read-ends mapped
-    :param None nreads: number of reads to process (default: all reads)
-    :param 2000 half_len: limit in the X axis of the first plot
-    :param 20 half_step: to bin distances between read-ends in the first plot
-    :param 2000 full_len: limit in the X axis of the second plot
-    :param 20 full_step: to bin distances between read-ends in the second plot
-    :param None savefig: path where to store the output images.
+    :returns: the number of read pairs in each strand category at each
+       distance between read-ends
     """
-
     fhandler = open(fnam)
     pos = 0
     for line in fhandler:
@@ -1332,7 +1540,6 @@ def plot_strand_bias_by_distance(fnam, nreads=None, half_step=20, half_len=2000,
         pos += len(line)
     fhandler.seek(pos)
 
-    max_len = 100000
     dirs = [[0 for i in range(max_len)],
             [0 for i in range(max_len)],
             [0 for i in range(max_len)],
@@ -1351,6 +1558,45 @@ def plot_strand_bias_by_distance(fnam, nreads=None, half_step=20, half_len=2000,
         if re1!=re2 and crm1 == crm2 and diff < max_len:
             dir1, dir2 = int(dir1) * 2, int(dir2)
             dirs[dir1 + dir2][diff] += 1
+    fhandler.close()
+    return dirs
+
+
+def plot_strand_bias_by_distance(fnam, nreads=None, half_step=20, half_len=2000,
+                                 full_step=500, full_len=50000, savefig=None):
+    """
+    Classify reads into for categories depending on the strand on which each end
+    is mapped, and plots the proportion of each of these categories in function
+    of the genomic distance between them.
+    The four categories are:
+
+       - Both read-ends mapped in the forward strand
+       - Both read-ends mapped in the reverse strand
+       - First read-end in the forward strand1, second in the reverse
+       - First read-end in the reverse strand1, second in the forward
+
+    Note: First/second read-ends are according to their genomic coordinates.
+
+    The plot is divided in two halves, in order to use different zooms for
+    read-ends mapped very close, and read-ends further (by default the first
+    half goes from a distance of 0 to 2 kb, and the second from 2 kb to 50 kb).
+
+    :param fnam: input file name with the intersection of the two read-ends
+       mapped (or statistics computed by
+       :func:`pytadbit.mapping.read_stats.read_stats`)
+    :param None nreads: number of reads to process (default: all reads)
+    :param 2000 half_len: limit in the X axis of the first plot
+    :param 20 half_step: to bin distances between read-ends in the first plot
+    :param 2000 full_len: limit in the X axis of the second plot
+    :param 20 full_step: to bin distances between read-ends in the second plot
+    :param None savefig: path where to store the output images.
+    """
+    if isinstance(fnam, ReadStats):
+        max_len = fnam.params['max_len']
+        dirs = fnam.strands.tolist()
+    else:
+        max_len = 100000
+        dirs = _strands_by_distance(fnam, nreads, max_len)
 
     sum_dirs = [0 for i in range(max_len)]
     for i in range(max_len):
@@ -3,11 +3,38 @@
 
 
 """
-from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from array      import array
+from shutil     import copyfileobj
+from math       import ceil
+from itertools  import compress
+from numpy      import frombuffer, fromfile, int64, uint64, zeros
+from numpy      import uint16, load
+from numpy.lib.format import open_memmap
+from numpy      import concatenate, lexsort, argsort
+from numpy      import maximum, arange, log2, where, memmap, unique
+from numpy      import partition, in1d
+from collections import OrderedDict
+from pytadbit.utils.fastq_utils import cardinality_from_zeroes
+from pytadbit.parsers.pairs_store import PairsWriter
+from pytadbit.utils.line_blocks import split_file
+from pytadbit.mapping.restriction_enzymes import merge_re_fragment_counts
+from pytadbit.mapping.restriction_enzymes import save_re_fragment_counts
 import multiprocessing as mu
+import os
+
+_FILTERS = {1 : 'self-circle',
+            2 : 'dangling-end',
+            3 : 'error',
+            4 : 'extra dangling-end',
+            5 : 'too close from RES',
+            6 : 'too short',
+            7 : 'too large',
+            8 : 'over-represented',
+            9 : 'duplicated',
+            10: 'random breaks'}
 
 def apply_filter(fnam, outfile, masked, filters=None, reverse=False, 
-                 verbose=True):
+                 verbose=True, pairs_store=None):
     """
     Create a new file with reads filtered
 
@@ -20,32 +47,111 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     :param False reverse: if set, the resulting outfile will only contain the
        reads filtered, not the valid pairs.
     :param False verbose:
+    :param None pairs_store: path to a pairs store (see
+       :mod:`pytadbit.parsers.pairs_store`) where to also write the reads kept,
+       with the filters applying to each of them. Needs the column of flags
+       written by filter_reads
 
     :returns: number of reads kept
     """
     filters = filters or masked.keys()
     filter_names = []
-    filter_handlers = {}
-    for k in filters:
-        try:
-            fh = open(masked[k]['fnam'])
-            val = fh.next().strip()
-            filter_handlers[k] = [val, fh]
-        except StopIteration:
-            pass
-
     out = open(outfile, 'w')
     fhandler = open(fnam)
     # get the header
     pos = 0
+    chromosomes = OrderedDict()
     while True:
         line = next(fhandler)
         if not line.startswith('#'):
             break
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split('\t')
+            chromosomes[crm] = int(clen)
         pos += len(line)
         out.write(line)
     fhandler.seek(pos)
 
+    flags = flags_column(fnam, masked, filters)
+    if flags:
+        writer = PairsWriter(pairs_store, chromosomes) if pairs_store else None
+        count = _apply_flags(fhandler, out, flags, filters, reverse, writer)
+        if writer:
+            writer.close()
+    elif pairs_store:
+        raise Exception('ERROR: writing a pairs store needs the column of '
+                        'filter flags')
+    else:
+        count = _apply_read_ids(fhandler, out, masked, filters, reverse)
+    if verbose:
+        print '    saving to file %d reads %s %s.' % (
+            count, 'with' if reverse else 'without', ', '.join(filter_names))
+    out.close()
+    return count
+
+def flags_column(fnam, masked, filters=None):
+    """
+    :param fnam: path to the file of read pairs to be filtered
+    :param masked: dictionary given by :func:`filter_reads`
+    :param None filters: list of filters applied (all by default)
+
+    :returns: the path to the column of filter flags written by
+       :func:`filter_reads` (with one flag per line of fnam), or None if the
+       filters have no column of flags
+    """
+    filters = filters or masked.keys()
+    flags = set(masked[k].get('flags') for k in filters)
+    if len(flags) != 1 or None in flags:
+        return None
+    sources = set(masked[k].get('source') for k in filters)
+    if sources != set([_source(fnam)]):
+        raise Exception('ERROR: filter flags computed on another file than '
+                        '%s' % fnam)
+    return flags.pop()
+
+def _source(fnam):
+    return os.path.abspath(fnam), os.path.getsize(fnam)
+
+def _apply_flags(fhandler, out, flags, filters, reverse, writer=None):
+    """
+    Writes the lines of read pairs according to the column of flags written
+    by filter_reads (one per line), and to the pairs store of writer with
+    their flags.
+    """
+    flags = load(flags, mmap_mode='r')
+    mask = sum(1 << (k - 1) for k in filters)
+    count = 0
+    nlines = 0
+    for lines in iter(lambda: fhandler.readlines(8388608), []):
+        line_flags = flags[nlines:nlines + len(lines)]
+        keep = (line_flags & mask) != 0
+        if len(keep) < len(lines):
+            raise Exception('ERROR: more read pairs than filter flags')
+        if not reverse:
+            keep = ~keep
+        out.writelines(compress(lines, keep))
+        if writer:
+            writer.write_lines(list(compress(lines, keep)), line_flags[keep])
+        count += keep.sum()
+        nlines += len(lines)
+    if nlines != len(flags):
+        raise Exception('ERROR: less read pairs than filter flags')
+    return int(count)
+
+def _apply_read_ids(fhandler, out, masked, filters, reverse):
+    """
+    Writes the lines of read pairs according to the files of read IDs of each
+    filter (that follow the order of the read pairs).
+    """
+    filter_handlers = {}
+    for k in filters:
+        try:
+            fh = open(masked[k]['fnam'])
+            val = fh.next().strip()
+            filter_handlers[k] = [val, fh]
+        except StopIteration:
+            pass
+
     current = set([v for v, _ in filter_handlers.values()])
     count = 0
     if reverse:
@@ -81,16 +187,13 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
                 except StopIteration:
                     del filter_handlers[k]
             current = set([v for v, _ in filter_handlers.values()])
-    if verbose:
-        print '    saving to file %d reads %s %s.' % (
-            count, 'with' if reverse else 'without', ', '.join(filter_names))
-    out.close()
     return count
 
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
-                 savedata=None, min_dist_to_re=750, fast=True):
+                 savedata=None, min_dist_to_re=750, fast=True, ncpus=None,
+                 max_size=10000000):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -116,8 +219,9 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        8- over-represented   : reads coming from the top 0.5% most frequently
           detected restriction fragments, they may be prone to PCR artifacts or
           represent fragile regions of the genome or genome assembly errors
-       9- duplicated         : the combination of the start positions of the
-          reads is repeated -> PCR artifact (only keep one copy)
+       9- duplicated         : the combination of the start positions (and
+          strands) of the reads is repeated -> PCR artifact (only keep one
+          copy, the first one in the file)
        10- random breaks     : start position of one of the read is too far (
           more than min_dist_to_re) from RE cutting site. Non-canonical
           enzyme activity or random physical breakage of the chromatin.
@@ -140,7 +244,32 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: parallel version, the file is split in chunks of reads
+       filtered by different processes
+    :param None ncpus: number of processes used by the parallel version (all
+       available CPUs by default)
+    :param 10000000 max_size: maximum number of read pairs checked at once for
+       duplicates (about 100 bytes of memory each, in each process). Read pairs
+       are split on disk into partitions of this size, by positions, and
+       duplicates are searched in each partition (no need for the file to be
+       sorted, duplicated read pairs need not be consecutive)
+
+    Besides the partitions checked for duplicates, each process keeps in
+    memory a block of one million lines of its chunk (about 50 bytes per
+    line) and the number of read-ends per RE fragment seen, the rest being
+    stored in temporary files next to output.
+
+    The number of read ends per RE fragment, used by filter 8, is saved to
+    output + '_fragment_counts.npz' (see
+    :func:`pytadbit.mapping.restriction_enzymes.load_re_fragment_counts`).
+
+    The filters of each read pair are also saved to output + '_flags.npy', an
+    array of 16 bits integers with one value per line of the input file, the
+    bit k - 1 being set if the read pair is removed by filter k (same bits as
+    the flags of :func:`pytadbit.parsers.hic_bam_parser.bed2D_to_BAMhic`).
+    This file is used by :func:`apply_filter`, only on the file of read pairs
+    it was computed from (checked from the path and size of the file, stored
+    in the returned dictionary as 'source').
 
     :return: dicitonary with, as keys, the kind of filter applied, and as values
        a set of read IDs to be removed
@@ -151,37 +280,110 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     if not output:
         output = fnam
 
-    if not fast: # mainly for debugging
-        if verbose:
-            print 'filtering duplicates'
-        masked, total = _filter_duplicates(fnam,output)
-        if verbose:
-            print 'filtering same fragments'
-        masked.update(_filter_same_frag(fnam, max_molecule_length, output))
-        if verbose:
-            print 'filtering fro RE'
-        masked.update(_filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                                       re_proximity, min_frag_size, output))
+    ncpus = (ncpus or mu.cpu_count()) if fast else 1
+    flags = output + '_flags.npy'
+    masked = dict((k, {'name': name, 'reads': 0, 'flags': flags,
+                       'source': _source(fnam),
+                       'fnam': _filter_fnam(output, name)})
+                  for k, name in _FILTERS.iteritems())
+
+    # split the file into chunks of lines, all filters but the
+    # over-represented and duplicated ones are computed by each worker in a
+    # single scan, that also splits read pairs into partitions to search for
+    # duplicates
+    chunks = split_file(fnam, ncpus)
+    crm_ids, npairs = _file_stats(fnam)
+    nparts = max(1, int(ceil(float(npairs) / max_size)))
+    params = (max_molecule_length, max_frag_size, min_frag_size,
+              re_proximity, min_dist_to_re)
+    jobs = [(fnam, beg, end, i, output, crm_ids, nparts, params)
+            for i, (beg, end) in enumerate(chunks)]
+    if verbose:
+        print 'filtering reads in %d chunk%s' % (len(jobs),
+                                                's' if len(jobs) > 1 else '')
+    pool = mu.Pool(ncpus) if ncpus > 1 else None
+    mapper = pool.map if pool else map
+    try:
+        results = mapper(_filter_chunk, jobs)
+
+        # over-represented fragments, from the counts of all chunks
+        total = 0
+        zeroes = zeros(2**_LOGLOG_BITS, dtype=int64)
+        for counts, ntot, _, _, chunk_zeroes in results:
+            total += ntot
+            for k in counts:
+                masked[k]['reads'] += counts[k]
+            zeroes = maximum(zeroes, chunk_zeroes)
+        # LogLog estimates are biased with less than ~8 hashes per bucket
+        if verbose and total >= 8 * len(zeroes):
+            print '  ~%.2f%% duplicated reads (estimated)' % (
+                max(0, 100 - cardinality_from_zeroes(zeroes) / total * 100))
+        fragments, frag_count = merge_re_fragment_counts(
+            [frags for _, _, frags, _, _ in results])
+        save_re_fragment_counts(output + '_fragment_counts.npz',
+                                sorted(crm_ids, key=crm_ids.get),
+                                fragments, frag_count)
+        if len(frag_count):
+            cut = int((1 - over_represented) * len(frag_count) + 0.5)
+            # use cut-1 because it represents the length of the list
+            cut = (cut - 1) % len(frag_count)
+            cut = partition(frag_count, cut)[cut]
+        else:
+            cut = 0
         if verbose:
             print 'filtering over representeds'
-        masked.update(_filter_over_represented(fnam, over_represented, output))
-    else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam,output))
-        pool.close()
-        pool.join()
-        masked, total = d.get()
-        masked.update(b.get())
-        masked.update(c.get())
-        masked.update(a.get())
+        over = fragments[frag_count > cut]
+        jobs = [(fnam, i, output, over) for i in xrange(len(chunks))]
+        masked[8]['reads'] = sum(mapper(_over_represented_chunk, jobs))
+
+        # duplicates, searched in each partition
+        if verbose:
+            print 'filtering duplicates in %d partition%s' % (
+                nparts, 's' if nparts > 1 else '')
+        masked[9]['reads'] = sum(mapper(_duplicated_partition,
+                                        [(output, p, len(chunks))
+                                         for p in xrange(nparts)]))
+        mapper(_duplicated_chunk,
+               [(fnam, beg, end, i, output, nparts, max_size)
+                for i, (beg, end) in enumerate(chunks)])
+        for p in xrange(nparts):
+            os.remove(_chunk_fnam(output, 'duplicated offsets', p))
+        if pool:
+            pool.close()
+            pool.join()
+
+        # flags of each chunk follow the order of the input file
+        out = open_memmap(flags, mode='w+', dtype=uint16, shape=(total, ))
+        pos = 0
+        for i in xrange(len(chunks)):
+            tmp = _chunk_fnam(output, 'flags', i)
+            if os.path.getsize(tmp):
+                chunk_flags = memmap(tmp, dtype=uint16, mode='r')
+                nlines = len(chunk_flags)
+                for beg in xrange(0, nlines, max_size):
+                    end = min(beg + max_size, nlines)
+                    out[pos + beg:pos + end] = chunk_flags[beg:end]
+                pos += nlines
+                del chunk_flags
+            os.remove(tmp)
+        out.flush()
+        del out
+
+        # read IDs of each chunk follow the order of the input file
+        for k in masked:
+            out = open(masked[k]['fnam'], 'w')
+            for i in xrange(len(chunks)):
+                tmp = _chunk_fnam(output, masked[k]['name'], i)
+                fh = open(tmp)
+                copyfileobj(fh, out)
+                fh.close()
+                os.remove(tmp)
+            out.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        _remove_chunk_files(output, len(chunks), nparts)
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -205,174 +407,348 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         #         total) * 100)
     return masked
 
-def _filter_same_frag(fnam, max_molecule_length, output):
-    # t0 = time()
-    masked = {1 : {'name': 'self-circle'       , 'reads': 0}, 
-              2 : {'name': 'dangling-end'      , 'reads': 0},
-              3 : {'name': 'error'             , 'reads': 0},
-              4 : {'name': 'extra dangling-end', 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
+def _filter_fnam(output, name):
+    return output + '_' + name.replace(' ', '_') + '.tsv'
+
+def _chunk_fnam(output, name, chunk):
+    return '%s_%d~' % (_filter_fnam(output, name), chunk)
+
+def _remove_chunk_files(output, nchunks, nparts):
+    """
+    Removes the temporary files of the chunks and partitions left by
+    filter_reads (all of them if it stopped on an error).
+    """
+    names = _FILTERS.values() + ['fragments', 'offsets', 'flags']
+    names += ['keys %d' % part for part in xrange(nparts)]
+    tmps = [_chunk_fnam(output, name, chunk)
+            for name in names for chunk in xrange(nchunks)]
+    tmps += [_chunk_fnam(output, 'duplicated offsets', part)
+             for part in xrange(nparts)]
+    for tmp in tmps:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _file_stats(fnam, nlines=10000):
+    """
+    :returns: the index of each chromosome in the header of a file of read
+       pairs, and the number of read pairs in the file (estimated from the
+       length of the first lines)
+    """
     fhandler = open(fnam)
-    line = fhandler.next()
+    crm_ids = {}
+    beg = 0
+    line = fhandler.readline()
     while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            (read,
-             cr1, pos1, sd1, _, _, re1,
-             cr2, pos2, sd2, _, _, re2) = line.split('\t')
-            ps1, ps2, sd1, sd2 = map(int, (pos1, pos2, sd1, sd2))
-            if cr1 == cr2:
-                if re1 == re2.rstrip():
-                    if sd1 != sd2:
-                        if (ps2 > ps1) == sd2:
-                            # ----<===---===>---                   self-circles
-                            masked[1]["reads"] += 1
-                            outfil[1].write(read + '\n')
-                        else:
-                            # ----===>---<===---                   dangling-ends
-                            masked[2]["reads"] += 1
-                            outfil[2].write(read + '\n')
-                    else:
-                        # --===>--===>-- or --<===--<===-- or same errors
-                        masked[3]["reads"] += 1
-                        outfil[3].write(read + '\n')
-                elif (abs(ps1 - ps2) < max_molecule_length
-                      and sd2 != sd1
-                      and (ps2 > ps1) != sd2):
-                    # different fragments but facing and very close
-                    masked[4]["reads"] += 1
-                    outfil[4].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 1', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+        if line.startswith('# CRM '):
+            crm_ids[line[6:].split()[0]] = len(crm_ids)
+        beg += len(line)
+        line = fhandler.readline()
+    size = num = 0
+    while line and num < nlines:
+        size += len(line)
+        num += 1
+        line = fhandler.readline()
+    fhandler.seek(0, 2)
+    end = fhandler.tell()
+    fhandler.close()
+    return crm_ids, (end - beg) * num / size if size else 0
 
-def _filter_duplicates(fnam, output):
+def _filter_chunk((fnam, beg, end, chunk, output, crm_ids, nparts, params)):
+    """
+    Applies filters 1 to 7 and 10 to a chunk of the file, counts the reads per
+    RE fragment for filter 8, and splits the positions of the reads into
+    partitions for filter 9.
+
+    The fragments of each line, its position in the file, and its flags (bit
+    k - 1 set if the read pair is removed by filter k), are stored on disk for
+    filters 8 and 9, by blocks of _BLOCK_LINES lines.
+    """
+    (max_molecule_length, max_frag_size, min_frag_size,
+     re_proximity, min_dist_to_re) = params
+    counts = dict((k, 0) for k in _FILTERS if k not in (8, 9))
+    outfil = dict((k, open(_chunk_fnam(output, _FILTERS[k], chunk), 'w'))
+                  for k in counts)
+    dumps = dict((name, open(_chunk_fnam(output, name, chunk), 'wb'))
+                 for name in ('fragments', 'offsets', 'flags'))
+    # fragment of each read-end ((chromosome << 32) | RE site), and position
+    # of each line in the file
+    fragments = array('l')
+    offsets = array('l')
+    flags = array('H')
+    # fragments seen so far, and number of read-ends in each
+    frag_counts = merge_re_fragment_counts([])
+    # position of each line in the file, and of each read-end in the genome
+    # (chromosome, position and strand), written to partitions by blocks
+    keys = array('l')
+    zeroes = zeros(2**_LOGLOG_BITS, dtype=int64)
     total = 0
-    masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
     fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    (read,
-     cr1, pos1, sd1, _ , _, _,
-     cr2, pos2, sd2, _ , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2
-    for line in fhandler:
+    fhandler.seek(beg)
+    pos = beg
+    while pos < end:
+        line = fhandler.readline()
+        offsets.append(pos)
         (read,
-         cr1, pos1, sd1, _ , _, _,
-         cr2, pos2, sd2, _ , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
-        if prev_elts == new_elts:
-            masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
+         cr1, pos1, sd1, _, rs1, re1,
+         cr2, pos2, sd2, _, rs2, re2) = line.split('\t')
         total += 1
-        prev_elts = new_elts
-    # print 'done 4', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
+        ps1, ps2, sd1, sd2 = int(pos1), int(pos2), int(sd1), int(sd2)
+        # duplicates
+        keys.append(pos)
+        keys.append((crm_ids[cr1] << 34) | (ps1 << 1) | sd1)
+        keys.append((crm_ids[cr2] << 34) | (ps2 << 1) | sd2)
+        pos += len(line)
+        flag = 0
+        # over-represented fragments
+        fragments.append((crm_ids[cr1] << 32) | int(rs1))
+        fragments.append((crm_ids[cr2] << 32) | int(rs2))
+        # same fragment
+        re2 = re2.rstrip()
+        if cr1 == cr2:
+            if re1 == re2:
+                if sd1 != sd2:
+                    if (ps2 > ps1) == sd2:
+                        # ----<===---===>---                   self-circles
+                        counts[1] += 1
+                        outfil[1].write(read + '\n')
+                        flag |= 1
+                    else:
+                        # ----===>---<===---                   dangling-ends
+                        counts[2] += 1
+                        outfil[2].write(read + '\n')
+                        flag |= 2
+                else:
+                    # --===>--===>-- or --<===--<===-- or same errors
+                    counts[3] += 1
+                    outfil[3].write(read + '\n')
+                    flag |= 4
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2 != sd1
+                  and (ps2 > ps1) != sd2):
+                # different fragments but facing and very close
+                counts[4] += 1
+                outfil[4].write(read + '\n')
+                flag |= 8
+        # distance to RE sites
+        re1, rs1, re2, rs2 = int(re1), int(rs1), int(re2), int(rs2)
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not '~' in read:
+                counts[5] += 1
+                outfil[5].write(read + '\n')
+                flag |= 16
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            counts[10] += 1
+            outfil[10].write(read + '\n')
+            flag |= 512
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            counts[6] += 1
+            outfil[6].write(read + '\n')
+            flag |= 32
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            counts[7] += 1
+            outfil[7].write(read + '\n')
+            flag |= 64
+        flags.append(flag)
+        if len(flags) >= _BLOCK_LINES:
+            _write_partitions(keys, output, chunk, nparts, zeroes)
+            frag_counts = _dump_lines(dumps, fragments, offsets, flags,
+                                      frag_counts)
+            del keys[:]
+    fhandler.close()
+    for k in outfil:
         outfil[k].close()
-    return masked, total
+    _write_partitions(keys, output, chunk, nparts, zeroes)
+    frag_counts = _dump_lines(dumps, fragments, offsets, flags, frag_counts)
+    for out in dumps.itervalues():
+        out.close()
+    return counts, total, frag_counts, dumps['fragments'].name, zeroes
 
-def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
-                     re_proximity, min_frag_size, output):
-    # t0 = time()
-    masked = {5 : {'name': 'too close from RES', 'reads': 0},
-              6 : {'name': 'too short'         , 'reads': 0},
-              7 : {'name': 'too large'         , 'reads': 0},
-              10: {'name': 'random breaks'     , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
+# number of lines of a chunk kept in memory by each process (about 50 bytes
+# each)
+_BLOCK_LINES = 1000000
+
+def _dump_lines(dumps, fragments, offsets, flags, frag_counts):
+    """
+    Appends the fragments, positions and flags of a block of lines to the files
+    of a chunk, and empties the arrays.
+
+    :returns: the fragments seen so far, and the number of read-ends in each
+    """
+    if not flags:
+        return frag_counts
+    frags, nums = unique(frombuffer(fragments, dtype=int64), return_counts=True)
+    for name, values in (('fragments', fragments), ('offsets', offsets),
+                         ('flags', flags)):
+        values.tofile(dumps[name])
+        del values[:]
+    return merge_re_fragment_counts([frag_counts, (frags, nums)])
+
+# bits of the hashes used as bucket for the LogLog count of unique read pairs
+_LOGLOG_BITS = 16
+
+def _hash_keys(keys1, keys2):
+    """
+    64 bits hashes of the positions of two read-ends (mixing function of
+    SplitMix64)
+    """
+    hashes = keys1.astype(uint64) * uint64(0x9E3779B97F4A7C15)
+    hashes ^= keys2.astype(uint64)
+    hashes ^= hashes >> uint64(31)
+    hashes *= uint64(0xBF58476D1CE4E5B9)
+    hashes ^= hashes >> uint64(27)
+    hashes *= uint64(0x94D049BB133111EB)
+    hashes ^= hashes >> uint64(31)
+    return hashes
+
+def _write_partitions(keys, output, chunk, nparts, zeroes):
+    """
+    Appends the positions of read pairs to the partition files of a chunk,
+    read pairs at the same positions going to the same partition. Also
+    updates the maximum number of trailing zeroes of each bucket of hashes
+    (see :func:`pytadbit.utils.fastq_utils.estimate_cardinality`).
+    """
+    if not keys:
+        return
+    keys = frombuffer(keys, dtype=int64).reshape(-1, 3)
+    hashes = _hash_keys(keys[:, 1], keys[:, 2])
+    # trailing zeroes of the hash (without the bucket bits)
+    rest = hashes >> uint64(_LOGLOG_BITS)
+    lowest = (rest & (~rest + uint64(1))) | (rest == 0)
+    nzeroes = where(rest == 0, 64 - _LOGLOG_BITS,
+                    log2(lowest.astype(float)).astype(int64))
+    maximum.at(zeroes, (hashes & uint64(len(zeroes) - 1)).astype(int64),
+               nzeroes)
+    parts = ((hashes >> uint64(32)) % uint64(nparts)).astype(int64)
+    order = argsort(parts, kind='mergesort')
+    bounds = parts[order].searchsorted(arange(nparts + 1))
+    keys = keys[order]
+    for part in xrange(nparts):
+        if bounds[part] == bounds[part + 1]:
+            continue
+        out = open(_chunk_fnam(output, 'keys %d' % part, chunk), 'ab')
+        keys[bounds[part]:bounds[part + 1]].tofile(out)
+        out.close()
+
+def _duplicated_partition((output, part, nchunks)):
+    """
+    Finds duplicated read pairs in a partition (all but the first one of each
+    set of read pairs at the same positions), and stores their positions in
+    the file.
+
+    :returns: the number of duplicated read pairs
+    """
+    keys = [zeros((0, 3), dtype=int64)]
+    for chunk in xrange(nchunks):
+        fnam = _chunk_fnam(output, 'keys %d' % part, chunk)
+        if os.path.exists(fnam):
+            keys.append(fromfile(fnam, dtype=int64).reshape(-1, 3))
+            os.remove(fnam)
+    keys = concatenate(keys)
+    keys = keys[lexsort((keys[:, 0], keys[:, 2], keys[:, 1]))]
+    dups = ((keys[1:, 1] == keys[:-1, 1]) & (keys[1:, 2] == keys[:-1, 2]))
+    offsets = keys[1:, 0][dups]
+    offsets.sort()
+    offsets.tofile(_chunk_fnam(output, 'duplicated offsets', part))
+    return len(offsets)
+
+def _duplicated_chunk((fnam, beg, end, chunk, output, nparts, max_size)):
+    """
+    Filter 9 over a chunk of the file, once the positions of the duplicated
+    read pairs are known. Only the lines of the reads filtered are read again,
+    in windows of about max_size reads.
+    """
+    lines = _chunk_fnam(output, 'offsets', chunk)
+    flags = _chunk_fnam(output, 'flags', chunk)
+    offsets = []
+    for part in xrange(nparts):
+        dump = _chunk_fnam(output, 'duplicated offsets', part)
+        if not os.path.getsize(dump):
+            continue
+        dups = memmap(dump, dtype=int64, mode='r')
+        offsets.append(dups[dups.searchsorted(beg):dups.searchsorted(end)])
+    nwins = sum(len(dups) for dups in offsets) / max_size + 1
+    step = (end - beg) / nwins + 1
+    outfil = open(_chunk_fnam(output, _FILTERS[9], chunk), 'w')
     fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            (read,
-             _, pos1, _, _, rs1, re1,
-             _, pos2, _, _, rs2, re2) = line.split('\t')
-            ps1, ps2, re1, rs1, re2, rs2 = map(int, (pos1, pos2, re1, rs1, re2, rs2))
-            diff11 = re1 - ps1
-            diff12 = ps1 - rs1
-            diff21 = re2 - ps2
-            diff22 = ps2 - rs2
-            if ((diff11 < re_proximity) or
-                (diff12 < re_proximity) or 
-                (diff21 < re_proximity) or
-                (diff22 < re_proximity)):
-                # multicontacts excluded if fragment is internal (not the first)
-                if not '~' in read:
-                    masked[5]["reads"] += 1
-                    outfil[5].write(read + '\n')
-            if (((diff11 > min_dist_to_re) and
-                 (diff12 > min_dist_to_re)) or 
-                ((diff21 > min_dist_to_re) and
-                 (diff22 > min_dist_to_re))):
-                masked[10]["reads"] += 1
-                outfil[10].write(read + '\n')
-            dif1 = re1 - rs1
-            dif2 = re2 - rs2
-            if (dif1 < min_frag_size) or (dif2 < min_frag_size):
-                masked[6]["reads"] += 1
-                outfil[6].write(read + '\n')
-            if (dif1 > max_frag_size) or (dif2 > max_frag_size):
-                masked[7]["reads"] += 1
-                outfil[7].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 2', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+    pos = None
+    for win in xrange(beg, end, step):
+        window = concatenate([zeros(0, dtype=int64)] + [
+            dups[dups.searchsorted(win):dups.searchsorted(win + step)]
+            for dups in offsets])
+        window.sort()
+        if len(window):
+            _set_flags(flags, memmap(lines, dtype=int64,
+                                     mode='r').searchsorted(window), 9)
+        for dup in window.tolist():
+            # close lines are read, instead of moving in the file
+            if pos is None or not 0 <= dup - pos < 65536:
+                fhandler.seek(dup)
+                pos = dup
+            while pos < dup:
+                pos += len(fhandler.readline())
+            line = fhandler.readline()
+            pos += len(line)
+            outfil.write(line.split('\t', 1)[0] + '\n')
+    fhandler.close()
+    outfil.close()
+    os.remove(lines)
 
-def _filter_over_represented(fnam, over_represented, output):
-    # t0 = time()
-    frag_count = count_re_fragments(fnam)
-    num_frags = len(frag_count)
-    cut = int((1 - over_represented) * num_frags + 0.5)
-    # use cut-1 because it represents the length of the list
-    cut = sorted([frag_count[crm] for crm in frag_count])[cut - 1]
-    masked = {8 : {'name': 'over-represented'  , 'reads': 0}}
-    outfil = {}
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k] = open(masked[k]['fnam'], 'w')
+def _set_flags(fnam, lines, k):
+    """
+    Sets the flag of filter k for the given lines of a chunk
+    """
+    flags = memmap(fnam, dtype=uint16, mode='r+')
+    flags[lines] |= 1 << (k - 1)
+    flags.flush()
+    del flags
+
+def _over_represented_chunk((fnam, chunk, output, over)):
+    """
+    Filter 8 over a chunk of the file, once the over-represented fragments are
+    known (sorted array of fragments). The fragments of the read pairs are read
+    from disk in blocks of _BLOCK_LINES lines, and only the lines of the reads
+    filtered are read again.
+    """
+    dump = _chunk_fnam(output, 'fragments', chunk)
+    frag_fh = open(dump, 'rb')
+    offs_fh = open(_chunk_fnam(output, 'offsets', chunk), 'rb')
+    flags = _chunk_fnam(output, 'flags', chunk)
+    outfil = open(_chunk_fnam(output, _FILTERS[8], chunk), 'w')
     fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            read, cr1,  _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
-            if (frag_count.get((cr1, rs1), 0) > cut or
-                  frag_count.get((cr2, rs2), 0) > cut):
-                masked[8]["reads"] += 1
-                outfil[8].write(read + '\n')
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    # print 'done 3', time() - t0
-    for k in masked:
-        masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
-        outfil[k].close()
-    return masked
+    count = 0
+    nlines = 0
+    while True:
+        frags = fromfile(frag_fh, dtype=int64, count=2 * _BLOCK_LINES)
+        if not len(frags):
+            break
+        offsets = fromfile(offs_fh, dtype=int64, count=len(frags) / 2)
+        lines = where(in1d(frags, over).reshape(-1, 2).any(axis=1))[0]
+        if len(lines):
+            _set_flags(flags, lines + nlines, 8)
+        for pos in offsets[lines].tolist():
+            fhandler.seek(pos)
+            outfil.write(fhandler.readline().split('\t', 1)[0] + '\n')
+        count += len(lines)
+        nlines += len(offsets)
+    fhandler.close()
+    outfil.close()
+    frag_fh.close()
+    offs_fh.close()
+    os.remove(dump)
+    return count
 
 
 def _filter_yannick(fnam, maxlen, de_left, de_right, output):
@@ -8,8 +8,13 @@ from pytadbit.utils.file_handling import mkdir, which
 from warnings import warn
 from pytadbit.utils.file_handling import magic_open, get_free_space_mb
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES, religated
+from pytadbit.utils.line_blocks import read_blocks, process_blocks
 from tempfile import gettempdir, mkstemp
 from subprocess import CalledProcessError, PIPE, Popen
+from threading import Thread
+from itertools import izip, chain
+from re import compile, escape
+import multiprocessing as mu
 
 def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
                     min_seq_len=15, fastq=True, verbose=True,
@@ -19,121 +24,38 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
     trim each read according to a start/end positions or split them into
     restriction enzyme fragments
 
+    The input file is read by chunks of complete reads, processed in parallel
+    (nthreads processes, all CPUs by default), the order of the reads being
+    kept in the output.
+
+    :param out_fastq: path to the output FASTQ file, or an open file (e.g. the
+       standard input of the mapper)
+    :param None r_enz: name of the restriction enzyme used, or list of names
+       for experiments with several enzymes (ligation sites of all the
+       combinations of enzymes are searched at once)
     :param True add_site: when splitting the sequence by ligated sites found,
        removes the ligation site, and put back the original RE site.
 
     """
     skip = kwargs.get('skip', False)
-    ## define local functions to process reads and sequences
-    def _get_fastq_read_heavy(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = fhandler.next()
-        _   = fhandler.next()  # lose qualities header but not needed
-        qal = fhandler.next()  # lose qualities but not needed
-        # header now also contains original read
-        return (rlines + ' ' + seq.strip() + ' ' + qal.strip(),
-                seq.strip(), qal.strip())
-
-    def _get_fastq_read_light(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = fhandler.next()
-        _   = fhandler.next()  # lose qualities header but not needed
-        qal = fhandler.next()  # lose qualities but not needed
-        return (rlines, seq.strip(), qal.strip())
-
-    def _get_map_read_heavy(line):
-        header = line.split('\t', 1)[0]
-        seq, qal    = header.rsplit(' ', 2)[-2:]
-        return header, seq, qal
-
-    def _get_map_read_light(line):
-        header, seq, qal, _ = line.split('\t', 3)
-        return header, seq, qal
-
-    def _split_read_re(seq, qal, pattern, max_seq_len=None, site='', cnt=0):
-        """
-        Recursive generator that splits reads according to the
-        predefined restriction enzyme.
-        RE fragments yielded are followed and preceded by the RE site if a
-        ligation site was found after the fragment.
-
-        EXAMPLE:
-
-           seq = '-------oGATCo========oGATCGATCo_____________oGATCGATCo~~~~~~~~~~~~'
-           qal = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
-
-        should yield these fragments:
-
-            -------oGATCo========oGATC
-            xxxxxxxxxxxxxxxxxxxxxxHHHH
-
-            GATCo_____________oGATC
-            HHHHxxxxxxxxxxxxxxxHHHH
+    ncpus = kwargs.get('nthreads') or mu.cpu_count()
 
-            GATCo~~~~~~~~~~~~
-            HHHHxxxxxxxxxxxxx
-
-        """
-        cnt += 1
-        try:
-            pos = seq.index(pattern)
-        except ValueError:
-            if len(seq) == max_seq_len:
-                raise ValueError
-            if len(seq) > min_seq_len:
-                yield seq, qal, cnt
-            return
-        xqal = ('H' * len(site))
-        if pos < min_seq_len:
-            split_read(site + seq[pos + len_relg:],
-                       xqal + qal[pos + len_relg:],
-                       pattern, max_seq_len, cnt=cnt)
-        else:
-            yield seq[:pos] + site, qal[:pos] + xqal, cnt
-        new_pos = pos + len_relg
-        for sseq, sqal, cnt in split_read(site + seq[new_pos:],
-                                          xqal + qal[new_pos:], pattern,
-                                          max_seq_len, site=site, cnt=cnt):
-            yield sseq, sqal, cnt
-
-    # Define function for stripping lines according to focus
-    if isinstance(trim, tuple):
-        beg, end = trim
-        beg -= 1
-        strip_line = lambda x: x[beg:end]
-    else:
-        strip_line = lambda x: x
-
-    # define function to split reads according to restriction enzyme sites
-    if isinstance(r_enz, str):
-        enzyme = RESTRICTION_ENZYMES[r_enz].replace('|', '')
-        enz_pattern = religated(r_enz)
-        sub_enz_pattern = enz_pattern[:len(enz_pattern) / 2]
-        len_relg = len(enz_pattern)
+    # define ligation sites to split reads according to restriction enzyme sites
+    if r_enz:
+        enzymes = [r_enz] if isinstance(r_enz, str) else list(r_enz)
         print '  - splitting into restriction enzyme (RE) fragments using ligation sites'
         print '  - ligation sites are replaced by RE sites to match the reference genome'
-        print '    * enzyme: %s, ligation site: %s, RE site: %s' % (r_enz, enz_pattern, enzyme)
-        split_read = _split_read_re
-    else:
-        enzyme = ''
-        enz_pattern = ''
-        split_read = lambda x, y, z, after_z, after_after_z: (yield x, y , 1)
-
-    # function to yield reads from input file
-    if light_storage:
-        get_seq = _get_fastq_read_light if fastq else _get_map_read_light
-        insert_mark = insert_mark_light
+        for enz1 in enzymes:
+            for enz2 in enzymes:
+                print '    * enzyme: %s, ligation site: %s, RE site: %s' % (
+                    enz1 if enz1 == enz2 else enz1 + '-' + enz2,
+                    religated(enz1, enz2),
+                    RESTRICTION_ENZYMES[enz1].replace('|', '') + (
+                        '' if enz1 == enz2 else
+                        '-' + RESTRICTION_ENZYMES[enz2].replace('|', '')))
+        ligations = _ligation_sites(enzymes, add_site)
     else:
-        get_seq = _get_fastq_read_heavy if fastq else _get_map_read_heavy
-        insert_mark = insert_mark_heavy
+        ligations = None
 
     ## Start processing the input file
     if verbose:
@@ -154,21 +76,136 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
     # open input file
     fhandler = magic_open(fastq_path, cpus=kwargs.get('nthreads'))
     # create output file
-    out_name = out_fastq
-    out = open(out_fastq, 'w')
-    # iterate over reads and strip them
-    site = enzyme if add_site else ''
-    for header in fhandler:
-        header, seq, qal = get_seq(header)
+    out = open(out_fastq, 'w') if isinstance(out_fastq, str) else out_fastq
+    # iterate over chunks of reads, trim and split them
+    params = trim, ligations, min_seq_len, fastq, light_storage
+    chunks = read_blocks(fhandler, nlines=4 if fastq else 1)
+    results = process_blocks(_transform_chunk, chunks, params, ncpus,
+                             pool=kwargs.get('pool'))
+    try:
+        for reads, count in results:
+            out.write(reads)
+            counter += count
+    finally:
+        # stops the processes if reads could not be written
+        results.close()
+    if isinstance(out_fastq, str):
+        out.close()
+    return out_fastq, counter
+
+def _ligation_sites(enzymes, add_site):
+    """
+    :returns: two tuples (one for the ligation sites, and one for the half
+       ligation sites) with a regular expression matching any of the sites, and
+       a dictionary with, for each site, the length of the ligation site, and
+       the RE sites to put back before and after it
+    """
+    sites = {}
+    halves = {}
+    for enz1 in enzymes:
+        for enz2 in enzymes:
+            ligation = religated(enz1, enz2)
+            before = RESTRICTION_ENZYMES[enz1].replace('|', '') if add_site else ''
+            after  = RESTRICTION_ENZYMES[enz2].replace('|', '') if add_site else ''
+            sites.setdefault(ligation, (len(ligation), before, after))
+            halves.setdefault(ligation[:len(ligation) / 2],
+                              (len(ligation), '', ''))
+    # longest sites first, in case several are found at the same position
+    return tuple((compile('|'.join(escape(site) for site in
+                                   sorted(patterns, key=len, reverse=True))),
+                  patterns) for patterns in (sites, halves))
+
+def _split_read(seq, qal, ligations, min_seq_len):
+    """
+    Generator that splits reads according to the ligation sites of the
+    restriction enzyme(s).
+    RE fragments yielded are followed and preceded by the RE site if a
+    ligation site was found after the fragment.
+
+    EXAMPLE:
+
+       seq = '-------oGATCo========oGATCGATCo_____________oGATCGATCo~~~~~~~~~~~~'
+       qal = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+
+    should yield these fragments:
+
+        -------oGATCo========oGATC
+        xxxxxxxxxxxxxxxxxxxxxxHHHH
+
+        GATCo_____________oGATC
+        HHHHxxxxxxxxxxxxxxxHHHH
+
+        GATCo~~~~~~~~~~~~
+        HHHHxxxxxxxxxxxxx
+
+    :raises: ValueError if no ligation site is found in the read
+    """
+    pattern, sites = ligations
+    max_seq_len = len(seq)
+    cnt = 0
+    while True:
+        cnt += 1
+        match = pattern.search(seq)
+        if not match:
+            if len(seq) == max_seq_len:
+                raise ValueError
+            if len(seq) > min_seq_len:
+                yield seq, qal, cnt
+            return
+        pos = match.start()
+        len_relg, before, after = sites[match.group()]
+        if pos >= min_seq_len:
+            yield seq[:pos] + before, qal[:pos] + 'H' * len(before), cnt
+        new_pos = pos + len_relg
+        seq = after + seq[new_pos:]
+        qal = 'H' * len(after) + qal[new_pos:]
+
+def _transform_chunk((chunk, (trim, ligations, min_seq_len, fastq,
+                              light_storage))):
+    """
+    Trims and splits the reads of a chunk of a FASTQ file (or of a MAP file)
+
+    :returns: the reads in FASTQ format, and the number of reads processed
+    """
+    lines = chunk.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    if fastq:
+        # header now also contains original read (if not light)
+        headers = (h.split()[0][1:] for h in lines[::4])
+        seqs = (l.strip() for l in lines[1::4])
+        qals = (l.strip() for l in lines[3::4])
+        if light_storage:
+            reads = izip(headers, seqs, qals)
+        else:
+            reads = ((h + ' ' + s + ' ' + q, s, q)
+                     for h, s, q in izip(headers, seqs, qals))
+    elif light_storage:
+        reads = (l.split('\t', 3)[:3] for l in lines)
+    else:
+        reads = ((h,) + tuple(h.rsplit(' ', 2)[-2:])
+                 for h in (l.split('\t', 1)[0] for l in lines))
+    insert_mark = insert_mark_light if light_storage else insert_mark_heavy
+    if isinstance(trim, tuple):
+        beg, end = trim
+        beg -= 1
+    else:
+        beg, end = None, None
+    out = []
+    counter = 0
+    for header, seq, qal in reads:
         counter += 1
         # trim on wanted region of the read
-        seq = strip_line(seq)
-        qal = strip_line(qal)
+        seq = seq[beg:end]
+        qal = qal[beg:end]
+        if not ligations:
+            out.append('@%s\n%s\n+\n%s\n' % (header, seq, qal))
+            continue
         # get the generator of restriction enzyme fragments
-        iter_frags = split_read(seq, qal, enz_pattern, len(seq), site)
+        iter_frags = _split_read(seq, qal, ligations[0], min_seq_len)
         # the first fragment should not be preceded by the RE site
         try:
-            seq, qal, cnt = iter_frags.next()
+            first = iter_frags.next()
         except StopIteration:
             # read full of ligation events, fragments not reaching minimum
             continue
@@ -176,22 +213,18 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
             # or not ligation site found, in which case we try with half
             # ligation site in case there was a sequencing error (half ligation
             # site is a RE site or nearly, and thus should not be found anyway)
-            iter_frags = split_read(seq, qal, sub_enz_pattern, len(seq), '')
+            iter_frags = _split_read(seq, qal, ligations[1], min_seq_len)
             try:
-                seq, qal, cnt = iter_frags.next()
+                first = iter_frags.next()
             except ValueError:
                 continue
             except StopIteration:
                 continue
-        out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                        seq, qal, '0', '-\n'))))
         # the next fragments should be preceded by the RE site
-        # continue
-        for seq, qal, cnt in  iter_frags:
-            out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                            seq, qal, '0', '-\n'))))
-    out.close()
-    return out_name, counter
+        for seq, qal, cnt in chain((first, ), iter_frags):
+            out.append('@%s\n%s\n+\n%s\n' % (insert_mark(header, cnt),
+                                                seq, qal))
+    return ''.join(out), counter
 
 def insert_mark_heavy(header, num):
     if num == 1 :
@@ -217,7 +250,7 @@ def _gem_filter(fnam, unmap_out, map_out):
        - not feasible with gt.filter
     """
     fhandler = magic_open(fnam) if isinstance(fnam, str) else fnam
-    unmap_out = open(unmap_out, 'w')
+    unmap_out = open(unmap_out, 'w') if isinstance(unmap_out, str) else unmap_out
     map_out   = open(map_out  , 'w')
     def _strip_read_name(line):
         """
@@ -243,6 +276,108 @@ def _gem_filter(fnam, unmap_out, map_out):
         if not bad:
             map_out.write(_strip_read_name(line))
     unmap_out.close()
+    map_out.close()
+
+class _ReadForwarder(object):
+    """
+    File-like object receiving reads in MAP format, that are trimmed (or split
+    into RE fragments) and written as FASTQ to the standard input of a GEM
+    process, which is closed with this object.
+    """
+    def __init__(self, gem, trim=None, r_enz=None, add_site=True,
+                 min_seq_len=15, light_storage=False, size=100000):
+        if r_enz:
+            enzymes = [r_enz] if isinstance(r_enz, str) else list(r_enz)
+            ligations = _ligation_sites(enzymes, add_site)
+        else:
+            ligations = None
+        self.params = trim, ligations, min_seq_len, False, light_storage
+        self.out    = gem.stdin
+        self.size   = size
+        self.lines  = []
+        self.count  = 0
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.size:
+            self.flush()
+
+    def flush(self):
+        reads, count = _transform_chunk((''.join(self.lines), self.params))
+        self.out.write(reads)
+        self.count += count
+        del self.lines[:]
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+def _mapping_pipeline(gem_index_path, fastq_path, fastq, stages, outfiles,
+                      fail_map, nthreads=8, **kwargs):
+    """
+    Maps reads in successive stages (e.g. windows of iterative mapping)
+    running concurrently, with one GEM process per stage. Reads uniquely
+    mapped by a stage are written to its output file, the others are trimmed
+    (or split into RE fragments) and sent to the next stage, without
+    intermediate files.
+
+    :param fastq_path: path to the input reads
+    :param fastq: whether the input is in FASTQ format (MAP otherwise)
+    :param stages: list of tuples with the kind of mapping, the beginning and
+       end of the window, and the parameters of :func:`transform_fastq`
+    :param outfiles: list of paths where to write the reads mapped by each
+       stage
+    :param fail_map: path where to write the reads not mapped by the last
+       stage
+
+    :returns: the number of reads processed by each stage
+    """
+    # the processes transforming the input reads are started before the GEM
+    # processes and the threads, so that they do not inherit their pipes
+    pool = mu.Pool(nthreads) if nthreads > 1 else None
+    try:
+        gems = [_gem_mapping(gem_index_path, None, None, nthreads=nthreads,
+                             **kwargs) for _ in stages]
+        unmapped = [_ReadForwarder(gem, **params)
+                    for gem, (_, _, _, params) in zip(gems[1:], stages[1:])]
+        unmapped.append(fail_map)
+        errors = []
+        def _filter(gem, unmap_out, map_out):
+            try:
+                _gem_filter(gem.stdout, unmap_out, map_out)
+            except Exception, e:
+                # stop the whole pipeline
+                errors.append(e)
+                for proc in gems:
+                    if proc.poll() is None:
+                        proc.kill()
+        threads = [Thread(target=_filter, args=args)
+                   for args in zip(gems, unmapped, outfiles)]
+        for (kind, beg, end, _), thread in zip(stages, threads):
+            print 'Mapping %s reads in window %s-%s...' % (
+                'fragments of' if kind == 'frag' else 'full', beg, end)
+            thread.start()
+        try:
+            _, counter = transform_fastq(fastq_path, gems[0].stdin, fastq=fastq,
+                                         nthreads=nthreads, pool=pool,
+                                         **stages[0][3])
+        except IOError:
+            # broken pipe, GEM stopped (its exit status is checked below)
+            counter = None
+        _wait_gem(gems[0])
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        for gem in gems:
+            _wait_gem(gem)
+        if counter is None:
+            raise Exception('ERROR: GEM stopped reading input reads')
+        return [counter] + [forward.count for forward in unmapped[:-1]]
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
 
 def _gem_mapping(gem_index_path, fastq_path, out_map_path,
                 gem_binary='gem-mapper', **kwargs):
@@ -251,10 +386,16 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
        (start, end) position, or the name of a restriction enzyme. By default it
        uses the full sequence.
     :param 33 quality: set it to 'ignore' in order to speed-up the mapping
+
+    :returns: None, or, if fastq_path is None, the GEM process reading the
+       FASTQ from its standard input (to be closed and waited for), and
+       writing mapped reads to its standard output if out_map_path is None
     """
     gem_index_path    = os.path.abspath(os.path.expanduser(gem_index_path))
-    fastq_path        = os.path.abspath(os.path.expanduser(fastq_path))
-    out_map_path      = os.path.abspath(os.path.expanduser(out_map_path))
+    if fastq_path:
+        fastq_path    = os.path.abspath(os.path.expanduser(fastq_path))
+    if out_map_path:
+        out_map_path  = os.path.abspath(os.path.expanduser(out_map_path))
     nthreads          = kwargs.get('nthreads'            , 8)
     max_edit_distance = kwargs.get('max_edit_distance'   , 0.04)
     mismatches        = kwargs.get('mismatches'          , 0.04)
@@ -273,7 +414,7 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
                         'not provide any binary for MAC-OS.')
 
     # mapping
-    print 'TO GEM', fastq_path
+    print 'TO GEM', fastq_path or 'standard input'
     kgt = kwargs.get
     gem_cmd = [
         gem_binary, '-I', gem_index_path,
@@ -294,9 +435,11 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
         '--max-extendable-matches'  , kgt('max-extendable-matches', '20'      ),
         '--max-extensions-per-match', kgt('max-extensions-per-match', '1'     ),
         '-e'                        , kgt('e', str(mismatches)                ),
-        '-T'                        , str(nthreads),
-        '-i'                        , fastq_path,
-        '-o', out_map_path.replace('.map', '')]
+        '-T'                        , str(nthreads)]
+    if fastq_path:
+        gem_cmd += ['-i', fastq_path]
+    if out_map_path:
+        gem_cmd += ['-o', out_map_path.replace('.map', '')]
 
     if 'paired-end-alignment' in kwargs or 'p' in kwargs:
         gem_cmd.append('--paired-end-alignment')
@@ -326,6 +469,11 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
             warn('WARNING: %s not in usual keywords, misspelled?' % kw)
 
     print ' '.join(gem_cmd)
+    if not fastq_path:
+        # file descriptors are not inherited, otherwise other GEM processes
+        # would keep the standard input open
+        return Popen(gem_cmd, stdin=PIPE, close_fds=True,
+                     stdout=open(os.devnull, 'w') if out_map_path else PIPE)
     try:
         # check_call(gem_cmd, stdout=PIPE, stderr=PIPE)
         out, err = Popen(gem_cmd, stdout=PIPE, stderr=PIPE).communicate()
@@ -334,6 +482,19 @@ def _gem_mapping(gem_index_path, fastq_path, out_map_path,
         print err
         raise Exception(e.output)
 
+def _wait_gem(gem):
+    """
+    Closes the standard input of a GEM process and waits for it to finish
+    """
+    try:
+        gem.stdin.close()
+    except IOError:
+        # broken pipe, remaining reads could not be written
+        pass
+    if gem.wait():
+        raise Exception('ERROR: GEM mapping failed (exit status %d)' %
+                        gem.returncode)
+
 def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=True,
                  min_seq_len=15, windows=None, add_site=True, clean=False,
                  get_nread=False, **kwargs):
@@ -382,7 +543,6 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
     suffix = kwargs.get('suffix', '')
     suffix = ('_' * (suffix != '')) + suffix
     nthreads = kwargs.get('nthreads', 8)
-    outfiles = []
     temp_dir = os.path.abspath(os.path.expanduser(
         kwargs.get('temp_dir', gettempdir())))
     # create directories
@@ -412,90 +572,39 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
         # in this case we will need to keep the information about original
         # sequence at any point, light storage is thus not possible.
         light_storage = False
+    fastq = (   input_reads.endswith('.fastq'   )
+             or input_reads.endswith('.fastq.gz')
+             or input_reads.endswith('.fq.gz'   )
+             or input_reads.endswith('.dsrc'    ))
+    # one stage per window, and one more to map again splitting unmapped
+    # reads into RE fragments (no need to trim this time)
+    stages = []
     for win in windows:
-        # Prepare the FASTQ file and iterate over them
-        curr_map, counter = transform_fastq(
-            input_reads, mkstemp(prefix=base_name + '_', dir=temp_dir)[1],
-            fastq=(   input_reads.endswith('.fastq'   )
-                   or input_reads.endswith('.fastq.gz')
-                   or input_reads.endswith('.fq.gz'   )
-                   or input_reads.endswith('.dsrc'    )),
-            min_seq_len=min_seq_len, trim=win, skip=skip, nthreads=nthreads,
-            light_storage=light_storage)
-        # clean
-        if input_reads != fastq_path and clean:
-            print '   x removing original input %s' % input_reads
-            os.system('rm -f %s' % (input_reads))
-        # First mapping, full length
-        if not win:
-            beg, end = 1, 'end'
-        else:
-            beg, end = win
-        out_map_path = curr_map + '_full_%s-%s%s.map' % (beg, end, suffix)
-        if end:
-            print 'Mapping reads in window %s-%s%s...' % (beg, end, suffix)
-        else:
-            print 'Mapping full reads...', curr_map
-
-        if not skip:
-            _gem_mapping(gem_index_path, curr_map, out_map_path, **kwargs)
-            # parse map file to extract not uniquely mapped reads
-            print 'Parsing result...'
-            _gem_filter(out_map_path,
-                        curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix),
-                        os.path.join(out_map_dir,
-                                     base_name + '_full_%s-%s%s.map' % (
-                                         beg, end, suffix)))
-            # clean
-            if clean:
-                print '   x removing GEM input %s' % curr_map
-                os.system('rm -f %s' % (curr_map))
-                print '   x removing map %s' % out_map_path
-                os.system('rm -f %s' % (out_map_path))
-            # for next round, we will use remaining unmapped reads
-            input_reads = curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix)
-        outfiles.append(
-            (os.path.join(out_map_dir,
-                          base_name + '_full_%s-%s%s.map' % (beg, end, suffix)),
-             counter))
-
-    # map again splitting unmapped reads into RE fragments
-    # (no need to trim this time)
+        beg, end = win or (1, 'end')
+        stages.append(('full', beg, end, dict(trim=win)))
     if frag_map:
         if not r_enz:
             raise Exception('ERROR: need enzyme name to fragment.')
-        frag_map, counter = transform_fastq(
-            input_reads, mkstemp(prefix=base_name + '_', dir=temp_dir)[1],
-            min_seq_len=min_seq_len, trim=win, fastq=False, r_enz=r_enz,
-            add_site=add_site, skip=skip, nthreads=nthreads,
-            light_storage=light_storage)
-        # clean
-        if clean:
-            print '   x removing pre-GEM input %s' % input_reads
-            os.system('rm -f %s' % (input_reads))
-        if not win:
-            beg, end = 1, 'end'
-        else:
-            beg, end = win
-        out_map_path = frag_map + '_frag_%s-%s%s.map' % (beg, end, suffix)
-        if not skip:
-            print 'Mapping fragments of remaining reads...'
-            _gem_mapping(gem_index_path, frag_map, out_map_path, **kwargs)
-            print 'Parsing result...'
-            _gem_filter(out_map_path, curr_map + '_fail%s.map' % (suffix),
-                        os.path.join(out_map_dir,
-                                     base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)))
+        stages.append(('frag', beg, end, dict(trim=win, r_enz=r_enz,
+                                              add_site=add_site)))
+    for _, _, _, params in stages:
+        params.update(min_seq_len=min_seq_len, light_storage=light_storage)
+    outfiles = [os.path.join(out_map_dir, base_name + '_%s_%s-%s%s.map' % (
+        kind, beg, end, suffix)) for kind, beg, end, _ in stages]
+    if skip:
+        _, counter = transform_fastq(input_reads, None, fastq=fastq, skip=skip,
+                                     nthreads=nthreads, **stages[0][3])
+        counters = [counter] + [0] * (len(stages) - 1)
+    else:
+        fail_map = mkstemp(prefix=base_name + '_',
+                           suffix='_fail%s.map' % (suffix), dir=temp_dir)[1]
+        counters = _mapping_pipeline(gem_index_path, input_reads, fastq,
+                                     stages, outfiles, fail_map, **kwargs)
         # clean
         if clean:
-            print '   x removing GEM input %s' % frag_map
-            os.system('rm -f %s' % (frag_map))
-            print '   x removing failed to map ' + curr_map + '_fail%s.map' % (suffix)
-            os.system('rm -f %s' % (curr_map + '_fail%s.map' % (suffix)))
-            print '   x removing tmp mapped %s' % out_map_path
-            os.system('rm -f %s' % (out_map_path))
-        outfiles.append((os.path.join(out_map_dir,
-                                      base_name + '_frag_%s-%s%s.map' % (beg, end, suffix)),
-                         counter))
+            print '   x removing failed to map ' + fail_map
+            os.system('rm -f %s' % (fail_map))
+    outfiles = zip(outfiles, counters)
     if get_nread:
         return outfiles
     return [out for out, _ in outfiles]
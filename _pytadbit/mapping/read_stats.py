@@ -0,0 +1,347 @@
+"""
+18 Oct 2026
+
+Statistics of read pairs for quality checks, computed in a single pass.
+
+All the histograms and counters needed by the read-level plots of
+:mod:`pytadbit.mapping.analyze` are accumulated in a :class:`ReadStats`, from
+blocks of lines of a file of read pairs (or of columns of a pairs store). The
+file is split in chunks scanned by parallel workers, and their partial
+statistics are merged. The resulting object can be passed to the plotting
+functions instead of the file of reads:
+
+::
+
+  stats = read_stats('reads.tsv', ncpus=8)
+  insert_sizes(stats, savefig='insert_sizes.pdf')
+  plot_genomic_distribution(stats, savefig='genomic_distribution.pdf')
+  plot_strand_bias_by_distance(stats, savefig='strand_bias.pdf')
+"""
+
+from collections                  import OrderedDict
+from pytadbit.utils.line_blocks   import split_file, read_blocks
+from pytadbit.utils.line_blocks   import parse_pairs, PAIRS_COLUMNS
+from pytadbit.parsers.pairs_store import load_pairs_store, is_pairs_store
+import multiprocessing as mu
+import numpy as np
+
+# all the columns but read names
+_COLUMNS = PAIRS_COLUMNS[1:]
+
+
+class ReadStats(object):
+    """
+    Histograms and counters of a set of read pairs, as used by the read-level
+    plots of :mod:`pytadbit.mapping.analyze`. Statistics of different sets of
+    read pairs (computed with the same parameters) can be merged with +=
+
+    :param 10000 resolution: size of the bins of the genomic distribution of
+       reads (see :func:`pytadbit.mapping.analyze.plot_genomic_distribution`)
+    :param 100000 max_len: maximum distance between read-ends for the strand
+       bias (see
+       :func:`pytadbit.mapping.analyze.plot_strand_bias_by_distance`)
+    :param 20 window: maximum distance of reads to RE sites (see
+       :func:`pytadbit.mapping.analyze.plot_rsite_reads_distribution`)
+    :param 1000 rsite_maxdist: maximum distance between read-ends (see
+       :func:`pytadbit.mapping.analyze.plot_rsite_reads_distribution`)
+    :param 800 diag_maxdist: maximum distance between read-ends (see
+       :func:`pytadbit.mapping.analyze.plot_diagonal_distributions`)
+    :param [-2,3] de_left: distances to the RE site of the second read-end
+       of dangling-ends (see
+       :func:`pytadbit.mapping.analyze.plot_diagonal_distributions`)
+    :param [0,5] de_right: distances to the RE site of the first read-end of
+       dangling-ends (see
+       :func:`pytadbit.mapping.analyze.plot_diagonal_distributions`)
+
+    Statistics are stored as:
+
+       - nreads: number of read pairs
+       - chromosomes: dictionary with the length of each chromosome
+       - lengths: mapped length of the first and second read-ends (two
+         arrays of counts)
+       - dangling_ends: distance between read-ends of dangling-ends (array of
+         counts)
+       - genomic: number of first and second read-ends in each bin of each
+         chromosome (two dictionaries of arrays of counts)
+       - strands: number of read pairs in each strand category at each
+         distance (array of shape (4, max_len))
+       - rsite: distances of the first and second read-ends of facing read
+         pairs to the closest RE site, from -window to window (array of shape
+         (2, 2 * window + 1))
+       - diagonal: number of random breaks, dangling-ends and rejoined read
+         pairs at each distance up to diag_maxdist (array of shape
+         (3, diag_maxdist + 1))
+    """
+    def __init__(self, resolution=10000, max_len=100000, window=20,
+                 rsite_maxdist=1000, diag_maxdist=800, de_left=(-2, 3),
+                 de_right=(0, 5)):
+        self.params = {'resolution'   : resolution,
+                       'max_len'      : max_len,
+                       'window'       : window,
+                       'rsite_maxdist': rsite_maxdist,
+                       'diag_maxdist' : diag_maxdist,
+                       'de_left'      : list(de_left),
+                       'de_right'     : list(de_right)}
+        self.nreads        = 0
+        self.chromosomes   = OrderedDict()
+        self.lengths       = [np.zeros(0, dtype=np.int64) for _ in xrange(2)]
+        self.dangling_ends = np.zeros(0, dtype=np.int64)
+        self.genomic       = [{}, {}]
+        self.strands       = np.zeros((4, max_len), dtype=np.int64)
+        self.rsite         = np.zeros((2, 2 * window + 1), dtype=np.int64)
+        self.diagonal      = np.zeros((3, diag_maxdist + 1), dtype=np.int64)
+
+    def __repr__(self):
+        return 'ReadStats(%d read pairs)' % self.nreads
+
+    def __iadd__(self, other):
+        if self.params != other.params:
+            raise Exception('ERROR: statistics computed with different '
+                            'parameters')
+        self.nreads += other.nreads
+        for crm, length in other.chromosomes.iteritems():
+            self.chromosomes.setdefault(crm, length)
+        for i in xrange(2):
+            self.lengths[i] = _add(self.lengths[i], other.lengths[i])
+            for crm, counts in other.genomic[i].iteritems():
+                self.genomic[i][crm] = _add(self.genomic[i].get(
+                    crm, counts[:0]), counts)
+        self.dangling_ends = _add(self.dangling_ends, other.dangling_ends)
+        self.strands  += other.strands
+        self.rsite    += other.rsite
+        self.diagonal += other.diagonal
+        return self
+
+    def check_params(self, **kwargs):
+        """
+        Raises an exception if the statistics were not computed with the
+        given parameters.
+        """
+        for param, value in kwargs.iteritems():
+            if isinstance(value, tuple):
+                value = list(value)
+            if self.params[param] != value:
+                raise Exception(('ERROR: statistics computed with %s=%s, '
+                                 'instead of %s') % (
+                                     param, self.params[param], value))
+
+    def update(self, names, cols):
+        """
+        Adds read pairs to the statistics.
+
+        :param names: list of chromosome names (position in the list being the
+           chromosome index in cols)
+        :param cols: dictionary with the columns of a file of read pairs, as
+           arrays of integers (keys: crm1, pos1, sd1, len1, rs1, re1, crm2...)
+        """
+        crm1, pos1, sd1, len1, rs1, re1 = [cols[k + '1'] for k in (
+            'crm', 'pos', 'sd', 'len', 'rs', 're')]
+        crm2, pos2, sd2, len2, rs2, re2 = [cols[k + '2'] for k in (
+            'crm', 'pos', 'sd', 'len', 'rs', 're')]
+        self.nreads += len(crm1)
+        same_crm = crm1 == crm2
+
+        # mapped length, and genomic distribution of each read-end
+        resolution = self.params['resolution']
+        for i, (crm, pos, length) in enumerate(((crm1, pos1, len1),
+                                                (crm2, pos2, len2))):
+            self.lengths[i] = _add(self.lengths[i], np.bincount(length))
+            bins, counts = np.unique((crm << 32) | (pos / resolution),
+                                     return_counts=True)
+            crms = bins >> 32
+            bins &= 0xffffffff
+            for idx in np.unique(crms).tolist():
+                sel = crms == idx
+                values = np.zeros(bins[sel][-1] + 1, dtype=np.int64)
+                values[bins[sel]] = counts[sel]
+                self.genomic[i][names[idx]] = _add(
+                    self.genomic[i].get(names[idx], values[:0]), values)
+
+        # dangling-ends (RE fragment of the first read-end)
+        keep = ((rs1 == rs2) & same_crm & (sd1 != sd2) &
+                ((pos2 > pos1) == (sd1 == 1)))
+        self.dangling_ends = _add(self.dangling_ends,
+                                  np.bincount(np.abs(pos2 - pos1)[keep]))
+
+        # strands in function of the distance between read-ends (ordered by
+        # position)
+        max_len = self.params['max_len']
+        swap = pos2 < pos1
+        dist = np.abs(pos2 - pos1)
+        keep = (rs1 != rs2) & same_crm & (dist < max_len)
+        cats = np.where(swap, sd2, sd1) * 2 + np.where(swap, sd1, sd2)
+        self.strands += np.bincount((cats * max_len + dist)[keep],
+                                    minlength=4 * max_len).reshape(4, max_len)
+
+        # facing read-ends close to the diagonal, with the distance of each
+        # read-end to its closest RE site
+        swap = pos1 > pos2
+        ordered = lambda x, y: (np.where(swap, y, x), np.where(swap, x, y))
+        pos1, pos2 = ordered(pos1, pos2)
+        sd1, sd2   = ordered(sd1, sd2)
+        rs1, rs2   = ordered(rs1, rs2)
+        re1, re2   = ordered(re1, re2)
+        facing = same_crm & (sd1 == 1) & (sd2 == 0)
+        mollen = pos2 - pos1
+        dist1 = pos1 - np.where(np.abs(pos1 - rs1) < np.abs(pos1 - re1),
+                                rs1, re1)
+        dist2 = pos2 - np.where(np.abs(pos2 - rs2) < np.abs(pos2 - re2),
+                                rs2, re2)
+        window = self.params['window']
+        keep = facing & (mollen <= self.params['rsite_maxdist'])
+        for i, dist in enumerate((dist1, dist2)):
+            sel = keep & (np.abs(dist) <= window)
+            self.rsite[i] += np.bincount(dist[sel] + window,
+                                         minlength=2 * window + 1)
+        keep = facing & (mollen <= self.params['diag_maxdist'])
+        des = (np.in1d(dist1, self.params['de_right']) |
+               np.in1d(dist2, self.params['de_left']))
+        rbreaks = ~des & (re1 == re2)
+        for i, cat in enumerate((rbreaks, des, ~des & ~rbreaks)):
+            self.diagonal[i] += np.bincount(mollen[keep & cat],
+                                            minlength=len(self.diagonal[i]))
+
+
+def _add(counts1, counts2):
+    """
+    Sum of two arrays of counts of different lengths
+    """
+    if len(counts1) < len(counts2):
+        counts1, counts2 = counts2, counts1
+    counts1 = counts1.copy()
+    counts1[:len(counts2)] += counts2
+    return counts1
+
+
+def read_stats(fnam, nreads=None, ncpus=1, **kwargs):
+    """
+    Computes, in a single pass, the statistics needed by the read-level plots
+    of :mod:`pytadbit.mapping.analyze`.
+
+    :param fnam: path to a tab separated file of read pairs generated by
+       :func:`pytadbit.mapping.get_intersection`, or to a pairs store (see
+       :func:`pytadbit.parsers.pairs_store.write_pairs_store`), of which only
+       the needed columns are read
+    :param None nreads: compute the statistics on a random sample of this
+       number of read pairs (reservoir sampling, the whole file is read)
+    :param 1 ncpus: number of chunks of the file processed in parallel
+    :param kwargs: parameters of the statistics (see :class:`ReadStats`)
+
+    :returns: a :class:`ReadStats`
+    """
+    stats = ReadStats(**kwargs)
+    if is_pairs_store(fnam):
+        store = load_pairs_store(fnam)
+        stats.chromosomes.update(store.chromosomes)
+        crm_ids = dict(store.crm_ids)
+        # chunks of pairs instead of chunks of bytes
+        step = max(1, -(-len(store) // ncpus))
+        chunks = [(beg, min(beg + step, len(store)))
+                  for beg in xrange(0, len(store), step)] or [(0, 0)]
+    else:
+        crm_ids = {}
+        fhandler = open(fnam)
+        line = fhandler.readline()
+        while line.startswith('#'):
+            if line.startswith('# CRM '):
+                crm, length = line[6:].split('\t')
+                stats.chromosomes[crm] = int(length)
+                crm_ids[crm] = len(crm_ids)
+            line = fhandler.readline()
+        fhandler.close()
+        chunks = split_file(fnam, ncpus)
+    jobs = [(fnam, beg, end, crm_ids, kwargs, nreads) for beg, end in chunks]
+    if ncpus > 1 and len(jobs) > 1:
+        pool = mu.Pool(ncpus)
+        results = pool.map(_chunk_stats, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_chunk_stats, jobs)
+    if not nreads:
+        for chunk_stats in results:
+            stats += chunk_stats
+        return stats
+    # merge the samples of each chunk, with the same chromosome indexes
+    samples = []
+    for names, sample in results:
+        for crm in names:
+            crm_ids.setdefault(crm, len(crm_ids))
+        idx = np.array([crm_ids[crm] for crm in names], dtype=np.int64)
+        for col in ('crm1', 'crm2'):
+            sample[col] = idx[sample[col]]
+        samples.append(sample)
+    stats.update(sorted(crm_ids, key=crm_ids.get),
+                 _sample(_concatenate(samples), nreads))
+    return stats
+
+
+def _chunk_stats((fnam, beg, end, crm_ids, params, nreads)):
+    """
+    Statistics of a chunk of a file of read pairs.
+
+    :returns: a ReadStats, or if nreads, the list of chromosome names and a
+       random sample of the read pairs
+    """
+    stats = ReadStats(**params)
+    crm_ids = dict(crm_ids)
+    rand = np.random.RandomState()
+    sample = None
+    for cols in _chunk_columns(fnam, beg, end, crm_ids):
+        if not nreads:
+            stats.update(sorted(crm_ids, key=crm_ids.get), cols)
+            continue
+        # reservoir sampling: read pairs with the lowest random keys
+        cols['key'] = rand.random_sample(len(cols['crm1']))
+        sample = _sample(cols if sample is None else
+                         _concatenate([sample, cols]), nreads)
+    if not nreads:
+        return stats
+    if sample is None:
+        sample = parse_pairs('', {}, _COLUMNS)
+        sample['key'] = np.zeros(0)
+    return sorted(crm_ids, key=crm_ids.get), sample
+
+
+def _chunk_columns(fnam, beg, end, crm_ids, size=1000000):
+    """
+    Reads a chunk of a file of read pairs (from byte beg to end), or of a
+    pairs store (from pair beg to end), by blocks. Chromosomes not found in
+    crm_ids are added to it.
+
+    :yields: dictionaries with each column as an array of integers
+    """
+    if not is_pairs_store(fnam):
+        fhandler = open(fnam)
+        fhandler.seek(beg)
+        for block in read_blocks(fhandler, end=end):
+            yield parse_pairs(block, crm_ids, _COLUMNS)
+        fhandler.close()
+        return
+    store = load_pairs_store(fnam)
+    for pos in xrange(beg, end, size):
+        rows = slice(pos, min(pos + size, end))
+        strands = store.column('strands')[rows].astype(np.int64)
+        cols = {}
+        for num in '12':
+            for col, name in (('crm', 'crm'), ('pos', 'pos'), ('len', 'len'),
+                              ('rs', 'beg'), ('re', 'end')):
+                cols[col + num] = store.column(name + num)[rows].astype(
+                    np.int64)
+            cols['sd' + num] = (strands >> (int(num) - 1)) & 1
+        yield cols
+
+
+def _sample(cols, nreads):
+    """
+    :returns: the nreads read pairs with the lowest random keys
+    """
+    if len(cols['key']) <= nreads:
+        return cols
+    keep = np.argpartition(cols['key'], nreads - 1)[:nreads]
+    return dict((col, values[keep]) for col, values in cols.iteritems())
+
+
+def _concatenate(samples):
+    return dict((col, np.concatenate([sample[col] for sample in samples]))
+                for col in samples[0])
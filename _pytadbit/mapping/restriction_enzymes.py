@@ -4,30 +4,118 @@
 Definition and mapping of restriction enymes
 """
 
-from re import compile
+from re                           import compile
+from os                           import path
+from itertools                    import izip
+from numpy                        import array, concatenate, cumsum, int64
+from numpy                        import searchsorted, maximum, savez, load
+from numpy                        import unique, bincount
+from pytadbit.utils.file_handling import mkdir
+from pytadbit.parsers.genome_store import genome_checksum
+from pytadbit.parsers.pairs_store  import load_pairs_store, is_pairs_store
+from pytadbit.utils.line_blocks    import read_blocks, parse_pairs
 
 
 def count_re_fragments(fnam):
-    frag_count = {}
+    """
+    :param fnam: path to a tab separated file generated by
+       :func:`pytadbit.mapping.get_intersection`, or to a pairs store
+
+    :returns: a dictionary with the number of read ends falling in each RE
+       fragment, keys being tuples of chromosome name and position of the RE
+       site (see :func:`re_fragment_counts` for a more compact output)
+    """
+    names, fragments, counts = re_fragment_counts(fnam)
+    return dict(((names[frag >> 32], str(frag & 0xffffffff)), count)
+                for frag, count in izip(fragments.tolist(), counts.tolist()))
+
+
+def re_fragment_counts(fnam):
+    """
+    Counts the read ends falling in each RE fragment. Fragments are identified
+    by an integer encoding the index of their chromosome and the position of
+    their RE site: (chromosome << 32) | position
+
+    :param fnam: path to a tab separated file generated by
+       :func:`pytadbit.mapping.get_intersection`, or to a pairs store
+
+    :returns: the list of chromosome names, a sorted array of fragment
+       identifiers, and an array with the number of read ends in each fragment
+    """
+    if is_pairs_store(fnam):
+        return _re_fragment_counts_store(fnam)
+    crm_ids = {}
     fhandler = open(fnam)
-    line = fhandler.next()
+    line = fhandler.readline()
     while line.startswith('#'):
-        line = fhandler.next()
-    try:
-        while True:
-            _, cr1, _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
-            try:
-                frag_count[(cr1, rs1)] += 1
-            except KeyError:
-                frag_count[(cr1, rs1)] = 1
-            try:
-                frag_count[(cr2, rs2)] += 1
-            except KeyError:
-                frag_count[(cr2, rs2)] = 1
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    return frag_count
+        if line.startswith('# CRM '):
+            crm_ids.setdefault(line[6:].split()[0], len(crm_ids))
+        line = fhandler.readline()
+    counted = []
+    for block in read_blocks(fhandler, line):
+        # chromosomes not in the header are added to crm_ids
+        cols = parse_pairs(block, crm_ids, ['crm1', 'rs1', 'crm2', 'rs2'])
+        for num in '12':
+            counted.append(unique((cols['crm' + num] << 32) | cols['rs' + num],
+                                  return_counts=True))
+        if len(counted) > 32:
+            counted = [merge_re_fragment_counts(counted)]
+    fhandler.close()
+    names = sorted(crm_ids, key=crm_ids.get)
+    return (names, ) + merge_re_fragment_counts(counted)
+
+
+def _re_fragment_counts_store(fnam):
+    store = load_pairs_store(fnam)
+    counted = []
+    for _, block in store.blocks(['crm1', 'beg1', 'crm2', 'beg2']):
+        for num in '12':
+            counted.append(unique((block['crm' + num].astype(int64) << 32) |
+                                  block['beg' + num], return_counts=True))
+        if len(counted) > 32:
+            counted = [merge_re_fragment_counts(counted)]
+    return (list(store.crm_names), ) + merge_re_fragment_counts(counted)
+
+
+def merge_re_fragment_counts(counted):
+    """
+    Sums counts of read ends per RE fragment (as returned by
+    :func:`re_fragment_counts`).
+
+    :param counted: list of tuples with an array of fragment identifiers and
+       an array with the number of read ends in each fragment
+
+    :returns: a sorted array of fragment identifiers, and an array with the
+       number of read ends in each fragment
+    """
+    if not counted:
+        return array([], dtype=int64), array([], dtype=int64)
+    fragments, ids = unique(concatenate([frags for frags, _ in counted]),
+                            return_inverse=True)
+    counts = bincount(ids, weights=concatenate([nums for _, nums in counted]),
+                      minlength=len(fragments))
+    return fragments, counts.astype(int64)
+
+
+def save_re_fragment_counts(fnam, names, fragments, counts):
+    """
+    Writes counts of read ends per RE fragment (as returned by
+    :func:`re_fragment_counts`) to a NumPy file, to be loaded with
+    :func:`load_re_fragment_counts`.
+    """
+    savez(fnam, names=array(names, dtype=str), fragments=fragments,
+          counts=counts)
+
+
+def load_re_fragment_counts(fnam):
+    """
+    :param fnam: path to a file written by :func:`save_re_fragment_counts`
+
+    :returns: the list of chromosome names, a sorted array of fragment
+       identifiers, and an array with the number of read ends in each fragment
+    """
+    stored = load(fnam)
+    return stored['names'].tolist(), stored['fragments'], stored['counts']
 
 
 
@@ -52,7 +140,8 @@ def map_re_sites_nochunk(enzyme_name, genome_seq, verbose=False):
     :param enzyme_name: name of the enzyme to map (upper/lower case are
        important)
     :param genome_seq: a dictionary containing the genomic sequence by
-       chromosome
+       chromosome (or a genome store, see
+       :func:`pytadbit.parsers.genome_store.load_genome_store`)
     """
     enzyme      = RESTRICTION_ENZYMES[enzyme_name]
     enz_pattern = compile(enzyme.replace('|', ''))
@@ -93,7 +182,8 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     :param enzyme_name: name of the enzyme to map (upper/lower case are
        important)
     :param genome_seq: a dictionary containing the genomic sequence by
-       chromosome
+       chromosome (or a genome store, see
+       :func:`pytadbit.parsers.genome_store.load_genome_store`)
     :param 100000 frag_chunk: in order to optimize the search for nearby RE
        sites, each chromosome is splitted into chunks.
     """
@@ -140,6 +230,61 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
         print 'Found %d RE sites' % count
     return frags
 
+def re_site_index(enzyme_name, genome_seq, savedir=None, verbose=False):
+    """
+    map all restriction enzyme (RE) sites of a given enzyme in a genome, as
+    :func:`map_re_sites_nochunk` but returning sorted NumPy arrays, to be
+    searched with :func:`nearest_re_sites`.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important)
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome (or a genome store, see
+       :func:`pytadbit.parsers.genome_store.load_genome_store`)
+    :param None savedir: directory where to store the index. The file is named
+       after the enzyme and the checksum of the genome, and is loaded instead
+       of digesting again the genome if it exists.
+
+    :returns: a dictionary with, for each chromosome, an array of the
+       positions of the RE sites (starting by 1 and ending by the length of
+       the chromosome)
+    """
+    if savedir:
+        fnam = path.join(savedir, 're_sites_%s_%s.npz' % (
+            enzyme_name.lower(), genome_checksum(genome_seq)[:10]))
+        if path.exists(fnam):
+            if verbose:
+                print 'Loading RE sites from %s' % fnam
+            stored = load(fnam)
+            offsets = stored['offsets']
+            sites = stored['sites']
+            return dict((crm, sites[offsets[i]:offsets[i + 1]])
+                        for i, crm in enumerate(stored['names'].tolist()))
+    frags = map_re_sites_nochunk(enzyme_name, genome_seq, verbose=verbose)
+    index = dict((crm, array(frags[crm], dtype=int64)) for crm in frags)
+    if savedir:
+        mkdir(savedir)
+        names = frags.keys()
+        savez(fnam, names=array(names),
+              offsets=cumsum([0] + [len(index[crm]) for crm in names]),
+              sites=concatenate([index[crm] for crm in names]))
+    return index
+
+def nearest_re_sites(sites, positions):
+    """
+    Search the RE sites surrounding a list of positions.
+
+    :param sites: sorted array of RE site positions of a chromosome (as
+       returned by :func:`re_site_index`)
+    :param positions: array of positions, should be lower than the last RE
+       site
+
+    :returns: two arrays with the closest upstream RE site (lower or equal)
+       and the closest downstream RE site (greater) of each position
+    """
+    idx = searchsorted(sites, positions, side='right')
+    return sites[maximum(idx - 1, 0)], sites[idx]
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
@@ -155,15 +300,23 @@ def repaired(r_enz):
     return complementary(beg + site[min(len(beg), len(end)) :
                                     max(len(beg), len(end))])
 
-def religated(r_enz):
+def religated(r_enz, r_enz2=None):
     """
     returns the resulting sequence after religation of two digested and repaired
     ends.
+
+    :param r_enz: name of the enzyme that digested the first end
+    :param None r_enz2: name of the enzyme that digested the second end (in
+       experiments with two enzymes), same as r_enz by default
     """
     site = RESTRICTION_ENZYMES[r_enz]
     beg, end = site.split('|')
     site = site.replace('|', '')
-    return beg + site[min(len(beg), len(end)) : max(len(beg), len(end))] + end
+    # digested and filled-in end of the first fragment
+    beg += site[min(len(beg), len(end)) : max(len(beg), len(end))]
+    if r_enz2:
+        end = RESTRICTION_ENZYMES[r_enz2].split('|')[1]
+    return beg + end
 
 
 class RE_dict(dict):
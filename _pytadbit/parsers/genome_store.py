@@ -0,0 +1,217 @@
+"""
+18 Oct 2026
+
+Binary storage of a reference genome, with direct access to each chromosome.
+
+A store is a directory with an index of the chromosomes (name, length and
+offset of the sequence, as in a FASTA index) and the sequences concatenated in
+a NumPy file, either one byte per nucleotide or 2-bit packed:
+
+::
+
+  genome.tdg/
+    index.json
+    sequence.npy     <- nucleotides (4 per byte if 2-bit packed)
+    other_start.npy  <- 2-bit only: start of the stretches of nucleotides
+    other_length.npy    other than A, C, G or T (N, IUPAC codes...)
+    other_char.npy
+
+The sequence file is memory-mapped, only the chromosomes accessed are read
+from disk, and chromosome lengths are available without reading any sequence.
+"""
+
+from os                                   import path
+from collections                          import OrderedDict, Mapping
+from hashlib                              import md5
+from itertools                            import izip
+from json                                 import dump, load as json_load
+from numpy                                import zeros, empty, frombuffer, load
+from numpy                                import flatnonzero, concatenate, diff
+from numpy                                import uint8, int64, array, save
+from numpy.lib.format                     import open_memmap
+from pytadbit.utils.file_handling         import mkdir
+
+_LETTERS = frombuffer('ACGT', dtype=uint8)
+_CODES   = zeros(256, dtype=uint8)
+_CODES[_LETTERS] = range(4)
+_IS_BASE = zeros(256, dtype=bool)
+_IS_BASE[_LETTERS] = True
+
+
+class GenomeStore(Mapping):
+    """
+    Reference genome loaded from a genome store (see
+    :func:`write_genome_store`). Behaves as the dictionary returned by
+    :func:`pytadbit.parsers.genome_parser.parse_fasta`, the sequence of a
+    chromosome being read from disk each time it is accessed.
+
+    :param inpath: path to a genome store
+    :param True mmap: memory-map the sequences instead of loading them
+    """
+    def __init__(self, inpath, mmap=True):
+        index = json_load(open(path.join(inpath, 'index.json')))
+        mmap_mode = 'r' if mmap else None
+        self.path     = inpath
+        self.checksum = index['checksum']
+        self.twobit   = index['twobit']
+        self._chromosomes = OrderedDict(
+            (str(crm), infos) for crm, infos in index['chromosomes'])
+        self._sequence = load(path.join(inpath, 'sequence.npy'),
+                              mmap_mode=mmap_mode)
+        if self.twobit:
+            self._others = [load(path.join(inpath, 'other_%s.npy' % name))
+                            for name in ['start', 'length', 'char']]
+
+    def __getitem__(self, crm):
+        length, offset, beg, end = self._chromosomes[crm]
+        if not self.twobit:
+            return self._sequence[offset:offset + length].tostring()
+        packed = self._sequence[offset:offset + (length + 3) / 4]
+        codes = empty((len(packed), 4), dtype=uint8)
+        for i in xrange(4):
+            codes[:, i] = (packed >> (6 - 2 * i)) & 3
+        chars = _LETTERS[codes.ravel()[:length]]
+        starts, lengths, others = [a[beg:end] for a in self._others]
+        for start, nchars, char in izip(starts, lengths, others):
+            chars[start:start + nchars] = char
+        return chars.tostring()
+
+    def __iter__(self):
+        return iter(self._chromosomes)
+
+    def __len__(self):
+        return len(self._chromosomes)
+
+    def __contains__(self, crm):
+        return crm in self._chromosomes
+
+    def __repr__(self):
+        return 'GenomeStore(%s, %d chromosomes)' % (self.path, len(self))
+
+    def lengths(self):
+        """
+        :returns: an ordered dictionary with the length of each chromosome
+        """
+        return OrderedDict((crm, infos[0])
+                           for crm, infos in self._chromosomes.iteritems())
+
+
+def genome_checksum(genome_seq):
+    """
+    :param genome_seq: a dictionary generated by
+       :func:`pytadbit.parsers.genome_parser.parse_fasta` or a
+       :class:`GenomeStore`
+
+    :returns: MD5 checksum of the chromosome names and sequences
+    """
+    if isinstance(genome_seq, GenomeStore):
+        return genome_seq.checksum
+    checksum = md5()
+    for crm in genome_seq:
+        checksum.update('>%s\n' % crm)
+        checksum.update(genome_seq[crm])
+    return checksum.hexdigest()
+
+
+def chromosome_lengths(genome_seq):
+    """
+    :param genome_seq: a dictionary generated by
+       :func:`pytadbit.parsers.genome_parser.parse_fasta` or a
+       :class:`GenomeStore`
+
+    :returns: an ordered dictionary with the length of each chromosome
+    """
+    if isinstance(genome_seq, GenomeStore):
+        return genome_seq.lengths()
+    return OrderedDict((crm, len(genome_seq[crm])) for crm in genome_seq)
+
+
+def _pack(seq):
+    """
+    2-bit packing of a sequence, other characters than A, C, G and T are
+    returned as stretches of identical characters
+    """
+    chars = frombuffer(seq, dtype=uint8)
+    codes = zeros((len(chars) + 3) / 4 * 4, dtype=uint8)
+    codes[:len(chars)] = _CODES[chars]
+    codes = codes.reshape(-1, 4)
+    packed = ((codes[:, 0] << 6) | (codes[:, 1] << 4) |
+              (codes[:, 2] << 2) |  codes[:, 3])
+    others = flatnonzero(~_IS_BASE[chars])
+    other_chars = chars[others]
+    breaks = flatnonzero((diff(others) != 1) | (diff(other_chars) != 0)) + 1
+    starts = concatenate(([0], breaks)).astype(int64)
+    ends   = concatenate((breaks, [len(others)])).astype(int64)
+    if not len(others):
+        starts = ends = starts[:0]
+    return packed, others[starts], ends - starts, other_chars[starts]
+
+
+def write_genome_store(genome_seq, outpath, twobit=True):
+    """
+    Writes a reference genome into a genome store, to be loaded with
+    :func:`load_genome_store`.
+
+    :param genome_seq: a dictionary generated by
+       :func:`pytadbit.parsers.genome_parser.parse_fasta`
+    :param outpath: path to the store (a directory, created if needed)
+    :param True twobit: pack the sequences using 2 bits per nucleotide
+    """
+    mkdir(outpath)
+    chromosomes = []
+    offset = 0
+    for crm in genome_seq:
+        length = len(genome_seq[crm])
+        chromosomes.append([crm, [length, offset, 0, 0]])
+        offset += (length + 3) / 4 if twobit else length
+    sequence = open_memmap(path.join(outpath, 'sequence.npy'), mode='w+',
+                           dtype=uint8, shape=(offset,))
+    others = [[], [], []]
+    nothers = 0
+    for crm, infos in chromosomes:
+        length, offset = infos[:2]
+        if not twobit:
+            sequence[offset:offset + length] = frombuffer(genome_seq[crm],
+                                                          dtype=uint8)
+            continue
+        packed, starts, lengths, chars = _pack(genome_seq[crm])
+        sequence[offset:offset + len(packed)] = packed
+        for values, array_list in izip((starts, lengths, chars), others):
+            array_list.append(values)
+        infos[2:] = nothers, nothers + len(starts)
+        nothers += len(starts)
+    sequence.flush()
+    del sequence
+    if twobit:
+        for name, arrays, dtype in izip(['start', 'length', 'char'], others,
+                                        [int64, int64, uint8]):
+            values = concatenate(arrays) if arrays else array([], dtype=dtype)
+            save(path.join(outpath, 'other_%s.npy' % name), values.astype(dtype))
+    out = open(path.join(outpath, 'index.json'), 'w')
+    dump({'chromosomes': chromosomes,
+          'twobit'     : twobit,
+          'checksum'   : genome_checksum(genome_seq)}, out)
+    out.close()
+
+
+def load_genome_store(inpath, mmap=True):
+    """
+    Loads a reference genome from a genome store.
+
+    :param inpath: path to a genome store
+    :param True mmap: memory-map the sequences instead of loading them, only the
+       chromosomes accessed are read from disk
+
+    :returns: a :class:`GenomeStore`, that can be used as the dictionary
+       returned by :func:`pytadbit.parsers.genome_parser.parse_fasta`
+    """
+    return GenomeStore(inpath, mmap=mmap)
+
+
+def is_genome_store(inpath):
+    """
+    :returns: True if the path is a genome store
+    """
+    return (path.isdir(inpath) and
+            path.exists(path.join(inpath, 'index.json')) and
+            path.exists(path.join(inpath, 'sequence.npy')))
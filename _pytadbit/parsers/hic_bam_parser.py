@@ -5,9 +5,17 @@ into compressed BAM format.
 """
 
 from pytadbit.utils.file_handling import mkdir
-from cPickle                      import load, dump
+from numpy                        import frombuffer, unique, bincount, ones
+from numpy                        import concatenate, int32, int64, in1d
+from numpy                        import arange, cumsum, load
+from scipy.sparse                 import coo_matrix
+from pytadbit.hic_data            import SparseHiC_data
+from pytadbit.mapping.filter      import flags_column
+from array                        import array
 from time                         import sleep, time
 from collections                  import OrderedDict
+from itertools                    import chain, islice, izip, groupby
+from operator                     import itemgetter
 from pytadbit.utils.extraviews    import nicer
 from warnings                     import warn
 import pysam
@@ -42,49 +50,71 @@ def print_progress(procs):
 
 
 def read_bam_frag(inbam, filter_exclude, sections1, sections2,
-                  resolution, outdir, region, start, end, half=False):
+                  resolution, region, start, end, half=False):
+    """
+    Counts interactions of the reads starting in a given genomic region
+
+    :returns: three numpy arrays with the row index, the column index and the
+       number of interactions of each non-empty cell
+    """
     bamfile = pysam.AlignmentFile(inbam, 'rb')
     refs = bamfile.references
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=start - (1 if start else 0), end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 / resolution)]
-                pos2 = sections2[(crm2, pos2 / resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            try:
-                dico[(pos1, pos2)] += 1
-            except KeyError:
-                dico[(pos1, pos2)] = 1
-        if half:
-            for i, j in dico.keys():
-                if i < j:
-                    del(dico[(i,j)])
-        out = open(os.path.join(outdir, 'tmp_%s:%d-%d.pickle' % (
-            region, start, end)), 'w')
-        dump(dico, out)
-        out.close()
-    except Exception, e:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print e
-        print(exc_type, fname, exc_tb.tb_lineno)
+    rows = array('i')
+    cols = array('i')
+    for r in bamfile.fetch(region=region,
+                           start=start - (1 if start else 0), end=end,  # coords starts at 0
+                           multiple_iterators=True):
+        if r.flag & filter_exclude:
+            continue
+        crm1 = r.reference_name
+        pos1 = r.reference_start + 1
+        # reads overlapping the region, but starting in the previous one
+        if not start <= pos1 <= end:
+            continue
+        crm2 = refs[r.mrnm]
+        pos2 = r.mpos + 1
+        try:
+            pos1 = sections1[(crm1, pos1 / resolution)]
+            pos2 = sections2[(crm2, pos2 / resolution)]
+        except KeyError:
+            continue  # not in the subset matrix we want
+        rows.append(pos1)
+        cols.append(pos2)
+    bamfile.close()
+    return _count_cells(frombuffer(rows, dtype=int32),
+                        frombuffer(cols, dtype=int32),
+                        ones(len(rows), dtype=int32), len(sections2) + 1,
+                        half=half)
+
+
+def _count_cells(rows, cols, counts, ncols, half=False):
+    """
+    Sums the counts falling in the same cell
+
+    :param rows: numpy array of row indexes
+    :param cols: numpy array of column indexes
+    :param counts: numpy array of counts for each row/column pair
+    :param ncols: number of columns of the matrix
+    :param False half: only keep the lower half of the matrix (row >= column)
+
+    :returns: three numpy arrays with the row index, the column index and the
+       number of interactions of each non-empty cell (sorted by row, column)
+    """
+    keys, inverse = unique(rows.astype(int64) * ncols + cols,
+                           return_inverse=True)
+    counts = bincount(inverse, weights=counts).astype(int32)
+    rows, cols = keys // ncols, keys % ncols
+    if half:
+        keep = rows >= cols
+        rows, cols, counts = rows[keep], cols[keep], counts[keep]
+    return rows.astype(int32), cols.astype(int32), counts
 
 
 def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
              region1=None, start1=None, end1=None, verbose=False,
              region2=None, start2=None, end2=None, outdir=None,
-             tmpdir='/tmp/', normalized=False, by_decay=False,
-             get_all_data=False, use_bads=False):
+             normalized=False, by_decay=False,
+             get_all_data=False, use_bads=False, nchunks=100):
     """
     Extracts a (normalized) submatrix at wanted resolution from pseudo-BAM file
 
@@ -103,6 +133,9 @@ def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
     :param False decay: returns the dictionary of Decay normalized matrix (decay
        option can not be used at the same time as normalized option)
     :param False get_all_data:
+    :param 100 nchunks: number of chunks of bins in which the BAM file is
+       read, each chunk being a job (reads are counted in the chunk where they
+       start)
 
     returns: dictionary of interactions. If get_all_data is set to True, returns
        a dictionary with all biases used and bads1 columns (keys of the 
@@ -110,7 +143,6 @@ def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
     """
     if outdir:
         mkdir(outdir)
-    mkdir(tmpdir)
     bamfile = pysam.AlignmentFile(inbam, 'rb')
     sections = OrderedDict(zip(bamfile.references,
                                [x / resolution + 1 for x in bamfile.lengths]))
@@ -125,7 +157,7 @@ def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
         bins.extend([(crm, i) for i in xrange(len_crm + 1)])
 
     start_bin = 0
-    end_bin   = len(bins) + 1
+    end_bin   = len(bins)
     if region1:
         regions = [region1]
         start_bin = [i for i, b in enumerate(bins) if b[0] == region1][0]
@@ -143,36 +175,23 @@ def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
         start1 = 0
     if end1:
         end_bin = section_pos[region1][0] + end1 / resolution
-    else:
-        end = len(bins)
+    elif region1:
         end1 = (section_pos[region1][1] - section_pos[region1][0]) * resolution
 
     total = end_bin - start_bin + 1
     regs  = []
     begs  = []
     ends  = []
-    njobs = min(total, 100) + 1
-    nbins = total / njobs + 1
+    nbins = max(1, total / max(1, nchunks))
     for i in xrange(start_bin, end_bin, nbins):
-        if i + nbins > end_bin:  # make sure that we stop at the right place
-            nbins = end_bin - i
-        try:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[i + nbins - 1]
-        except IndexError:
-            (crm1, beg1), (crm2, fin2) = bins[i], bins[-1]
-        if crm1 != crm2:
-            fin1 = sections[crm1]
-            beg2 = 0
-            regs.append(crm1)
-            regs.append(crm2)
-            begs.append(beg1 * resolution)
-            begs.append(beg2 * resolution)
-            ends.append(fin1 * resolution + resolution)  # last nt included
-            ends.append(fin2 * resolution + resolution - 1)  # last nt not included (overlap with next window)
-        else:
-            regs.append(crm1)
-            begs.append(beg1 * resolution)
-            ends.append(fin2 * resolution + resolution - 1)            
+        # one region per chromosome overlapped by the chunk
+        for crm, crm_bins in groupby(bins[i:min(i + nbins, end_bin)],
+                                     key=itemgetter(0)):
+            crm_bins = list(crm_bins)
+            regs.append(crm)
+            begs.append(crm_bins[0][1] * resolution)
+            # last nt not included (overlap with next window)
+            ends.append(crm_bins[-1][1] * resolution + resolution - 1)
     ends[-1] += 1  # last nucleotide included
     
     # reduce dictionaries
@@ -209,20 +228,31 @@ def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
     if verbose:
         printime('\n  - Parsing BAM (%d chunks)' % (len(regs)))
     procs = []
-    for i, (region, b, e) in enumerate(zip(regs, begs, ends)):
-        if ncpus == 1:
-            read_bam_frag(inbam, filter_exclude,
-                          bins_dict1, bins_dict2,
-                          resolution, tmpdir, region, b, e,)
-        else:
-            procs.append(pool.apply_async(
-                read_bam_frag, args=(inbam, filter_exclude,
-                                     bins_dict1, bins_dict2,
-                                     resolution, tmpdir, region, b, e,)))
-    pool.close()
-    if verbose:
-        print_progress(procs)
-    pool.join()
+    results = []
+    try:
+        for i, (region, b, e) in enumerate(zip(regs, begs, ends)):
+            if ncpus == 1:
+                results.append(read_bam_frag(inbam, filter_exclude,
+                                             bins_dict1, bins_dict2,
+                                             resolution, region, b, e,))
+            else:
+                procs.append(pool.apply_async(
+                    read_bam_frag, args=(inbam, filter_exclude,
+                                         bins_dict1, bins_dict2,
+                                         resolution, region, b, e,)))
+        pool.close()
+        if verbose:
+            print_progress(procs)
+        results.extend(p.get() for p in procs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # reduce counts from all chunks
+    rows, cols, counts = _count_cells(
+        *[concatenate([r[i] for r in results]) for i in xrange(3)],
+        ncols=len(bins_dict2) + 1)
+    del results
 
     if verbose:
         printime('  - Writing matrices')
@@ -318,37 +348,17 @@ def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
         else:
             write = write2matrix
     
-    if verbose:
-        sys.stdout.write('     ')
-    dico = {}
-    for i, (region, start, end) in enumerate(zip(regs, begs, ends)):
-        if not i % 10 and i:
-            if verbose:
-                sys.stdout.write(' ')
-        if not i % 50 and i:
-            if verbose:
-                sys.stdout.write(' %9s\n     ' % ('%s/%s' % (i , len(regs))))
-        if verbose:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        fname = os.path.join(tmpdir, 'tmp_%s:%d-%d.pickle' % (region, start, end))
-        if outdir:
-            dico = load(open(fname))
-            for (j, k), v in dico.iteritems():
-                if j in bads1 or k in bads2:
-                    continue
-                write(j, k, v)
-        else:
-            dico.update(load(open(fname)))
-        os.system('rm -f %s' % (fname))
     if outdir:
+        keep = ~(in1d(rows, bads1.keys()) | in1d(cols, bads2.keys()))
+        for j, k, v in zip(rows[keep].tolist(), cols[keep].tolist(),
+                           counts[keep].tolist()):
+            write(j, k, v)
         out_raw.close()
         if biases:
             out_nrm.close()
             out_dec.close()
-    if verbose:
-        print '%s %9s\n' % (' ' * (54 - (i % 50) - (i % 50) / 10),
-                            '%s/%s' % (len(regs),len(regs)))
+    else:
+        dico = dict(zip(zip(rows.tolist(), cols.tolist()), counts.tolist()))
     if normalized and by_decay:
         warn('WARNING: choose either normalized or by_decay. Using decay normalization')
     if not outdir:
@@ -378,12 +388,51 @@ def read_bam(inbam, filter_exclude, resolution, biases, ncpus=8,
         return dico
         
 
-def bam_to_hic_data(inbam, resolution_list, filter_exclude, filter_include):
+def _bam_chrom_counts(inbam, chrom, resolution, filter_exclude,
+                      filter_include):
     """
-    Load hacked BAM file, into list of hic_data objects (one perc_zero resolution)
+    Counts interactions of the reads mapped on a given chromosome
+
+    :returns: four numpy arrays with the bin of the read on the given
+       chromosome, the index of the chromosome of the other read, the bin of the
+       other read, and the number of interactions of each non-empty cell
+    """
+    bamfile = pysam.AlignmentFile(inbam, 'rb')
+    bins1 = array('i')
+    crms2 = array('i')
+    bins2 = array('i')
+    for r in bamfile.fetch(chrom, multiple_iterators=True):
+        flag = r.flag
+        if flag & filter_exclude or flag & filter_include != filter_include:
+            continue
+        bins1.append((r.reference_start + 1) / resolution)
+        crms2.append(r.next_reference_id)
+        bins2.append((r.next_reference_start + 1) / resolution)
+    ncols = max(bamfile.lengths) / resolution + 1
+    nrefs = len(bamfile.references)
+    bamfile.close()
+    bins1 = frombuffer(bins1, dtype=int32)
+    crms2 = frombuffer(crms2, dtype=int32)
+    bins2 = frombuffer(bins2, dtype=int32)
+    keep = crms2 >= 0  # other read not mapped
+    rows, cols, counts = _count_cells(
+        bins1[keep], crms2[keep].astype(int64) * ncols + bins2[keep],
+        ones(keep.sum(), dtype=int32), nrefs * ncols)
+    return rows, cols / ncols, cols % ncols, counts
+
+
+def bam_to_hic_data(inbam, resolution_list, filter_exclude, filter_include=0,
+                    ncpus=8, verbose=False):
+    """
+    Load hacked BAM file, into list of hic_data objects (one per resolution)
+
+    The BAM file is read only once (in parallel, one chromosome per job),
+    binning reads at the smallest resolution. Matrices at larger resolutions
+    are obtained by summing blocks of bins of this first matrix.
 
     :param inbam: path to a BAM file
-    :param resolution_list: list of reolutions
+    :param resolution_list: list of resolutions, all should be multiples of the
+       smallest one
     :param filter_exclude: filters to exclude expects a number, which in binary would
        correspond to the presence/absence of the filters in the corresponding 
        order:
@@ -398,47 +447,74 @@ def bam_to_hic_data(inbam, resolution_list, filter_exclude, filter_include):
          - duplicated
          - random breaks
          - trans
-    :param filter_include: filters to be included (see doc of filter_exclude param)
- 
-    :returns: a list of HiC_data objects
+    :param 0 filter_include: filters to be included (see doc of filter_exclude
+       param)
+    :param 8 ncpus: number of chromosomes to parse in parallel
+    :param False verbose:
+
+    :returns: a list of :class:`pytadbit.hic_data.SparseHiC_data` objects, in
+       the same order as resolution_list, and the list of their bins (one
+       dictionary per resolution, with (chromosome, bin) as keys and the
+       position of the bin in the matrix as values)
     """
+    finest = min(resolution_list)
+    if any(r % finest for r in resolution_list):
+        raise Exception('ERROR: all resolutions should be multiples of %d' % (
+            finest))
     # open bam file
     bamfile = pysam.AlignmentFile(inbam, "rb")
     # get sections
     sections = OrderedDict(zip(bamfile.references,
                                bamfile.lengths))
-    # init HiC_data objects
-    dat_list = [init_hic_data(bamfile, resolution) for resolution in resolution_list]
-    bin_list = [get_bins(bamfile, resolution) for resolution in resolution_list]
-    # close bam file    
+    # close bam file
     bamfile.close()
-    # access bam file per chromosome
-    for chrom in sections.keys():
-        j = 0
-        print "Processing chromosome " + str(chrom)
-        # read line by line
-        for line in pysam.view("-F", str(filter_exclude),
-                               "-f", str(filter_include),
-                               inbam,
-                               chrom):
-            # get info
-            info = line.strip().split("\t")
-            chrom1 = info[2]
-            pos1 = int(info[3])
-            chrom2 = info[6]
-            pos2 = int(info[7])
-            if chrom2 == "=":
-                chrom2 = chrom1
-            # get bins and add counts
-            try:
-                for i in xrange(len(resolution_list)):
-                    b1 = bin_list[i][(chrom1, int(pos1) / resolution_list[i])]
-                    b2 = bin_list[i][(chrom2, int(pos2) / resolution_list[i])]
-                    dat_list[i][b1, b2] += 1
-            except KeyError:
-                pass
-            j += 1
-        print str(j) + " lines processed"
+    if verbose:
+        printime('\n  - Parsing BAM (%d chromosomes)' % (len(sections)))
+    # chromosome offsets at finest resolution
+    offsets = cumsum([0] + [sections[crm] / finest + 1 for crm in sections])
+    rows, cols, counts = [], [], []
+    pool = mu.Pool(ncpus)
+    try:
+        procs = [pool.apply_async(_bam_chrom_counts,
+                                  args=(inbam, crm, finest, filter_exclude,
+                                        filter_include))
+                 for crm in sections]
+        pool.close()
+        if verbose:
+            print_progress(procs)
+        for i, proc in enumerate(procs):
+            bins1, crms2, bins2, vals = proc.get()
+            rows.append(bins1 + offsets[i])
+            cols.append(offsets[crms2] + bins2)
+            counts.append(vals)
+    finally:
+        pool.terminate()
+        pool.join()
+    rows = concatenate(rows)
+    cols = concatenate(cols)
+    counts = concatenate(counts)
+    if verbose:
+        printime('  - Building matrices')
+    dat_list = []
+    bin_list = []
+    for resolution in resolution_list:
+        factor = resolution / finest
+        genome_seq = OrderedDict((crm, sections[crm] / resolution + 1)
+                                 for crm in sections)
+        # index of each bin of the finest matrix in the current matrix
+        fine2coarse = concatenate([
+            arange(sections[crm] / finest + 1) / factor + beg
+            for crm, beg in zip(sections, cumsum([0] + genome_seq.values()))])
+        size = sum(genome_seq.values())
+        dict_sec = dict(((crm, i), beg + i) for crm, beg in zip(
+            sections, cumsum([0] + genome_seq.values()).tolist())
+                        for i in xrange(genome_seq[crm]))
+        dat_list.append(SparseHiC_data(
+            coo_matrix((counts, (fine2coarse[rows], fine2coarse[cols])),
+                       shape=(size, size)),
+            size, genome_seq, dict_sec, resolution=resolution,
+            symmetricized=True))
+        bin_list.append(dict_sec)
     return dat_list, bin_list
 
 
@@ -505,5 +581,175 @@ def bam_to_2Dbed(inbam, outbed, resolution, filter_exclude=None, filter_include=
     return dat_list, bin_list
 
 
+# filters flagged in BAM files (bit n - 1 for filter n of
+# pytadbit.mapping.filter.filter_reads)
+_BAM_FILTERS = OrderedDict([('self-circle'       , 2**0 ),
+                            ('dangling-end'      , 2**1 ),
+                            ('error'             , 2**2 ),
+                            ('extra-dangling-end', 2**3 ),
+                            ('too-close-from-RES', 2**4 ),
+                            ('too-short'         , 2**5 ),
+                            ('too-large'         , 2**6 ),
+                            ('over-represented'  , 2**7 ),
+                            ('duplicated'        , 2**8 ),
+                            ('random-breaks'     , 2**9 ),
+                            ('trans'             , 2**10)])
+
+# two alignments (one per read-end) of a pair of reads
+_SAM_PAIR = ('%s\t%d\t%s\t%s\t%d\t1M\t%s\t%s\t%s%s\t*\t*\t'
+             'TC:i:%d\tE1:i:%s\tE2:i:%s\tE3:i:%s\tE4:i:%s\n'
+             '%s\t%d\t%s\t%s\t%d\t1M\t%s\t%s\t%s%s\t*\t*\t'
+             'TC:i:%d\tE3:i:%s\tE4:i:%s\tE1:i:%s\tE2:i:%s\n')
+
+
+def bed2D_to_BAMhic(infile, outbam, masked=None, filters=None, ncpus=1,
+                    max_memory='768M'):
+    """
+    Writes the read pairs of a 2D bed into a BAM file sorted by coordinate and
+    indexed, with the filters applied to each pair, to be loaded with
+    :func:`read_bam` or :func:`bam_to_hic_data`. Each pair gives two
+    alignments (one per read-end) with:
+
+      - FLAG: filters applied (bit n - 1 for filter n, see
+        :func:`pytadbit.mapping.filter.filter_reads`), plus 1024 for trans
+        contacts
+      - MAPQ: mapped length of the read-end (at most 255)
+      - RNEXT and PNEXT: position of the other read-end
+      - TLEN: mapped length of the other read-end (negative on the reverse
+        strand)
+      - tags: TC (1 for single contacts, 2 for multi-contacts), and E1 to E4
+        the RE sites around the read-end and around the other read-end
+
+    Filter flags are read from the column of flags written by
+    :func:`pytadbit.mapping.filter.filter_reads` (one per line of the input
+    file) or, without it, merged in a single pass from the files of read IDs
+    of each filter (in the order of the input file).
+    Alignments are written to a temporary SAM file, that is sorted and
+    compressed (with ncpus threads) by samtools (from pysam), the BAM file
+    being indexed afterwards (the index written by samtools sort with several
+    threads is not reliable).
+
+    :param infile: path to a tab separated file of read pairs, generated by
+       :func:`pytadbit.mapping.get_intersection`
+    :param outbam: path to the output BAM file (the index is written to
+       outbam + '.bai')
+    :param None masked: dictionary given by
+       :func:`pytadbit.mapping.filter.filter_reads`. If None, read pairs are
+       written without filter flags
+    :param None filters: list of numbers corresponding to the filters to flag
+       (all by default)
+    :param 1 ncpus: number of threads used to sort and compress
+    :param 768M max_memory: memory used by each thread to sort
+
+    :returns: the number of read pairs written
+    """
+    fhandler = open(infile)
+    tmpsam = outbam + '_unsorted.sam~'
+    out = open(tmpsam, 'w')
+    out.write('@HD\tVN:1.5\tSO:unsorted\n')
+    line = fhandler.readline()
+    while line.startswith('#'):
+        if line.startswith('# CRM '):
+            out.write('@SQ\tSN:%s\tLN:%s\n' % tuple(line[6:].split()))
+        line = fhandler.readline()
+    for name, flag in _BAM_FILTERS.iteritems():
+        out.write('@CO\tfilter:%s\tflag:%d\n' % (name, flag))
+    out.write('@CO\tTC:i\tMulticontact? 1 = no 2 = yes\n'
+              '@CO\tE1:i\tPosition of the left RE site of first read\n'
+              '@CO\tE2:i\tPosition of the right RE site of first read\n'
+              '@CO\tE3:i\tPosition of the left RE site of second read\n'
+              '@CO\tE4:i\tPosition of the right RE site of second read\n')
+    count = 0
+    for line, flag in _flagged_lines(fhandler, line, masked, filters,
+                                     infile):
+        (qname, cr1, pos1, sd1, l1, e1, e2,
+         cr2, pos2, sd2, l2, e3, e4) = line.rstrip('\n').split('\t')
+        if cr1 != cr2:
+            flag |= _BAM_FILTERS['trans']
+        tc = 2 if '~' in qname else 1
+        # MAPQ is stored in 8 bits
+        out.write(_SAM_PAIR % (
+            qname, flag, cr1, pos1, min(int(l1), 255), cr2, pos2,
+            '-' if sd2 == '0' else '', l2, tc, e1, e2, e3, e4,
+            qname, flag, cr2, pos2, min(int(l2), 255), cr1, pos1,
+            '-' if sd1 == '0' else '', l1, tc, e3, e4, e1, e2))
+        count += 1
+    out.close()
+    fhandler.close()
+    pysam.sort('-@', str(ncpus), '-m', max_memory, '-T', outbam + '_sort~',
+               '-o', outbam, tmpsam)
+    os.remove(tmpsam)
+    pysam.index(outbam)
+    return count
+
+
+def _flagged_lines(fhandler, line, masked=None, filters=None, fnam=None):
+    """
+    :param fhandler: file handler of the read pairs, after the header
+    :param line: first line of read pairs
+    :param None fnam: path to the file of read pairs
+
+    :returns: an iterator over each line with the flag of the filters applied
+       to it, from the column of flags if masked has one, otherwise from the
+       files of read IDs
+    """
+    if masked:
+        filters = filters or masked.keys()
+        flags = flags_column(fnam, masked, filters)
+        if flags:
+            return _column_flagged_lines(fhandler, line, flags, filters)
+    return _read_id_flagged_lines(fhandler, line, masked, filters)
 
 
+def _column_flagged_lines(fhandler, line, flags, filters):
+    """
+    Reads the flags of the lines of read pairs, by blocks, from the column of
+    flags written by filter_reads (one per line).
+
+    :yields: each line with the flag of the filters applied to it
+    """
+    flags = load(flags, mmap_mode='r')
+    mask = sum(1 << (k - 1) for k in filters)
+    lines = chain([line] if line else [], fhandler)
+    nlines = 0
+    for block in iter(lambda: list(islice(lines, 1000000)), []):
+        block_flags = (flags[nlines:nlines + len(block)] & mask).tolist()
+        if len(block_flags) < len(block):
+            raise Exception('ERROR: more read pairs than filter flags')
+        for line_flag in izip(block, block_flags):
+            yield line_flag
+        nlines += len(block)
+    if nlines != len(flags):
+        raise Exception('ERROR: less read pairs than filter flags')
+
+
+def _read_id_flagged_lines(fhandler, line, masked=None, filters=None):
+    """
+    Merges the read IDs of each filter with the lines of read pairs. Files of
+    read IDs follow the order of the file of read pairs, only the next read ID
+    of each filter is kept in memory.
+
+    :yields: each line with the flag of the filters applied to it
+    """
+    streams = {}
+    nexts = {}  # next read ID of each filter -> flag of these filters
+    def _next_read(k):
+        try:
+            read = streams[k].next().rstrip('\n')
+        except StopIteration:
+            streams.pop(k).close()
+            return
+        nexts[read] = nexts.get(read, 0) | 2**(k - 1)
+    if masked:
+        for k in filters or masked.keys():
+            streams[k] = open(masked[k]['fnam'])
+            _next_read(k)
+    for line in chain([line] if line else [], fhandler):
+        flag = nexts.pop(line.split('\t', 1)[0], 0) if nexts else 0
+        yield line, flag
+        k = 1
+        while flag:
+            if flag & 1:
+                _next_read(k)
+            flag >>= 1
+            k += 1
@@ -3,11 +3,19 @@ November 7, 2013.
 
 """
 
-from warnings                import warn
-from math                    import sqrt, isnan
-from pytadbit.parsers.gzopen import gzopen
-from collections             import OrderedDict
-from pytadbit                import HiC_data
+from warnings                     import warn
+from math                         import sqrt, isnan
+from pytadbit.parsers.gzopen      import gzopen
+from collections                  import OrderedDict
+from pytadbit                     import HiC_data
+from pytadbit.hic_data            import SparseHiC_data
+from pytadbit.parsers.pairs_store import load_pairs_store, is_pairs_store
+from pytadbit.parsers.pairs_store import parse_region
+from pytadbit.utils.line_blocks   import read_blocks, process_blocks
+from pytadbit.utils.line_blocks   import parse_pairs
+from itertools                    import izip
+from numpy                        import array, cumsum, zeros, int64, unique
+from numpy                        import concatenate, bincount
 
 HIC_DATA = True
 
@@ -382,49 +390,204 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     else:
         return matrices
 
-def load_hic_data_from_reads(fnam, resolution, **kwargs):
+def load_hic_data_from_reads(fnam, resolution, ncpus=1, **kwargs):
     """
-    :param fnam: tsv file with reads1 and reads2
+    :param fnam: tsv file with reads1 and reads2 (or pairs store, see
+       :func:`pytadbit.parsers.pairs_store.write_pairs_store`)
     :param resolution: the resolution of the experiment (size of a bin in
        bases)
+    :param 1 ncpus: number of blocks of the tsv file processed in parallel
     :param genome_seq: a dictionary containing the genomic sequence by
        chromosome
     :param False get_sections: for very very high resolution, when the column
        index does not fit in memory
+    :param False sparse: store interactions in a
+       :class:`pytadbit.hic_data.SparseHiC_data` object (array based, uses
+       much less memory for genome-wide matrices)
+    :param None region1: only count read pairs with one end in this region,
+       given as a chromosome name (e.g. 'chr1') or with positions in bases
+       (e.g. 'chr1:1000000-6000000'), and the other end in region2. With a
+       pairs store, only the pairs of the blocks overlapping the regions are
+       read
+    :param None region2: second region, same as region1 by default
     """
-    sections = []
-    genome_seq = OrderedDict()
+    if is_pairs_store(fnam):
+        return _load_hic_data_from_store(fnam, resolution, **kwargs)
+    lengths = OrderedDict()
     fhandler = open(fnam)
-    line = fhandler.next()
-    size = 0
+    line = fhandler.readline()
     while line.startswith('#'):
         if line.startswith('# CRM '):
             crm, clen = line[6:].split()
-            genome_seq[crm] = int(clen) / resolution + 1
-            size += genome_seq[crm]
-        line = fhandler.next()
-    section_sizes = {}
+            lengths[crm] = int(clen)
+        line = fhandler.readline()
+    imx, dict_sec = _new_hic_data(lengths, resolution, **kwargs)
+    crm_ids = dict((crm, i) for i, crm in enumerate(lengths))
+    regions = _regions(lengths, **kwargs)
+    if regions:
+        regions = tuple((crm_ids[crm], beg, end) for crm, beg, end in regions)
+    params = (crm_ids, regions, _bin_params(lengths, resolution, imx, dict_sec))
+    blocks = process_blocks(_count_block, read_blocks(fhandler, line),
+                            params, ncpus)
+    _set_counts(imx, _sum_blocks(blocks))
+    fhandler.close()
+    imx.symmetricized = True
+    return imx
+
+
+def _new_hic_data(lengths, resolution, **kwargs):
+    """
+    :returns: an empty HiC_data object (or SparseHiC_data) for a genome, and
+       the index of its bins
+    """
+    sections = []
+    genome_seq = OrderedDict((crm, lengths[crm] / resolution + 1)
+                             for crm in lengths)
+    size = sum(genome_seq.values())
     if kwargs.get('get_sections', True):
         for crm in genome_seq:
-            len_crm = genome_seq[crm]
-            section_sizes[(crm,)] = len_crm
-            sections.extend([(crm, i) for i in xrange(len_crm)])
+            sections.extend([(crm, i) for i in xrange(genome_seq[crm])])
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, genome_seq, dict_sec, resolution=resolution)
-    try:
-        while True:
-            _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
-            try:
-                ps1 = dict_sec[(cr1, int(ps1) / resolution)]
-                ps2 = dict_sec[(cr2, int(ps2) / resolution)]
-            except KeyError:
-                ps1 = int(ps1) / resolution
-                ps2 = int(ps2) / resolution
-            imx[ps1, ps2] += 1
-            imx[ps2, ps1] += 1
-            line = fhandler.next()
-    except StopIteration:
-        pass
+    hic_class = SparseHiC_data if kwargs.get('sparse', False) else HiC_data
+    return (hic_class((), size, genome_seq, dict_sec, resolution=resolution),
+            dict_sec)
+
+
+def _regions(lengths, region1=None, region2=None, **kwargs):
+    """
+    :returns: a tuple of the two regions (chromosome, beginning, end) passed
+       as arguments to load_hic_data_from_reads, or None
+    """
+    if not region1:
+        return None
+    region1 = parse_region(region1, lengths)
+    return region1, parse_region(region2, lengths) if region2 else region1
+
+
+def _bin_params(lengths, resolution, imx, dict_sec):
+    """
+    :returns: the parameters needed by _count_bins: number of bins and first
+       bin of each chromosome (plus an empty one for chromosomes not in the
+       header), whether the index of sections is used, size of the matrix and
+       resolution
+    """
+    nbins = array([clen / resolution + 1 for clen in lengths.itervalues()] +
+                  [0], dtype=int64)
+    offsets = cumsum(nbins) - nbins
+    return nbins, offsets, bool(dict_sec), len(imx), resolution
+
+
+def _count_bins(crm1, pos1, crm2, pos2, (nbins, offsets, indexed, size,
+                                         resolution)):
+    """
+    Counts the interactions of read pairs, in both directions
+
+    :returns: the flat positions of the cells of the matrix (row * size +
+       column), sorted, and the number of interactions in each
+    """
+    bin1 = pos1.astype(int64) / resolution
+    bin2 = pos2.astype(int64) / resolution
+    # bins not found in the index of sections are kept without chromosome
+    # offset
+    if indexed:
+        found = (bin1 < nbins[crm1]) & (bin2 < nbins[crm2])
+        bin1 += offsets[crm1] * found
+        bin2 += offsets[crm2] * found
+    cells, inverse = unique(concatenate((bin1 * size + bin2,
+                                         bin2 * size + bin1)),
+                            return_inverse=True)
+    return cells, bincount(inverse)
+
+
+def _in_regions(crm1, pos1, crm2, pos2, (region1, region2)):
+    """
+    :returns: a boolean array, True for read pairs with one end in region1 and
+       the other in region2
+    """
+    def _inside(crm, pos, (rcrm, beg, end)):
+        return (crm == rcrm) & (pos >= beg) & (pos <= end)
+    return ((_inside(crm1, pos1, region1) & _inside(crm2, pos2, region2)) |
+            (_inside(crm1, pos1, region2) & _inside(crm2, pos2, region1)))
+
+
+def _count_block((block, (crm_ids, regions, params))):
+    """
+    Counts the interactions of a block of lines of a tsv file of read pairs
+
+    :returns: the output of _count_bins
+    """
+    columns = ['crm1', 'pos1', 'crm2', 'pos2']
+    # chromosomes not in the header are after the last one
+    cols = parse_pairs(block, crm_ids, columns, missing=len(crm_ids))
+    crm1, pos1, crm2, pos2 = [cols[c] for c in columns]
+    if regions:
+        keep = _in_regions(crm1, pos1, crm2, pos2, regions)
+        crm1, pos1, crm2, pos2 = crm1[keep], pos1[keep], crm2[keep], pos2[keep]
+    return _count_bins(crm1, pos1, crm2, pos2, params)
+
+
+def _sum_counts(counted):
+    """
+    :param counted: list of outputs of _count_bins
+
+    :returns: the same with the counts of each cell summed
+    """
+    if len(counted) == 1:
+        return counted[0]
+    cells, inverse = unique(concatenate([c for c, _ in counted]),
+                            return_inverse=True)
+    counts = concatenate([n for _, n in counted])
+    return cells, bincount(inverse, weights=counts).astype(int64)
+
+
+def _sum_blocks(blocks, max_size=10000000):
+    """
+    Sums the counts of blocks of read pairs (outputs of _count_bins), merging
+    them whenever the cells stored are more than twice the cells counted so
+    far (plus max_size)
+    """
+    counted = [(zeros(0, dtype=int64), zeros(0, dtype=int64))]
+    total = 0
+    for cells, counts in blocks:
+        counted.append((cells, counts))
+        total += len(cells)
+        if total > 2 * len(counted[0][0]) + max_size:
+            counted = [_sum_counts(counted)]
+            total = len(counted[0][0])
+    return _sum_counts(counted)
+
+
+def _set_counts(imx, (cells, counts)):
+    """
+    Stores the interactions counted in an empty HiC_data object
+    """
+    if len(cells) and cells[-1] > len(imx)**2:
+        raise IndexError('ERROR: position %d larger than %s^2' % (
+            cells[-1], len(imx)))
+    if isinstance(imx, SparseHiC_data):
+        imx._set_arrays(cells, counts)
+    else:
+        dict.update(imx, izip(cells.tolist(), counts.tolist()))
+
+
+def _load_hic_data_from_store(fnam, resolution, **kwargs):
+    """
+    load_hic_data_from_reads from a pairs store, counting interactions by
+    blocks of read pairs
+    """
+    store = load_pairs_store(fnam)
+    imx, dict_sec = _new_hic_data(store.chromosomes, resolution, **kwargs)
+    params = _bin_params(store.chromosomes, resolution, imx, dict_sec)
+    columns = ['crm1', 'pos1', 'crm2', 'pos2']
+    if kwargs.get('region1'):
+        rows = store.region_rows(kwargs['region1'], kwargs.get('region2'))
+        blocks = (dict((c, store.column(c)[rows[beg:beg + 1000000]])
+                       for c in columns)
+                  for beg in xrange(0, len(rows), 1000000))
+    else:
+        blocks = (block for _, block in store.blocks(columns))
+    _set_counts(imx, _sum_blocks(
+        _count_bins(*([block[c] for c in columns] + [params]))
+        for block in blocks))
     imx.symmetricized = True
     return imx
-
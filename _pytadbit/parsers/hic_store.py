@@ -0,0 +1,162 @@
+"""
+18 Oct 2026
+
+Binary storage of Hi-C matrices, with random access to any region.
+
+A store is a directory with one sub-directory per resolution, each containing
+the matrix in Compressed Sparse Row format (one NumPy file per array), and
+optionally the biases, the filtered columns and the expected values:
+
+::
+
+  store.tds/
+    index.json
+    10000/
+      indptr.npy   <- index of the first value of each row
+      indices.npy  <- column of each value
+      data.npy     <- interaction counts
+      bias.npy
+      bads.npy
+      expected.npy
+    100000/
+      ...
+
+Arrays are memory-mapped when loading, so that extracting a region only reads
+from disk the rows of this region.
+"""
+
+from os                           import path
+from collections                  import OrderedDict
+from json                         import dump, load as json_load
+from numpy                        import save, load, array, int32, int64, isnan
+from pytadbit.utils.file_handling import mkdir
+from pytadbit.hic_data            import SparseHiC_data
+
+
+def write_hic_store(hic_data, outpath):
+    """
+    Writes a HiC_data object into a matrix store. Several resolutions can be
+    kept in a same store, writing a HiC_data at a resolution already stored
+    replaces it.
+
+    :param hic_data: HiC_data object (with chromosomes defined)
+    :param outpath: path to the store (a directory, created if needed)
+    """
+    mkdir(outpath)
+    index_path = path.join(outpath, 'index.json')
+    if path.exists(index_path):
+        index = json_load(open(index_path))
+    else:
+        index = {'resolutions': {}}
+    reso_dir = path.join(outpath, str(hic_data.resolution))
+    mkdir(reso_dir)
+    csr = hic_data.get_hic_data_as_csr()
+    csr.sort_indices()
+    data = csr.data
+    if isinstance(hic_data, SparseHiC_data):
+        data = data.astype(hic_data.dtype)
+    elif (data >= 0).all() and (data == data.round()).all():
+        data = data.astype('uint32')
+    save(path.join(reso_dir, 'indptr.npy'), csr.indptr.astype(int64))
+    save(path.join(reso_dir, 'indices.npy'), csr.indices.astype(int32))
+    save(path.join(reso_dir, 'data.npy'), data)
+    size = len(hic_data)
+    extras = {}
+    if hic_data.bias:
+        extras['bias'] = array([hic_data.bias.get(i, float('nan'))
+                                for i in xrange(size)])
+    if hic_data.bads:
+        extras['bads'] = array(sorted(hic_data.bads), dtype=int64)
+    if hic_data.expected:
+        extras['expected'] = array([hic_data.expected[i]
+                                    for i in xrange(len(hic_data.expected))])
+    for name in ['bias', 'bads', 'expected']:
+        if name in extras:
+            save(path.join(reso_dir, name + '.npy'), extras[name])
+    if hic_data.chromosomes:
+        chromosomes = hic_data.chromosomes.items()
+    else:
+        chromosomes = [(None, size)]
+    index['resolutions'][str(hic_data.resolution)] = {
+        'chromosomes'  : chromosomes,
+        'symmetricized': hic_data.symmetricized,
+        'extras'       : sorted(extras)}
+    # parameters of the expected counts, to reuse them once loaded
+    key = getattr(hic_data, '_expected_key', None)
+    if 'expected' in extras and key and key[0] == frozenset(hic_data.bads):
+        index['resolutions'][str(hic_data.resolution)][
+            'expected_params'] = list(key[1:])
+    out = open(index_path, 'w')
+    dump(index, out)
+    out.close()
+
+
+def store_resolutions(inpath):
+    """
+    :param inpath: path to a matrix store
+
+    :returns: the list of resolutions available in a matrix store
+    """
+    index = json_load(open(path.join(inpath, 'index.json')))
+    return sorted(int(r) for r in index['resolutions'])
+
+
+def load_hic_store(inpath, resolution=None, mmap=True):
+    """
+    Loads a HiC_data object from a matrix store.
+
+    :param inpath: path to a matrix store
+    :param None resolution: resolution to load, can be omitted if only one is
+       stored
+    :param True mmap: memory-map the matrix instead of loading it, only the
+       regions accessed are read from disk
+
+    :returns: a :class:`pytadbit.hic_data.SparseHiC_data` object
+    """
+    index = json_load(open(path.join(inpath, 'index.json')))
+    if resolution is None:
+        if len(index['resolutions']) > 1:
+            raise Exception('ERROR: several resolutions stored (%s), choose one'
+                            % (', '.join(map(str, store_resolutions(inpath)))))
+        resolution = int(index['resolutions'].keys()[0])
+    try:
+        infos = index['resolutions'][str(resolution)]
+    except KeyError:
+        raise KeyError('ERROR: resolution %s not found in store, use: %s' % (
+            resolution, ', '.join(map(str, store_resolutions(inpath)))))
+    reso_dir = path.join(inpath, str(resolution))
+    mmap_mode = 'r' if mmap else None
+    indptr, indices, data = [load(path.join(reso_dir, name + '.npy'),
+                                  mmap_mode=mmap_mode)
+                             for name in ['indptr', 'indices', 'data']]
+    chromosomes = OrderedDict((crm if crm is None else str(crm), nbins)
+                              for crm, nbins in infos['chromosomes'])
+    size = sum(chromosomes.values())
+    if None in chromosomes:
+        chromosomes = None
+        dict_sec = {}
+    else:
+        dict_sec = {}
+        total = 0
+        for crm in chromosomes:
+            dict_sec.update(((crm, i), total + i)
+                            for i in xrange(chromosomes[crm]))
+            total += chromosomes[crm]
+    hic_data = SparseHiC_data((), size, chromosomes, dict_sec,
+                              resolution=resolution,
+                              symmetricized=infos['symmetricized'],
+                              dtype=data.dtype,
+                              csr_arrays=(indptr, indices, data))
+    if 'bias' in infos['extras']:
+        hic_data.bias = dict((i, b) for i, b in enumerate(
+            load(path.join(reso_dir, 'bias.npy')).tolist()) if not isnan(b))
+    if 'bads' in infos['extras']:
+        hic_data.bads = dict((b, True) for b in
+                             load(path.join(reso_dir, 'bads.npy')).tolist())
+    if 'expected' in infos['extras']:
+        hic_data.expected = dict(enumerate(
+            load(path.join(reso_dir, 'expected.npy')).tolist()))
+        if 'expected_params' in infos:
+            hic_data._expected_key = ((frozenset(hic_data.bads),)
+                                      + tuple(infos['expected_params']))
+    return hic_data
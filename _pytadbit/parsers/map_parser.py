@@ -3,16 +3,19 @@
 """
 
 from pytadbit.utils.file_handling         import magic_open
-from bisect                               import bisect_right as bisect
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import re_site_index, nearest_re_sites
+from pytadbit.parsers.genome_store        import chromosome_lengths
 from warnings                             import warn
-from sys                                  import stdout
+from pytadbit.utils.extsort               import sorted_runs, merge_runs
 from subprocess                           import Popen
+from itertools                            import izip
+from numpy                                import array, zeros, unique, int64
+import multiprocessing as mu
 import os
 
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              **kwargs):
+              ncpus=None, **kwargs):
     """
     Parse map files
 
@@ -33,12 +36,18 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param out_file2: path to outfile tab separated format containing mapped
        read2 information
     :param genome_seq: a dictionary generated by :func:`pyatdbit.parser.genome_parser.parse_fasta`.
-       containing the genomic sequence
+       containing the genomic sequence, or a genome store loaded with
+       :func:`pytadbit.parsers.genome_store.load_genome_store`
     :param re_name: name of the restriction enzyme used
     :param True clean: remove temporary files required for indentification of
        multiple-contacts
+    :param None ncpus: number of processes used to parse input files (and
+       sort their reads) and to merge the reads of each read-end (all available
+       CPUs by default)
     :param False compress: compress (gzip) input map files. This is done in the
        background while next MAP files are parsed, or while files are sorted.
+    :param None re_index_dir: directory where to store the RE sites of the
+       genome, reused by the following parsings of the same genome and enzyme
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -51,11 +60,10 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    re_index = re_site_index(re_name, genome_seq, verbose=verbose,
+                             savedir=kwargs.get('re_index_dir', None))
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -70,23 +78,28 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
 
     # max number of reads per intermediate files for sorting
     max_size = 1000000
-    
+    ncpus = ncpus or mu.cpu_count()
+
+    # parse and sort chunks of reads, input files processed in parallel
+    if verbose:
+        print 'Loading and sorting reads'
+    jobs = [(fnam, _tmp_name(outfiles[read], nfile))
+            for read in range(len(fnames))
+            for nfile, fnam in enumerate(fnames[read])]
+    results = iter(sorted_runs(_map_reader, jobs, key=read_id,
+                               max_size=max_size, ncpus=ncpus,
+                               re_index=re_index))
     windows = {}
     multis  = {}
     procs   = []
+    runs    = {}
     for read in range(len(fnames)):
-        if verbose:
-            print 'Loading read' + str(read + 1)
         windows[read] = {}
+        runs[read]    = []
         num = 0
-        # iteration over reads
-        nfile = 0
-        tmp_files = []
-        reads     = []
         for fnam in fnames[read]:
-            try:
-                fhandler = magic_open(fnam)
-            except IOError:
+            result = results.next()
+            if result is None:
                 warn('WARNING: file "%s" not found\n' % fnam)
                 continue
             # get the iteration number of the iterative mapping
@@ -94,146 +107,108 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 num = int(fnam.split('.')[-1].split(':')[0])
             except:
                 num += 1
-            # set read counter
-            if verbose:
-                print 'loading file: %s' % (fnam)
-            # start parsing
-            read_count = 0
-            try:
-                while not False:
-                    for _ in xrange(max_size):
-                        try:
-                            reads.append(read_read(fhandler.next(), frags,
-                                                   frag_chunk))
-                        except KeyError:
-                            # Chromosome not in hash
-                            continue
-                        read_count += 1
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            except StopIteration:
-                fhandler.close()
-                nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            windows[read][num] = read_count
+            runs[read].extend(result[0])
+            windows[read][num] = result[1]
             if kwargs.get('compress', False) and fnam.endswith('.map'):
                 print 'compressing input MAP file'
                 procs.append(Popen(['gzip', fnam]))
-        nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-        
-        if verbose:
-            print 'Getting Multiple contacts'
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
-
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = tmp_reads_fh.next()
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                multis[read] += 1
-                prev_read =  prev_read.strip() + '|||' + read_line
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+    # merge sorted chunks of both read-ends in parallel, and write them
+    if verbose:
+        print 'Merge sort and getting Multiple contacts'
+    jobs = [(outfiles[read], runs[read], _header(genome_seq, windows[read]),
+             clean) for read in range(len(fnames))]
+    if ncpus > 1 and len(jobs) > 1:
+        pool = mu.Pool(len(jobs))
+        multis = dict(enumerate(pool.map(write_reads, jobs)))
+        pool.close()
+        pool.join()
+    else:
+        multis = dict(enumerate(map(write_reads, jobs)))
     # wait for compression to finish
     for p in procs:
         p.communicate()
     return windows, multis
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
-    out.close()
-    del(reads[:]) # empty list
+def read_id(line):
+    """
+    :returns: the identifier of the read in a line of parsed reads (without
+       the number of the fragment of multiple contacts)
+    """
+    return line.split('\t', 1)[0].split('~')[0]
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
+def _tmp_name(outfile, nfile):
+    dirname, basename = os.path.split(outfile)
+    return os.path.join(dirname, 'tmp_%03d_%s' % (nfile, basename))
+
+def _header(genome_seq, windows):
+    ## Also pipe file header
+    # chromosome sizes (in order)
+    header = '# Chromosome lengths (order matters):\n'
+    for crm, length in chromosome_lengths(genome_seq).iteritems():
+        header += '# CRM %s\t%d\n' % (crm, length)
+    header += '# Mapped\treads count by iteration\n'
+    for size in windows:
+        header += '# MAPPED %d %d\n' % (size, windows[size])
+    return header
+
+def write_reads((outfile, runs, header, clean)):
+    """
+    Merges sorted chunks of parsed reads and writes them, joining the
+    fragments of multiple contacts in a single line.
+
+    :returns: the number of multiple contacts
+    """
+    reads = merge_runs(runs, key=read_id, clean=clean)
+    try:
+        read_line = reads.next()
+    except StopIteration:
+        raise StopIteration('ERROR!\n Nothing parsed, check input files and'
+                            ' chromosome names (in genome.fasta and SAM/MAP'
+                            ' files).')
+    reads_fh = open(outfile, 'w')
+    reads_fh.write(header)
+    ## Multicontacts
+    prev_head = read_id(read_line)
+    prev_read = read_line
+    multis = 0
+    for read_line in reads:
+        head = read_id(read_line)
+        if head == prev_head:
+            multis += 1
+            prev_read =  prev_read.strip() + '|||' + read_line
         else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
+            reads_fh.write(prev_read)
+            prev_read = read_line
+        prev_head = head
+    reads_fh.write(prev_read)
+    reads_fh.close()
+    return multis
+
+def _map_reader(fnam, re_index):
+    fhandler = magic_open(fnam)
+    return _map_reads(fhandler, re_index)
 
-def read_read(r, frags, frag_chunk):
+def _map_reads(fhandler, re_index, block=100000):
+    reads = []
+    for line in fhandler:
+        try:
+            reads.append(read_read(line))
+        except KeyError:
+            continue
+        if len(reads) >= block:
+            for read in locate_reads(reads, re_index):
+                yield read
+            del reads[:]
+    fhandler.close()
+    for read in locate_reads(reads, re_index):
+        yield read
+
+def read_read(r):
+    """
+    :returns: read ID, chromosome, position, strand and mapped length of a read
+       in MAP format
+    """
     name, seq, _, _, ali = r.split('\t')[:5]
     try:
         crm, strand, pos = ali.split(':')[:3]
@@ -245,22 +220,49 @@ def read_read(r, frags, frag_chunk):
         pos = int(pos)
     else:
         pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos / frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
+    return name, crm, pos, positive, len_seq
+
+def locate_reads(reads, re_index):
+    """
+    Finds the RE sites surrounding a block of reads.
+
+    :param reads: list of tuples with read ID, chromosome, position, strand and
+       mapped length
+    :param re_index: RE sites of each chromosome, as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.re_site_index`
+
+    :returns: list of lines of parsed reads, reads mapped on chromosomes not
+       in the index are skipped
+    """
+    if not reads:
+        return []
+    names, crms, poss, positives, lens = zip(*reads)
+    poss = array(poss, dtype=int64)
+    lens = array(lens, dtype=int64)
+    prev_re = zeros(len(reads), dtype=int64)
+    next_re = zeros(len(reads), dtype=int64)
+    found   = zeros(len(reads), dtype=bool)
+    uniq_crms, crm_idx = unique(crms, return_inverse=True)
+    for i, crm in enumerate(uniq_crms):
+        try:
+            sites = re_index[crm]
+        except KeyError:
+            # Chromosome not in hash
+            continue
+        sel = crm_idx == i
+        pos = poss[sel]
         # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos / frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+        outside = pos >= sites[-1]
+        if outside.any():
+            if (pos[outside] - sites[-1] >= lens[sel][outside] - 1).any():
+                raise Exception('Read mapped mostly outside ' +
+                                'chromosome\n')
+            pos[outside] = sites[-1] - 1
+            poss[sel] = pos
+        prev_re[sel], next_re[sel] = nearest_re_sites(sites, pos)
+        found[sel] = True
+    return ['%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % read
+            for read, keep in izip(izip(names, crms, poss.tolist(), positives,
+                                        lens.tolist(), prev_re.tolist(),
+                                        next_re.tolist()), found.tolist())
+            if keep]
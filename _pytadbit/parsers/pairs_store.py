@@ -0,0 +1,518 @@
+"""
+18 Oct 2026
+
+Binary storage of read pairs, replacing between the processing steps the tab
+separated files generated by :func:`pytadbit.mapping.get_intersection` (that
+remain available as an export, see :func:`export_pairs_tsv`).
+
+The store of the valid pairs is written, with the filters of each pair, by
+:func:`pytadbit.mapping.filter.apply_filter` (used by tadbit filter) next to
+the tab separated file (see :func:`pairs_store_path`), and is loaded instead of
+this file by tadbit model and tadbit segment.
+
+A store is a directory with one binary file per column:
+
+::
+
+  reads.tdp/
+    index.json      <- chromosomes, data type of each column, chunks
+    names.bin       <- read names, concatenated
+    name_ends.bin   <- end of each read name in names.bin
+    crm1.bin        <- chromosome of read 1 (index in the list of chromosomes)
+    pos1.bin        <- position of read 1
+    len1.bin        <- mapped length of read 1
+    beg1.bin        <- RE site before read 1
+    end1.bin        <- RE site after read 1
+    crm2.bin ...    <- same for read 2
+    strands.bin     <- strand of read 1 (bit 1) and of read 2 (bit 2)
+    filters.bin     <- bitmask of the filters applying to each pair (bit n - 1
+                       for filter n, see :func:`pytadbit.mapping.filter.filter_reads`)
+    block_keys.bin  <- 2D index: blocks of the genome containing pairs
+    block_ends.bin     end of each block in block_rows.bin
+    block_rows.bin     index of the pairs of each block
+
+Columns are memory-mapped when loading, and read by blocks of pairs (one block
+per chunk of the store, 1 million pairs by default) as NumPy arrays.
+
+The 2D index groups pairs by blocks of the genome (1 Mb by default for each
+end, see :func:`index_pairs_store`), so that only the pairs of the blocks
+overlapping a region are read to load the interactions of this region.
+"""
+
+from os                           import path
+from collections                  import OrderedDict
+from json                         import dump, load as json_load
+from numpy                        import memmap, fromstring, array, zeros
+from numpy                        import int8, int16, int32, int64, uint8
+from numpy                        import uint16, uint32, cumsum, concatenate
+from numpy                        import unique, searchsorted, bincount, arange
+from numpy                        import minimum, maximum
+from pytadbit.utils.file_handling import mkdir, magic_open
+from pytadbit.utils.line_blocks   import parse_pairs
+
+# columns of each read, with their type in the store
+_POSITIONS = OrderedDict([('pos', uint32), ('len', int32), ('beg', uint32),
+                          ('end', uint32)])
+COLUMNS = (['crm1'] + [c + '1' for c in _POSITIONS] +
+           ['crm2'] + [c + '2' for c in _POSITIONS] + ['strands', 'filters'])
+
+
+def _crm_dtype(nchrom):
+    for dtype in (int8, int16, int32):
+        if nchrom <= 2**(8 * dtype().itemsize - 1):
+            return dtype
+
+
+def parse_region(region, chromosomes):
+    """
+    :param region: chromosome name (e.g. 'chr1'), region with positions in
+       bases, both included (e.g. 'chr1:1000000-6000000'), or tuple of
+       chromosome name, beginning and end
+    :param chromosomes: dictionary with the length of each chromosome
+
+    :returns: tuple with chromosome name, beginning and end of the region
+    """
+    if isinstance(region, tuple):
+        crm, beg, end = region
+    else:
+        crm, _, coords = region.partition(':')
+        if coords:
+            beg, end = [int(c) for c in coords.replace(',', '').split('-')]
+        else:
+            beg, end = 0, None
+    if crm not in chromosomes:
+        raise Exception('ERROR: chromosome %s not found' % crm)
+    if end is None:
+        end = chromosomes[crm]
+    return crm, beg, end
+
+
+def _block_offsets(chromosomes, block_size):
+    """
+    :returns: an array with the first block of each chromosome, and the total
+       number of blocks
+    """
+    return concatenate(([0], cumsum([clen / block_size + 1 for clen in
+                                     chromosomes.itervalues()]))).astype(int64)
+
+
+def _block_keys(offsets, block_size, crm1, pos1, crm2, pos2):
+    """
+    :returns: the key of the block of each pair, the two ends being sorted
+    """
+    bin1 = offsets[crm1] + pos1.astype(int64) // block_size
+    bin2 = offsets[crm2] + pos2.astype(int64) // block_size
+    return minimum(bin1, bin2) * offsets[-1] + maximum(bin1, bin2)
+
+
+class PairsWriter(object):
+    """
+    Writes read pairs into a pairs store, block by block.
+
+    :param outpath: path to the store (a directory, created if needed)
+    :param chromosomes: ordered dictionary with the name and length of each
+       chromosome
+    :param 1000000 chunk_size: number of pairs per chunk of the store
+    :param 1000000 block_size: size of the blocks of the 2D index built when
+       closing the store (None to skip it)
+    """
+    def __init__(self, outpath, chromosomes, chunk_size=1000000,
+                 block_size=1000000):
+        mkdir(outpath)
+        self.path        = outpath
+        self.chromosomes = OrderedDict(chromosomes)
+        self.crm_ids     = dict((crm, i) for i, crm in
+                                enumerate(self.chromosomes))
+        self.chunk_size  = chunk_size
+        self.block_size  = block_size
+        self.dtypes      = {'strands': uint8, 'filters': uint16,
+                            'name_ends': int64}
+        for num in '12':
+            self.dtypes['crm' + num] = _crm_dtype(len(self.chromosomes))
+            for col, dtype in _POSITIONS.iteritems():
+                self.dtypes[col + num] = dtype
+        self._files = dict((c, open(path.join(outpath, c + '.bin'), 'wb'))
+                           for c in COLUMNS + ['names', 'name_ends'])
+        self.npairs     = 0
+        self._name_size = 0
+
+    def write(self, names, columns):
+        """
+        :param names: list of read names
+        :param columns: dictionary with an array per column (the filters
+           column is optional)
+        """
+        if not names:
+            return
+        for col in COLUMNS:
+            values = columns.get(col)
+            if values is None:
+                values = zeros(len(names), dtype=self.dtypes[col])
+            array(values, dtype=self.dtypes[col]).tofile(self._files[col])
+        ends = cumsum([len(n) for n in names], dtype=int64) + self._name_size
+        ends.tofile(self._files['name_ends'])
+        self._files['names'].write(''.join(names))
+        self._name_size = int(ends[-1])
+        self.npairs += len(names)
+
+    def write_lines(self, lines, filters=None):
+        """
+        :param lines: list of lines in the tab separated format generated by
+           :func:`pytadbit.mapping.get_intersection`
+        :param None filters: array with the bitmask of the filters applying to
+           each line (none by default)
+        """
+        if not lines:
+            return
+        crm_ids = dict(self.crm_ids)
+        cols = parse_pairs(''.join(lines), crm_ids)
+        if len(crm_ids) > len(self.crm_ids):
+            raise Exception('ERROR: chromosome %s not in header' % (
+                min(set(crm_ids).difference(self.crm_ids))))
+        columns = {'strands': cols['sd1'] | (cols['sd2'] << 1),
+                   'filters': filters}
+        for num in '12':
+            for col in ('crm', 'pos', 'len'):
+                columns[col + num] = cols[col + num]
+            columns['beg' + num] = cols['rs' + num]
+            columns['end' + num] = cols['re' + num]
+        self.write(cols['name'], columns)
+
+    def close(self):
+        for out in self._files.itervalues():
+            out.close()
+        chunks = [[beg, min(beg + self.chunk_size, self.npairs)]
+                  for beg in xrange(0, self.npairs, self.chunk_size)]
+        dump({'chromosomes': self.chromosomes.items(),
+              'npairs'     : self.npairs,
+              'dtypes'     : dict((c, d.__name__)
+                                  for c, d in self.dtypes.iteritems()),
+              'chunks'     : chunks},
+             open(path.join(self.path, 'index.json'), 'w'))
+        if self.block_size:
+            index_pairs_store(self.path, self.block_size)
+
+
+class PairsStore(object):
+    """
+    Read pairs loaded from a pairs store (see :func:`write_pairs_store`).
+
+    :param inpath: path to a pairs store
+    :param True mmap: memory-map the columns instead of loading them
+    """
+    def __init__(self, inpath, mmap=True):
+        index = json_load(open(path.join(inpath, 'index.json')))
+        self.path        = inpath
+        self.mmap        = mmap
+        self.chromosomes = OrderedDict((str(crm), ln)
+                                       for crm, ln in index['chromosomes'])
+        self.crm_names   = self.chromosomes.keys()
+        self.crm_ids     = dict((crm, i) for i, crm in
+                                enumerate(self.crm_names))
+        self.chunks      = [tuple(c) for c in index['chunks']]
+        self.npairs      = index['npairs']
+        self.block_size  = index.get('block_size')
+        self._dtypes     = index['dtypes']
+        self._columns    = {}
+
+    def __len__(self):
+        return self.npairs
+
+    def __repr__(self):
+        return 'PairsStore(%s, %d pairs)' % (self.path, len(self))
+
+    def column(self, name):
+        """
+        :param name: name of the column (see COLUMNS)
+
+        :returns: the values of the column for all the pairs
+        """
+        if name not in self._columns:
+            fnam = path.join(self.path, name + '.bin')
+            dtype = self._dtypes[name]
+            if not self.npairs:
+                self._columns[name] = zeros(0, dtype=dtype)
+            elif self.mmap:
+                self._columns[name] = memmap(fnam, dtype=dtype, mode='r')
+            else:
+                self._columns[name] = fromstring(open(fnam, 'rb').read(),
+                                                 dtype=dtype)
+        return self._columns[name]
+
+    def names(self, beg=0, end=None):
+        """
+        :returns: the list of read names of the pairs from beg to end
+        """
+        end = self.npairs if end is None else end
+        if beg >= end:
+            return []
+        ends = self.column('name_ends')
+        start = int(ends[beg - 1]) if beg else 0
+        ends = ends[beg:end]
+        fhandler = open(path.join(self.path, 'names.bin'), 'rb')
+        fhandler.seek(start)
+        names = fhandler.read(int(ends[-1]) - start)
+        bounds = concatenate(([0], ends - start)).tolist()
+        return [names[bounds[i]:bounds[i + 1]] for i in xrange(end - beg)]
+
+    def blocks(self, columns=None, size=None):
+        """
+        Iterates over the pairs by blocks.
+
+        :param None columns: list of columns to read (see COLUMNS), all by
+           default
+        :param None size: number of pairs per block, by default one block per
+           chunk of the store
+
+        :returns: an iterator over tuples with the index of the first pair of
+           the block, and a dictionary of arrays with the values of each column
+        """
+        columns = columns or COLUMNS
+        if size:
+            bounds = [(beg, min(beg + size, self.npairs))
+                      for beg in xrange(0, self.npairs, size)]
+        else:
+            bounds = self.chunks
+        for beg, end in bounds:
+            yield beg, dict((c, self.column(c)[beg:end]) for c in columns)
+
+    def region_rows(self, region1, region2=None):
+        """
+        Selects the pairs with one end in each region. If the store has a 2D
+        index, only the pairs of the blocks overlapping the regions are read.
+
+        :param region1: chromosome name (e.g. 'chr1'), or region with
+           positions in bases (e.g. 'chr1:1000000-6000000')
+        :param None region2: second region, same as region1 by default
+
+        :returns: a sorted array with the index of the pairs
+        """
+        region1 = parse_region(region1, self.chromosomes)
+        region2 = (region1 if region2 is None else
+                   parse_region(region2, self.chromosomes))
+        if self.block_size:
+            rows = self._block_rows(region1, region2)
+        else:
+            rows = arange(self.npairs)
+        selected = [zeros(0, dtype=int64)]
+        columns = ['crm1', 'pos1', 'crm2', 'pos2']
+        for beg in xrange(0, len(rows), 1000000):
+            sub = rows[beg:beg + 1000000]
+            cols = dict((c, self.column(c)[sub]) for c in columns)
+            inside = {}
+            for num in '12':
+                for reg, (crm, start, end) in enumerate((region1, region2)):
+                    pos = cols['pos' + num]
+                    inside[num, reg] = ((cols['crm' + num] == self.crm_ids[crm])
+                                        & (pos >= start) & (pos <= end))
+            selected.append(sub[(inside['1', 0] & inside['2', 1]) |
+                                (inside['1', 1] & inside['2', 0])])
+        return concatenate(selected)
+
+    def _block_rows(self, region1, region2):
+        """
+        :returns: sorted index of the pairs in the blocks overlapping two
+           regions
+        """
+        offsets = _block_offsets(self.chromosomes, self.block_size)
+        bins = [arange(offsets[self.crm_ids[crm]] + beg // self.block_size,
+                       offsets[self.crm_ids[crm]] + end // self.block_size + 1)
+                for crm, beg, end in (region1, region2)]
+        keys = unique(minimum.outer(*bins) * offsets[-1] +
+                      maximum.outer(*bins))
+        block_keys = self.column('block_keys')
+        block_ends = self.column('block_ends')
+        found = searchsorted(block_keys, keys)
+        keys  = keys[found < len(block_keys)]
+        found = found[found < len(block_keys)]
+        found = found[block_keys[found] == keys]
+        block_rows = self.column('block_rows')
+        rows = [block_rows[int(block_ends[i - 1]) if i else 0:
+                           int(block_ends[i])] for i in found.tolist()]
+        rows = concatenate(rows + [zeros(0, dtype=int64)]).astype(int64)
+        rows.sort()
+        return rows
+
+    def lines(self, beg=0, end=None, mask=None):
+        """
+        :param None mask: boolean array selecting the pairs from beg to end to
+           return
+
+        :returns: the list of pairs from beg to end in the tab separated format
+           generated by :func:`pytadbit.mapping.get_intersection`
+        """
+        end = self.npairs if end is None else end
+        names = self.names(beg, end)
+        cols = dict((c, self.column(c)[beg:end]) for c in COLUMNS)
+        strands = cols['strands']
+        values = [names,
+                  [self.crm_names[c] for c in cols['crm1'].tolist()],
+                  cols['pos1'].tolist(), (strands & 1).tolist(),
+                  cols['len1'].tolist(), cols['beg1'].tolist(),
+                  cols['end1'].tolist(),
+                  [self.crm_names[c] for c in cols['crm2'].tolist()],
+                  cols['pos2'].tolist(), (strands >> 1).tolist(),
+                  cols['len2'].tolist(), cols['beg2'].tolist(),
+                  cols['end2'].tolist()]
+        if mask is not None:
+            keep = mask.nonzero()[0].tolist()
+            values = [[vals[i] for i in keep] for vals in values]
+        return ['%s\t%s\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n' % v
+                for v in zip(*values)]
+
+
+def write_pairs_store(fnam, outpath, chunk_size=1000000, block_size=1000000):
+    """
+    Converts a file of read pairs into a pairs store, to be loaded with
+    :func:`load_pairs_store`.
+
+    :param fnam: path to a tab separated file generated by
+       :func:`pytadbit.mapping.get_intersection`
+    :param outpath: path to the store (a directory, created if needed)
+    :param 1000000 chunk_size: number of pairs per chunk of the store
+    :param 1000000 block_size: size of the blocks of the 2D index (None to
+       skip it)
+
+    :returns: the number of pairs written
+    """
+    fhandler = magic_open(fnam)
+    chromosomes = OrderedDict()
+    lines = []
+    for line in fhandler:
+        if not line.startswith('#'):
+            lines.append(line)
+            break
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split('\t')
+            chromosomes[crm] = int(clen)
+    writer = PairsWriter(outpath, chromosomes, chunk_size=chunk_size,
+                         block_size=block_size)
+    for line in fhandler:
+        lines.append(line)
+        if len(lines) >= chunk_size:
+            writer.write_lines(lines)
+            del lines[:]
+    writer.write_lines(lines)
+    writer.close()
+    fhandler.close()
+    return writer.npairs
+
+
+def index_pairs_store(inpath, block_size=1000000):
+    """
+    Builds the 2D index of a pairs store (done when the store is written).
+    Pairs are grouped by blocks of block_size x block_size bases (the two ends
+    of a pair being sorted, the first being the most upstream), keeping their
+    order inside each block.
+
+    :param inpath: path to a pairs store
+    :param 1000000 block_size: size of the blocks in bases
+    """
+    store = load_pairs_store(inpath)
+    offsets = _block_offsets(store.chromosomes, block_size)
+    columns = ['crm1', 'pos1', 'crm2', 'pos2']
+    # first pass: number of pairs in each block
+    counts = {}
+    for _, block in store.blocks(columns):
+        keys, nums = unique(_block_keys(offsets, block_size,
+                                        *[block[c] for c in columns]),
+                            return_counts=True)
+        for key, num in zip(keys.tolist(), nums.tolist()):
+            counts[key] = counts.get(key, 0) + num
+    keys = array(sorted(counts), dtype=int64)
+    ends = cumsum([counts[k] for k in keys.tolist()], dtype=int64)
+    # second pass: place the index of each pair in its block (counting sort)
+    rows_dtype = uint32 if store.npairs < 2**32 else int64
+    rows_path = path.join(inpath, 'block_rows.bin')
+    if store.npairs:
+        rows = memmap(rows_path, dtype=rows_dtype, mode='w+',
+                      shape=(store.npairs, ))
+    else:
+        open(rows_path, 'wb').close()
+    fill = ends - [counts[k] for k in keys.tolist()]
+    for beg, block in store.blocks(columns):
+        ids = searchsorted(keys, _block_keys(offsets, block_size,
+                                             *[block[c] for c in columns]))
+        order = ids.argsort(kind='mergesort')
+        nums = bincount(ids, minlength=len(keys))
+        firsts = cumsum(nums) - nums
+        sorted_ids = ids[order]
+        rows[fill[sorted_ids] + arange(len(ids)) - firsts[sorted_ids]] = (
+            order + beg)
+        fill += nums
+    if store.npairs:
+        rows.flush()
+        del rows
+    keys.tofile(path.join(inpath, 'block_keys.bin'))
+    ends.tofile(path.join(inpath, 'block_ends.bin'))
+    index_path = path.join(inpath, 'index.json')
+    index = json_load(open(index_path))
+    index['block_size'] = block_size
+    index['dtypes'].update({'block_keys': 'int64', 'block_ends': 'int64',
+                            'block_rows': rows_dtype.__name__})
+    dump(index, open(index_path, 'w'))
+
+
+def load_pairs_store(inpath, mmap=True):
+    """
+    Loads read pairs from a pairs store.
+
+    :param inpath: path to a pairs store
+    :param True mmap: memory-map the columns instead of loading them
+
+    :returns: a :class:`PairsStore`
+    """
+    return PairsStore(inpath, mmap=mmap)
+
+
+def export_pairs_tsv(inpath, outfile, filters=None, reverse=False):
+    """
+    Writes the read pairs of a pairs store in the tab separated format
+    generated by :func:`pytadbit.mapping.get_intersection`.
+
+    :param inpath: path to a pairs store
+    :param outfile: path to the output file
+    :param None filters: list of filters (numbers, see
+       :func:`pytadbit.mapping.filter.filter_reads`), pairs matching any of
+       them are not written
+    :param False reverse: write only the pairs matching the filters
+
+    :returns: the number of pairs written
+    """
+    store = load_pairs_store(inpath)
+    bits = sum(1 << (f - 1) for f in filters or [])
+    out = open(outfile, 'w')
+    for crm, clen in store.chromosomes.iteritems():
+        out.write('# CRM %s\t%d\n' % (crm, clen))
+    count = 0
+    for beg, block in store.blocks(['filters']):
+        end = beg + len(block['filters'])
+        mask = None
+        if bits:
+            mask = (block['filters'] & bits) != 0
+            if not reverse:
+                mask = ~mask
+        lines = store.lines(beg, end, mask=mask)
+        out.write(''.join(lines))
+        count += len(lines)
+    out.close()
+    return count
+
+
+def pairs_store_path(fnam):
+    """
+    :param fnam: path to a tab separated file of read pairs
+
+    :returns: the path of the pairs store written next to this file (see
+       :func:`pytadbit.mapping.filter.apply_filter`)
+    """
+    return path.splitext(fnam)[0] + '.tdp'
+
+
+def is_pairs_store(inpath):
+    """
+    :returns: True if the path is a pairs store
+    """
+    return (path.isdir(inpath) and
+            path.exists(path.join(inpath, 'index.json')) and
+            path.exists(path.join(inpath, 'strands.bin')))
@@ -2,16 +2,17 @@
 17 nov. 2014
 """
 
-from bisect import bisect_right as bisect
 from pysam import Samfile
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import re_site_index
 from warnings import warn
-import os
-from sys import stdout
+from pytadbit.utils.extsort import sorted_runs
+from pytadbit.parsers.map_parser import read_id, write_reads, _tmp_name, _header
+from pytadbit.parsers.map_parser import locate_reads
+import multiprocessing as mu
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
-              mapper=None, **kwargs):
+              mapper=None, ncpus=None, **kwargs):
     """
     Parse sam/bam file using pysam tools.
 
@@ -29,10 +30,16 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param out_file1: path to outfile tab separated format containing mapped
        read2 information
     :param genome_seq: a dictionary generated by :func:`pyatdbit.parser.genome_parser.parse_fasta`.
-       containing the genomic sequence
+       containing the genomic sequence, or a genome store loaded with
+       :func:`pytadbit.parsers.genome_store.load_genome_store`
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param None ncpus: number of processes used to parse input files (and
+       sort their reads) and to merge the reads of each read-end (all available
+       CPUs by default)
+    :param None re_index_dir: directory where to store the RE sites of the
+       genome, reused by the following parsings of the same genome and enzyme
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -45,11 +52,10 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    re_index = re_site_index(re_name, genome_seq, verbose=verbose,
+                             savedir=kwargs.get('re_index_dir', None))
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -64,27 +70,29 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
 
     # max number of reads per intermediate files for sorting
     max_size = 1000000
+    ncpus = ncpus or mu.cpu_count()
 
+    # parse and sort chunks of reads, input files processed in parallel
+    if verbose:
+        print 'Loading and sorting reads'
+    jobs = [(fnam, _tmp_name(outfiles[read], nfile))
+            for read in range(len(fnames))
+            for nfile, fnam in enumerate(fnames[read])]
+    results = iter(sorted_runs(_sam_reader, jobs, key=read_id,
+                               max_size=max_size, ncpus=ncpus,
+                               re_index=re_index, mapper=mapper, verbose=verbose))
     windows = {}
     multis  = {}
-    procs   = []
+    runs    = {}
     for read in range(len(fnames)):
-        if verbose:
-            print 'Loading read' + str(read + 1)
         windows[read] = {}
+        runs[read]    = []
         num = 0
-        # iteration over reads
-        nfile = 0
-        tmp_files = []
-        reads     = []
         for fnam in fnames[read]:
-            try:
-                fhandler = Samfile(fnam)
-            except IOError:
+            result = results.next()
+            if result is None:
                 print 'WARNING: file "%s" not found' % fnam
                 continue
-            except ValueError:
-                raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
             # get the iteration number of the iterative mapping
             try:
                 num = int(fnam.split('.')[-1].split(':')[0])
@@ -92,184 +100,72 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 num += 1
             # set read counter
             windows[read].setdefault(num, 0)
-            # guess mapper used
-            if not mapper:
-                mapper = fhandler.header['PG'][0]['ID']
-            if mapper.lower()=='gem':
-                condition = lambda x: x[1][0][0] != 'N'
-            elif mapper.lower() in ['bowtie', 'bowtie2']:
-                condition = lambda x: 'XS' in dict(x)
-            else:
-                warn('WARNING: unrecognized mapper used to generate file\n')
-                condition = lambda x: x[1][1] != 1
-            if verbose:
-                print 'loading SAM file from %s: %s' % (mapper, fnam)
-            # getrname chromosome names
-            i = 0
-            crm_dict = {}
-            while True:
-                try:
-                    crm_dict[i] = fhandler.getrname(i)
-                    i += 1
-                except ValueError:
-                    break
-            # iteration over reads
-            sub_count = 0  # to empty read buffer
-            for r in fhandler:
-                if r.is_unmapped:
-                    continue
-                if condition(r.tags):
-                    continue
-                positive = not r.is_reverse
-                crm      = crm_dict[r.tid]
-                len_seq  = len(r.seq)
-                if positive:
-                    pos = r.pos + 1
-                else:
-                    pos = r.pos + len_seq
-                try:
-                    frag_piece = frags[crm][pos / frag_chunk]
-                except KeyError:
-                    # Chromosome not in hash
-                    continue
-                idx = bisect(frag_piece, pos)
-                try:
-                    next_re = frag_piece[idx]
-                except IndexError:
-                    # case where part of the read is mapped outside chromosome
-                    count = 0
-                    while idx >= len(frag_piece) and count < len_seq:
-                        pos -= 1
-                        count += 1
-                        frag_piece = frags[crm][pos / frag_chunk]
-                        idx = bisect(frag_piece, pos)
-                    if count >= len_seq:
-                        raise Exception('Read mapped mostly outside ' +
-                                        'chromosome\n')
-                    next_re    = frag_piece[idx]
-                prev_re    = frag_piece[idx - 1 if idx else 0]
-                name       = r.qname
-                reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-                    name, crm, pos, positive, len_seq, prev_re, next_re))
-                windows[read][num] += 1
-                sub_count += 1
-                if sub_count >= max_size:
-                    sub_count = 0
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            nfile += 1
-            write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+            runs[read].extend(result[0])
+            windows[read][num] += result[1]
 
-
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
-        if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
-            if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-        
-        if verbose:
-            print 'Getting Multiple contacts'
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
-
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = tmp_reads_fh.next()
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                multis[read] += 1
-                prev_read =  prev_read.strip() + '|||' + read_line
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
-    # wait for compression to finish
-    for p in procs:
-        p.communicate()
+    # merge sorted chunks of both read-ends in parallel, and write them
+    if verbose:
+        print 'Merge sort and getting Multiple contacts'
+    jobs = [(outfiles[read], runs[read], _header(genome_seq, windows[read]),
+             clean) for read in range(len(fnames))]
+    if ncpus > 1 and len(jobs) > 1:
+        pool = mu.Pool(len(jobs))
+        multis = dict(enumerate(pool.map(write_reads, jobs)))
+        pool.close()
+        pool.join()
+    else:
+        multis = dict(enumerate(map(write_reads, jobs)))
     return windows, multis
 
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
-        return
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
-    out.close()
-    del(reads[:]) # empty list
+def _sam_reader(fnam, re_index, mapper=None, verbose=False):
+    try:
+        fhandler = Samfile(fnam)
+    except ValueError:
+        raise Exception('ERROR: not a SAM/BAM file\n%s' % fnam)
+    return _sam_reads(fhandler, fnam, re_index, mapper, verbose)
 
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
+def _sam_reads(fhandler, fnam, re_index, mapper, verbose, block=100000):
+    # guess mapper used
+    if not mapper:
+        mapper = fhandler.header['PG'][0]['ID']
+    if mapper.lower()=='gem':
+        condition = lambda x: x[1][0][0] != 'N'
+    elif mapper.lower() in ['bowtie', 'bowtie2']:
+        condition = lambda x: 'XS' in dict(x)
+    else:
+        warn('WARNING: unrecognized mapper used to generate file\n')
+        condition = lambda x: x[1][1] != 1
+    if verbose:
+        print 'loading SAM file from %s: %s' % (mapper, fnam)
+    # getrname chromosome names
+    i = 0
+    crm_dict = {}
     while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
+        try:
+            crm_dict[i] = fhandler.getrname(i)
+            i += 1
+        except ValueError:
+            break
+    # iteration over reads
+    reads = []
+    for r in fhandler:
+        if r.is_unmapped:
+            continue
+        if condition(r.tags):
+            continue
+        positive = not r.is_reverse
+        len_seq  = len(r.seq)
+        if positive:
+            pos = r.pos + 1
         else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
+            pos = r.pos + len_seq
+        reads.append((r.qname, crm_dict[r.tid], pos, positive, len_seq))
+        if len(reads) >= block:
+            for read in locate_reads(reads, re_index):
+                yield read
+            del reads[:]
+    fhandler.close()
+    for read in locate_reads(reads, re_index):
+        yield read
@@ -17,6 +17,9 @@ from pytadbit.utils.sqlite_utils  import get_jobid, add_path, get_path_id, print
 from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.mapping.analyze     import insert_sizes
 from pytadbit.mapping.filter      import filter_reads, apply_filter
+from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic
+from pytadbit.parsers.pairs_store import pairs_store_path
+from multiprocessing              import cpu_count
 import sqlite3 as lite
 import time
 
@@ -40,7 +43,8 @@ def run(opts):
 
         # compute the intersection of the two read ends
         print 'Getting intersection between read 1 and read 2'
-        count, multiples = get_intersection(fname1, fname2, reads)
+        count, multiples = get_intersection(fname1, fname2, reads,
+                                            ncpus=opts.cpus)
 
         # compute insert size
         print 'Get insert size...'
@@ -68,19 +72,32 @@ def run(opts):
                               max_frag_size=opts.max_frag_size,
                               min_frag_size=opts.min_frag_size,
                               re_proximity=opts.re_proximity,
-                              min_dist_to_re=min_dist, fast=True)
+                              min_dist_to_re=min_dist, fast=True,
+                              ncpus=opts.cpus)
 
+    # valid pairs also written to an indexed pairs store, to load regions
+    mstore = pairs_store_path(mreads)
     n_valid_pairs = apply_filter(reads, mreads, masked,
-                                 filters=opts.apply)
+                                 filters=opts.apply, pairs_store=mstore)
+
+    # all read pairs, flagged with the filters applied to each
+    bam = None
+    if opts.bam:
+        bam = path.join(opts.workdir, '03_filtered_reads',
+                        'intersection_%s.bam' % param_hash)
+        print 'Writing read pairs and filters to BAM...'
+        bed2D_to_BAMhic(reads, bam, masked, ncpus=opts.cpus or cpu_count())
 
     finish_time = time.localtime()
     print median, max_f, mad
     # save all job information to sqlite DB
     save_to_db(opts, count, multiples, reads, mreads, n_valid_pairs, masked,
-               hist_path, median, max_f, mad, launch_time, finish_time)
+               hist_path, median, max_f, mad, launch_time, finish_time, bam,
+               mstore)
 
 def save_to_db(opts, count, multiples, reads, mreads, n_valid_pairs, masked,
-               hist_path, median, max_f, mad, launch_time, finish_time):
+               hist_path, median, max_f, mad, launch_time, finish_time,
+               bam=None, mstore=None):
     if 'tmpdb' in opts and opts.tmpdb:
         # check lock
         while path.exists(path.join(opts.workdir, '__lock_db')):
@@ -138,6 +155,9 @@ def save_to_db(opts, count, multiples, reads, mreads, n_valid_pairs, masked,
         add_path(cur, mreads, '2D_BED', jobid, opts.workdir)
         add_path(cur,  reads, '2D_BED', jobid, opts.workdir)
         add_path(cur, hist_path, 'FIGURE', jobid, opts.workdir)
+        if bam:
+            add_path(cur, bam, 'HIC_BAM', jobid, opts.workdir)
+        add_path(cur, mstore, 'PAIRS_STORE', jobid, opts.workdir)
         try:
             cur.execute("""
             insert into INTERSECTION_OUTPUTs
@@ -302,6 +322,12 @@ def populate_args(parser):
                         help='''path to working directory (generated with the
                         tool tadbit mapper)''')
 
+    glopts.add_argument('--bam', dest='bam', action='store_true',
+                        default=False,
+                        help='''also write all read pairs, flagged with the
+                        filters applied to each, into a sorted and indexed BAM
+                        file (e.g. to be loaded with bam_to_hic_data)''')
+
     glopts.add_argument('--over_represented', dest='over_represented', metavar="NUM",
                         action='store', default=0.001, type=float,
                         help='''[%(default)s%%] percentage of restriction-enzyme
@@ -324,6 +350,13 @@ def populate_args(parser):
                         help='''[%(default)s] to exclude read-ends falling too
                         close from RE site (pseudo-dangling-ends)''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. If higher
+                        than 1, tasks with multi-threading
+                        capabilities will enabled (if 0 all available)
+                        ''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
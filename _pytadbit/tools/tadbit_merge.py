@@ -19,6 +19,7 @@ from string                       import ascii_letters
 from random                       import random
 from shutil                       import copyfile
 from warnings                     import warn
+from multiprocessing              import cpu_count
 import sqlite3 as lite
 import time
 
@@ -60,10 +61,12 @@ def run(opts):
     if not opts.skip_comparison:
         print 'Comparison'
         print ' - loading first sample', mreads1
-        hic_data1 = load_hic_data_from_reads(mreads1, opts.reso)
+        hic_data1 = load_hic_data_from_reads(mreads1, opts.reso,
+                                             ncpus=opts.cpus or cpu_count())
 
         print ' - loading second sample', mreads2
-        hic_data2 = load_hic_data_from_reads(mreads2, opts.reso)
+        hic_data2 = load_hic_data_from_reads(mreads2, opts.reso,
+                                             ncpus=opts.cpus or cpu_count())
 
         if opts.norm and biases1:
             bad_co1 = path.join(opts.workdir1, bad_co1)
@@ -556,6 +559,13 @@ def populate_args(parser):
                         help='''if provided uses this directory to manipulate the
                         database''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. If higher
+                        than 1, tasks with multi-threading
+                        capabilities will enabled (if 0 all available)
+                        cores will be used''')
+
     parser.add_argument_group(glopts)
 
 
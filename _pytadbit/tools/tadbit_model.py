@@ -19,11 +19,15 @@ from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.sqlite_utils  import get_path_id, add_path, print_db, get_jobid
 from pytadbit.utils.sqlite_utils  import digest_parameters
 from pytadbit                     import load_hic_data_from_reads
+from pytadbit.parsers.hic_store   import load_hic_store
+from pytadbit.parsers.pairs_store import pairs_store_path, is_pairs_store
+from pytadbit.experiment          import load_experiment_from_hic_data
 from pytadbit                     import get_dependencies_version
 from pytadbit.parsers.hic_parser  import optimal_reader
 from itertools                    import product
 from warnings                     import warn
 from numpy                        import arange
+from multiprocessing              import cpu_count
 from cPickle                      import load
 from hashlib                      import md5
 import sqlite3 as lite
@@ -255,17 +259,37 @@ def run(opts):
     # load data
     if opts.matrix:
         crm = load_hic_data(opts)
+        exp = crm.experiments[0]
     else:
-        # FIXME: copied from somewhere else
         (bad_co, bad_co_id, biases, biases_id,
-         mreads, mreads_id, reso) = load_parameters_fromdb(opts)
-        hic_data = load_hic_data_from_reads(mreads, reso)
-        hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
-        hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
-                             for l in open(biases))
-
-    exp = crm.experiments[0]
-    opts.beg, opts.end = opts.beg or 1, opts.end or exp.size
+         mreads, mreads_id, reso, hic_store) = load_parameters_fromdb(opts)
+        if hic_store and path.exists(path.join(opts.workdir, hic_store)):
+            # memory-mapped, only the modelled region is read from disk
+            hic_data = load_hic_store(path.join(opts.workdir, hic_store),
+                                      resolution=reso)
+        else:
+            mreads = path.join(opts.workdir, mreads)
+            # with the pairs store written by tadbit filter, only the blocks
+            # of the region are read
+            if is_pairs_store(pairs_store_path(mreads)):
+                mreads = pairs_store_path(mreads)
+            # only the read pairs of the modelled region are counted (beg and
+            # end are 1-based bins, one more bin is kept after the end)
+            hic_data = load_hic_data_from_reads(
+                mreads, reso,
+                ncpus=opts.cpus or cpu_count(),
+                region1=(opts.crm, max(0, (opts.beg or 0) - 1) * reso,
+                         (opts.end + 1) * reso if opts.end else None))
+            hic_data.bads = dict((int(l.strip()), True) for l in
+                                 open(path.join(opts.workdir, bad_co)))
+            hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
+                                 for l in open(path.join(opts.workdir, biases)))
+        exp = load_experiment_from_hic_data('test', hic_data, opts.crm,
+                                            start=opts.beg or 1,
+                                            end=opts.end or None)
+
+    # bins of the experiment may start after the beginning of the chromosome
+    opts.beg, opts.end = opts.beg or 1, opts.end or exp.size + exp._offset
 
     # prepare output folders
     batch_job_hash = digest_parameters(opts, get_md5=True , extra=[
@@ -740,8 +764,16 @@ def load_parameters_fromdb(opts):
         where NORMALIZE_OUTPUTs.JOBid = %d;
         """ % parse_jobid)
         reso = int(cur.fetchall()[0][0])
+        cur.execute("""
+        select distinct Path from PATHs
+        where paths.jobid = %s and paths.Type = 'HIC_STORE'
+        """ % parse_jobid)
+        try:
+            hic_store = cur.fetchall()[0][0]
+        except IndexError:  # normalized without matrix store
+            hic_store = None
         return (bad_co, bad_co_id, biases, biases_id,
-                mreads, mreads_id, reso)
+                mreads, mreads_id, reso, hic_store)
 
 
 def load_hic_data(opts):
@@ -11,6 +11,9 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.file_handling import mkdir
 from pytadbit.mapping.analyze     import plot_distance_vs_interactions, hic_map
+from pytadbit.parsers.hic_store   import write_hic_store
+from pytadbit.utils.normalize_hic import expected
+from multiprocessing              import cpu_count
 from os                           import path, remove
 from string                       import ascii_letters
 from random                       import random
@@ -32,7 +35,8 @@ def run(opts):
         mreads = path.join(opts.workdir, load_parameters_fromdb(opts))
 
     print 'loading', mreads
-    hic_data = load_hic_data_from_reads(mreads, opts.reso)
+    hic_data = load_hic_data_from_reads(mreads, opts.reso,
+                                        ncpus=opts.cpus or cpu_count())
 
     mkdir(path.join(opts.workdir, '04_normalization'))
 
@@ -59,8 +63,13 @@ def run(opts):
     # Identify biases
     if not opts.filter_only:
         print 'Get biases using ICE...'
-        hic_data.normalize_hic(silent=False, max_dev=0.1, iterations=0,
-                               factor=opts.factor)
+        hic_data.normalize_hic(silent=False, max_dev=0.1,
+                               iterations=opts.iterations, factor=opts.factor)
+
+    # expected interactions per genomic distance, cached in hic_data.expected
+    # and stored with the matrix
+    print 'Get expected counts by genomic distance...'
+    expected(hic_data, bads=hic_data.bads, ncpus=opts.cpus or cpu_count())
 
     print 'Getting cis/trans...'
     cis_trans_N_D = cis_trans_N_d = float('nan')
@@ -107,6 +116,12 @@ def run(opts):
     dump(hic_data, out)
     out.close()
 
+    # and in a memory-mapped store, to load regions of it
+    print ' - Saving genomic matrix store'
+    store_path = path.join(opts.workdir, '04_normalization',
+                           'hic-data_%s_%s.tds' % (nice(opts.reso), param_hash))
+    write_hic_store(hic_data, store_path)
+
     # to feed the save_to_db funciton
     intra_dir_nrm_fig = intra_dir_nrm_txt = None
     inter_dir_nrm_fig = inter_dir_nrm_txt = None
@@ -196,7 +211,7 @@ def run(opts):
                 intra_dir_raw_fig, intra_dir_raw_txt,
                 inter_dir_raw_fig, inter_dir_raw_txt,
                 genom_map_raw_fig, genom_map_raw_txt,
-                pickle_path, launch_time, finish_time)
+                pickle_path, store_path, launch_time, finish_time)
 
 def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                a2, bad_columns_file, bias_file, inter_vs_gcoord, mreads,
@@ -207,7 +222,7 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                intra_dir_raw_fig, intra_dir_raw_txt,
                inter_dir_raw_fig, inter_dir_raw_txt,
                genom_map_raw_fig, genom_map_raw_txt,
-               pickle_path, launch_time, finish_time):
+               pickle_path, store_path, launch_time, finish_time):
     if 'tmpdb' in opts and opts.tmpdb:
         # check lock
         while path.exists(path.join(opts.workdir, '__lock_db')):
@@ -258,6 +273,7 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
             pass
         jobid = get_jobid(cur)
         add_path(cur, pickle_path     , 'PICKLE'     , jobid, opts.workdir)
+        add_path(cur, store_path      , 'HIC_STORE'  , jobid, opts.workdir)
         add_path(cur, bad_columns_file, 'BAD_COLUMNS', jobid, opts.workdir)
         add_path(cur, bias_file       , 'BIASES'     , jobid, opts.workdir)
         add_path(cur, inter_vs_gcoord , 'FIGURE'     , jobid, opts.workdir)
@@ -401,12 +417,25 @@ def populate_args(parser):
                         help='''[%(default)s] normalization(s) to apply.
                         Order matters.''')
 
+    glopts.add_argument('--iterations', dest='iterations', metavar="INT",
+                        action='store', default=0, type=str,
+                        help='''[%(default)s] number of iterations of ICE
+                        normalization. Use "max" to iterate until convergence
+                        (maximum deviation between row sums of 10%%)''')
+
     glopts.add_argument('--factor', dest='factor', metavar="NUM",
                         action='store', default=1, type=float,
                         help='''[%(default)s] target mean value of a cell after
                         normalization (can be used to weight experiments before
                         merging)''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. If higher
+                        than 1, tasks with multi-threading
+                        capabilities will enabled (if 0 all available)
+                        cores will be used''')
+
     glopts.add_argument('-j', '--jobid', dest='jobid', metavar="INT",
                         action='store', default=None, type=int,
                         help='''Use as input data generated by a job with a given
@@ -446,6 +475,9 @@ def populate_args(parser):
 
 def check_options(opts):
 
+    if opts.iterations != 'max':
+        opts.iterations = int(opts.iterations)
+
     # check resume
     if not path.exists(opts.workdir):
         raise IOError('ERROR: wordir not found.')
@@ -9,6 +9,7 @@ information needed
 from argparse                       import HelpFormatter
 from pytadbit                       import get_dependencies_version
 from pytadbit.parsers.genome_parser import parse_fasta
+from pytadbit.parsers.genome_store  import load_genome_store, is_genome_store
 from pytadbit.parsers.map_parser    import parse_map
 from os                             import path, remove
 from string                         import ascii_letters
@@ -55,17 +56,23 @@ def run(opts):
         out_file1 = path.join(opts.workdir, outdir, '%s_r2_%s.tsv' % (name, param_hash))
         
     logging.info('parsing genomic sequence')
-    try:
-        # allows the use of cPickle genome to make it faster
-        genome = load(open(opts.genome[0]))
-    except UnpicklingError:
-        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom)
+    if is_genome_store(opts.genome[0]):
+        # memory-mapped genome, sequences are loaded only when needed
+        genome = load_genome_store(opts.genome[0])
+    else:
+        try:
+            # allows the use of cPickle genome to make it faster
+            genome = load(open(opts.genome[0]))
+        except UnpicklingError:
+            genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom)
 
     if not opts.skip:
         logging.info('parsing reads in %s project', name)
         counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                    out_file2=out_file2, re_name=renz, verbose=True,
-                                   genome_seq=genome, compress=opts.compress_input)
+                                   genome_seq=genome, compress=opts.compress_input,
+                                   ncpus=opts.cpus,
+                                   re_index_dir=path.join(opts.workdir, outdir))
     else:
         counts = {}
         counts[0] = {}
@@ -308,6 +315,13 @@ def populate_args(parser):
                         done. This is done in background, while next MAP file is
                         processed, or while reads are sorted.''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=0, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. If higher
+                        than 1, tasks with multi-threading
+                        capabilities will enabled (if 0 all available)
+                        ''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
@@ -320,7 +334,8 @@ def populate_args(parser):
                         I.e.: --fasta chr_1.fa chr_2.fa
                         In this last case, order is important or the rest of the
                         analysis. Note: it can also be the path to a previously
-                        parsed genome in pickle format.''')
+                        parsed genome in pickle format, or to a genome store
+                        (see pytadbit.parsers.genome_store).''')
 
     glopts.add_argument('--jobids', dest='jobids', metavar="INT",
                         action='store', default=None, nargs='+', type=int,
@@ -12,21 +12,37 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.file_handling import mkdir
 from pytadbit.parsers.tad_parser  import parse_tads
+from pytadbit.parsers.hic_store   import load_hic_store
+from pytadbit.parsers.pairs_store import pairs_store_path, is_pairs_store
 from os                           import path, remove
 from time                         import sleep
 from shutil                       import copyfile
 from string                       import ascii_letters
 from random                       import random
+from multiprocessing              import cpu_count
 import sqlite3 as lite
 import time
 
 DESC = 'Finds TAD or compartment segmentation in Hi-C data.'
 
+def region_to_load(opts):
+    """
+    Only the read pairs of a single chromosome are needed to search its TADs.
+    Compartments are searched on the genome-wide matrix, as the expected
+    decay used to normalize it is computed over all chromosomes.
+
+    :returns: the name of the chromosome to load, or None to load all of them
+    """
+    if opts.only_tads and opts.crms and len(opts.crms) == 1:
+        return opts.crms[0]
+    return None
+
 def run(opts):
     check_options(opts)
     launch_time = time.localtime()
     param_hash = digest_parameters(opts)
 
+    hic_store = None
     if opts.nosql:
         bad_co = opts.bad_co
         biases = opts.biases
@@ -35,7 +51,7 @@ def run(opts):
         inputs = []
     else:
         (bad_co, bad_co_id, biases, biases_id,
-         mreads, mreads_id, reso) = load_parameters_fromdb(opts)
+         mreads, mreads_id, reso, hic_store) = load_parameters_fromdb(opts)
         # store path ids to be saved in database
         inputs = bad_co_id, biases_id, mreads_id
 
@@ -45,18 +61,33 @@ def run(opts):
 
     mkdir(path.join(opts.workdir, '05_segmentation'))
 
-    print 'loading %s \n    at resolution %s' % (mreads, nice(reso))
-    hic_data = load_hic_data_from_reads(mreads, reso)
-    hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
-    print 'loading filtered columns %s' % (bad_co)
-    print '    with %d of %d filtered out columns' % (len(hic_data.bads),
-                                                      len(hic_data))
-    try:
-        hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
-                             for l in open(biases))
-    except IOError:
-        if not opts.only_tads:
+    if hic_store and path.exists(path.join(opts.workdir, hic_store)):
+        hic_store = path.join(opts.workdir, hic_store)
+        print 'loading %s \n    at resolution %s' % (hic_store, nice(reso))
+        hic_data = load_hic_store(hic_store, resolution=reso)
+        print '    with %d of %d filtered out columns' % (len(hic_data.bads),
+                                                          len(hic_data))
+        if not hic_data.bias and not opts.only_tads:
             raise Exception('ERROR: data should be normalized to get compartments')
+    else:
+        # with the pairs store written by tadbit filter, only the blocks of
+        # the chromosome are read
+        if is_pairs_store(pairs_store_path(mreads)):
+            mreads = pairs_store_path(mreads)
+        print 'loading %s \n    at resolution %s' % (mreads, nice(reso))
+        hic_data = load_hic_data_from_reads(
+            mreads, reso, ncpus=opts.cpus or cpu_count(),
+            region1=region_to_load(opts))
+        hic_data.bads = dict((int(l.strip()), True) for l in open(bad_co))
+        print 'loading filtered columns %s' % (bad_co)
+        print '    with %d of %d filtered out columns' % (len(hic_data.bads),
+                                                          len(hic_data))
+        try:
+            hic_data.bias = dict((int(l.split()[0]), float(l.split()[1]))
+                                 for l in open(biases))
+        except IOError:
+            if not opts.only_tads:
+                raise Exception('ERROR: data should be normalized to get compartments')
 
     # compartments
     cmp_result = {}
@@ -250,8 +281,16 @@ def load_parameters_fromdb(opts):
         where NORMALIZE_OUTPUTs.JOBid = %d;
         """ % parse_jobid)
         reso = int(cur.fetchall()[0][0])
+        cur.execute("""
+        select distinct Path from PATHs
+        where paths.jobid = %s and paths.Type = 'HIC_STORE'
+        """ % parse_jobid)
+        try:
+            hic_store = cur.fetchall()[0][0]
+        except IndexError:  # normalized without matrix store
+            hic_store = None
         return (bad_co, bad_co_id, biases, biases_id,
-                mreads, mreads_id, reso)
+                mreads, mreads_id, reso, hic_store)
 
 def populate_args(parser):
     """
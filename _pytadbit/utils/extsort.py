@@ -0,0 +1,135 @@
+"""
+18 Oct 2026
+
+External sort of text files too large to be sorted in memory.
+
+Lines are read in chunks that are sorted in memory and written to temporary
+files (runs), several input files being processed in parallel. The runs are
+then merged in a single pass, keeping only one line per run in memory.
+"""
+
+from heapq import merge
+from os    import remove
+import multiprocessing as mu
+
+_WORKER = {}
+
+
+def write_sorted_run(lines, fnam, key=None):
+    """
+    Sorts a list of lines and writes them to a file. The list is emptied.
+
+    :param lines: list of lines
+    :param fnam: path to the output file
+    :param None key: function returning the sorting key of a line
+
+    :returns: the path to the file written
+    """
+    out = open(fnam, 'w')
+    out.write(''.join(sorted(lines, key=key)))
+    out.close()
+    del lines[:]
+    return fnam
+
+
+def _init_worker(reader, key, kwargs):
+    # set in each process, avoids pickling large arguments (e.g. genome
+    # fragments) with each job
+    _WORKER['reader'] = reader
+    _WORKER['key']    = key
+    _WORKER['kwargs'] = kwargs
+
+
+def _sort_job((infile, prefix, max_size)):
+    try:
+        lines = _WORKER['reader'](infile, **_WORKER['kwargs'])
+    except IOError:
+        return None
+    runs  = []
+    chunk = []
+    count = 0
+    for line in lines:
+        chunk.append(line)
+        count += 1
+        if len(chunk) >= max_size:
+            runs.append(write_sorted_run(chunk, '%s_%03d' % (prefix, len(runs)),
+                                         _WORKER['key']))
+    if chunk:
+        runs.append(write_sorted_run(chunk, '%s_%03d' % (prefix, len(runs)),
+                                     _WORKER['key']))
+    return runs, count
+
+
+def sorted_runs(reader, jobs, key=None, max_size=1000000, ncpus=1, **kwargs):
+    """
+    Reads input files and writes their lines in sorted runs of at most
+    max_size lines. Input files are processed in parallel.
+
+    :param reader: function taking as argument the path to an input file (and
+       kwargs), and returning an iterator over the lines to be sorted. Should
+       raise IOError if the file can not be opened.
+    :param jobs: list of tuples with the path to an input file and the prefix
+       of the paths to its runs
+    :param None key: function returning the sorting key of a line
+    :param 1000000 max_size: maximum number of lines per run
+    :param 1 ncpus: number of input files to process in parallel
+
+    :returns: for each job, a tuple with the list of runs and the number of
+       lines read (None if the input file could not be opened)
+    """
+    jobs = [(infile, prefix, max_size) for infile, prefix in jobs]
+    if ncpus > 1 and len(jobs) > 1:
+        pool = mu.Pool(min(ncpus, len(jobs)), initializer=_init_worker,
+                       initargs=(reader, key, kwargs))
+        results = pool.map(_sort_job, jobs)
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(reader, key, kwargs)
+        results = map(_sort_job, jobs)
+    _WORKER.clear()
+    return results
+
+
+def _keyed_lines(fnam, key, num):
+    for line in open(fnam):
+        yield key(line), num, line
+
+
+def _merge(runs, key):
+    return merge(*[_keyed_lines(fnam, key, num)
+                   for num, fnam in enumerate(runs)])
+
+
+def merge_runs(runs, key=None, clean=True, max_open=256):
+    """
+    K-way merge of sorted runs. Lines with equal keys are returned in the
+    order of the runs.
+
+    :param runs: list of paths to sorted files
+    :param None key: function returning the sorting key of a line
+    :param True clean: remove runs once merged
+    :param 256 max_open: maximum number of runs merged at once, first runs are
+       merged into intermediate runs if there are more
+
+    :returns: an iterator over the sorted lines
+    """
+    key = key or (lambda x: x)
+    runs = list(runs)
+    inputs = list(runs)
+    merged = []
+    while len(runs) > max_open:
+        fnam = '%s_%d' % (runs[0], len(merged))
+        out = open(fnam, 'w')
+        for _, _, line in _merge(runs[:max_open], key):
+            out.write(line)
+        out.close()
+        merged.append(fnam)
+        runs = [fnam] + runs[max_open:]
+    for _, _, line in _merge(runs, key):
+        yield line
+    for fnam in merged:
+        remove(fnam)
+    if clean:
+        for fnam in inputs:
+            remove(fnam)
@@ -347,6 +347,18 @@ def estimate_cardinality(values, k):
         bucket = h & (num_buckets - 1) # Mask out the k least significant bits as bucket ID
         bucket_hash = h >> k
         max_zeroes[bucket] = max(max_zeroes[bucket], _trailing_zeroes(bucket_hash))
+    return cardinality_from_zeroes(max_zeroes)
+
+def cardinality_from_zeroes(max_zeroes):
+    """Estimates the number of unique elements from the maximum number of
+    trailing 0 bits of their hashes, in each bucket (as computed in
+    estimate_cardinality). Buckets can be computed separately for subsets of
+    the elements, and then merged keeping the maximum of each bucket.
+
+    Arguments:
+        max_zeroes: A list with the maximum number of trailing 0 bits in each bucket.
+    """
+    num_buckets = len(max_zeroes)
     return 2 ** (float(sum(max_zeroes)) / num_buckets) * num_buckets * 0.79402
 
 
@@ -0,0 +1,163 @@
+"""
+18 Oct 2026
+
+Multi-resolution access to Hi-C matrices, to draw them at the resolution of
+the image instead of building dense matrices with one cell per bin.
+
+At zoom level L the matrix is summed in blocks of 2**L x 2**L bins. Block sums
+are computed on the fly from the sparse matrix, by square tiles of a fixed
+number of blocks, and the last tiles used are kept in memory.
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+
+def zoom_level(nbins, max_pixels):
+    """
+    :param nbins: number of bins of the region to be drawn
+    :param max_pixels: maximum number of rows (or columns) of the image
+
+    :returns: the lowest zoom level at which the region fits in max_pixels
+       (the number of bins per block being 2**level)
+    """
+    if max_pixels < 1:
+        raise Exception('ERROR: max_pixels should be a positive number')
+    level = 0
+    while -(-nbins // 2 ** level) > max_pixels:
+        level += 1
+    return level
+
+
+class HiCTiles(object):
+    """
+    Tiles of block-summed interaction counts of a Hi-C matrix, kept in a Least
+    Recently Used cache.
+
+    :param hic_data: HiC_data object, or scipy sparse matrix
+    :param False normalized: sum normalized interactions (biases of the
+       HiC_data object should be computed)
+    :param None masked: bins to be removed (e.g. hic_data.bads). Interactions
+       of masked bins are not counted, and blocks made only of masked bins are
+       set to NaN
+    :param 256 tile_size: number of blocks per row (and column) of a tile, at
+       any zoom level
+    :param 64 max_tiles: maximum number of tiles kept in memory; the least
+       recently used tiles are dropped first
+    """
+    def __init__(self, hic_data, normalized=False, masked=None, tile_size=256,
+                 max_tiles=64):
+        bias = None
+        if hasattr(hic_data, 'get_hic_data_as_csr'):
+            if normalized and not hic_data.bias:
+                raise Exception('ERROR: experiment not normalized yet')
+            if normalized:
+                bias = hic_data.bias
+            csr = hic_data.get_hic_data_as_csr()
+        else:
+            if normalized:
+                raise Exception('ERROR: only HiC_data objects can be '
+                                'normalized')
+            csr = hic_data.tocsr()
+        self._csr = csr
+        self.size = csr.shape[0]
+        self._weights = None
+        if bias:
+            self._weights = 1. / np.array([bias[i] for i in xrange(self.size)])
+        self._masked = np.zeros(self.size, dtype=bool)
+        if masked:
+            self._masked[[m for m in masked if m < self.size]] = True
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _block_sum(self, level, beg1, end1, beg2, end2):
+        """
+        sums interactions of rows beg1 to end1 and columns beg2 to end2 in
+        blocks of 2**level bins
+        """
+        fact = 2 ** level
+        sub = self._csr[beg1:end1, beg2:end2].tocoo()
+        rows = sub.row.astype(np.int64) + beg1
+        cols = sub.col.astype(np.int64) + beg2
+        vals = sub.data.astype(float)
+        if self._weights is not None:
+            vals *= self._weights[rows] * self._weights[cols]
+        keep = ~(self._masked[rows] | self._masked[cols])
+        nrows = -(-(end1 - beg1) // fact)
+        ncols = -(-(end2 - beg2) // fact)
+        tile = np.bincount(((rows[keep] - beg1) // fact) * ncols +
+                           (cols[keep] - beg2) // fact, weights=vals[keep],
+                           minlength=nrows * ncols).reshape(nrows, ncols)
+        # empty selections give integers, even with weights
+        tile = tile.astype(float)
+        tile[self._masked_blocks(level, beg1, end1), :] = np.nan
+        tile[:, self._masked_blocks(level, beg2, end2)] = np.nan
+        return tile
+
+    def _masked_blocks(self, level, beg, end):
+        """
+        :returns: for each block between beg and end, True if all its bins
+           are masked
+        """
+        return np.minimum.reduceat(self._masked[beg:end],
+                                   np.arange(0, end - beg, 2 ** level))
+
+    def tile(self, level, beg1, end1, beg2, end2):
+        """
+        :param level: zoom level, interactions being summed in blocks of
+           2**level bins
+        :param beg1: first row (bin) of the tile
+        :param end1: last row (bin, excluded) of the tile
+        :param beg2: first column (bin) of the tile
+        :param end2: last column (bin, excluded) of the tile
+
+        :returns: a numpy array with the block-summed interactions. Blocks
+           start at beg1 and beg2, the last one being smaller if the number
+           of bins is not a multiple of 2**level
+        """
+        key = (level, beg1, end1, beg2, end2)
+        try:
+            tile = self._tiles.pop(key)
+            self.hits += 1
+        except KeyError:
+            tile = self._block_sum(level, beg1, end1, beg2, end2)
+            self.misses += 1
+            while len(self._tiles) >= self.max_tiles:
+                self._tiles.popitem(last=False)
+        self._tiles[key] = tile
+        return tile
+
+    def region(self, start1, end1, start2, end2, level, mean=False):
+        """
+        Assembles the tiles covering a region of the matrix.
+
+        :param start1: first row (bin) of the region
+        :param end1: last row (bin, excluded) of the region
+        :param start2: first column (bin) of the region
+        :param end2: last column (bin, excluded) of the region
+        :param level: zoom level, interactions being summed in blocks of
+           2**level bins
+        :param False mean: return the mean interaction of the bins in each
+           block (masked bins excluded), instead of their sum
+
+        :returns: a numpy array with one cell per block of the region
+        """
+        fact = 2 ** level
+        span = self.tile_size * fact
+        matrix = np.vstack([
+            np.hstack([self.tile(level, beg1, min(beg1 + span, end1),
+                                 beg2, min(beg2 + span, end2))
+                       for beg2 in xrange(start2, end2, span)])
+            for beg1 in xrange(start1, end1, span)])
+        if mean:
+            good = (~self._masked).astype(float)
+            nbins1 = np.add.reduceat(good[start1:end1],
+                                     np.arange(0, end1 - start1, fact))
+            nbins2 = np.add.reduceat(good[start2:end2],
+                                     np.arange(0, end2 - start2, fact))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                matrix = matrix / np.outer(nbins1, nbins2)
+        return matrix
@@ -1,206 +1,252 @@
-from numpy import log, pi as pi_num, exp
+"""
+Gaussian Hidden Markov Models, used to label compartments.
+
+Probabilities are stored in arrays of shape (states, observations). For
+training, the forward-backward passes of all the sequences of observations
+(e.g. one per chromosome) are computed at once, sequences being padded to the
+length of the longest one.
+"""
+
+from numpy import log, pi as pi_num, exp, asarray, zeros, ones
+from numpy import arange, where, errstate
 import sys
 
+
+def _log(values):
+    """
+    log of probabilities, -inf for null or negative values
+    """
+    values = asarray(values, dtype=float)
+    with errstate(divide='ignore', invalid='ignore'):
+        return where(values > 0., log(values), float('-inf'))
+
+
 def best_path(probs, pi, T):
     """
     Viterbi algorithm with backpointers
     """
-    n = len(T)
-    m = len(probs[0])
-    log_V     = [[0. for _ in xrange(m)] for _ in xrange(n)]
-    backpt    = [[0  for _ in xrange(m)] for _ in xrange(n)]
-    states    =  [0  for _ in xrange(m)]
-    log_pi    =  [float('-inf') if pi[i] < 0. else log(pi[i]) for i in xrange(len(pi))]
-    log_T     =  [float('-inf') if T [i] < 0. else log(T[i]) for i in xrange(len(T))]
-    log_probs = [[float('-inf') if probs[i][j] < 0. else log(probs[i][j])
-                  for j in xrange(m)]
-                 for i in xrange(n)]
-    for i in xrange(n):
-        log_V[i][0] = log_probs[i][0] + log_pi[i]
+    log_probs = _log(probs)
+    log_pi    = _log(pi)
+    log_T     = _log(T)
+    n, m = log_probs.shape
+    backpt = zeros((n, m), dtype=int)
+    states = [0 for _ in xrange(m)]
+    log_V = log_probs[:, 0] + log_pi
+    every = arange(n)
     for k in xrange(1, m):
-        for stat in xrange(n):
-            log_V[stat][k] = float('-inf')
-            for prev in xrange(n):
-                # original state prob times transition prob
-                prob = log_V[prev][k-1] + log_T[prev][stat]
-                if prob > log_V[stat][k]:
-                    log_V[stat][k] = prob
-                    backpt[stat][k-1] = prev
-            log_V[stat][k] += log_probs[stat][k]
+        # original state prob times transition prob (rows are previous states)
+        prob = log_V[:, None] + log_T
+        prev = prob.argmax(axis=0)
+        backpt[:, k - 1] = prev
+        log_V = prob[prev, every] + log_probs[:, k]
     # get the likelihood of the most probable path
-    prob = log_V[0][-1]
-    for i in xrange(1, n):
-        if log_V[i][-1] > prob:
-            prob = log_V[i][-1]
-            states[-1] = i
+    states[-1] = int(log_V.argmax())
+    prob = float(log_V[states[-1]])
     # Follow the backtrack: get the path which maximize the path prob.
     for i in xrange(m - 2, -1, -1):
-        states[i] = backpt[states[i + 1]][i]
+        states[i] = int(backpt[states[i + 1], i])
     return states, prob
 
-def baum_welch_optimization(xh, T, E, new_pi, new_T, corrector,
-                            new_E, etas, gammas):
+
+def _pad(observations):
+    """
+    :returns: an array with one row per sequence of observations (padded with
+       zeros), and a boolean array marking actual observations
+    """
+    lengths = [len(obs) for obs in observations]
+    xs = zeros((len(observations), max(lengths)))
+    mask = zeros(xs.shape, dtype=bool)
+    for h, obs in enumerate(observations):
+        xs[h, :lengths[h]] = obs
+        mask[h, :lengths[h]] = True
+    return xs, mask
+
+
+def _batch_gaussian_prob(xs, E):
     """
-    implementation of the baum-welch algorithm
+    gaussian_prob for an array of sequences, shape of the result is
+    (sequences, states, observations)
     """
-    n = len(T)
-    m = len(gammas[0])
-    for i in xrange(n):
-        for j in xrange(n):
-            new_pi[i] += etas[i][j][0]
-    for i in xrange(n):
-        for j in xrange(n):
-            new_T[i][j] += sum(etas[i][j][k] for k in xrange(m - 1))
+    E = asarray(E, dtype=float)
+    mu, sd = E[:, 0], E[:, 1]
+    pi2sd = (2. * pi_num * sd)**-0.5
+    inv2sd = 1. / (2. * sd)
+    return pi2sd[None, :, None] * exp(-(xs[:, None, :] - mu[None, :, None])**2
+                                      * inv2sd[None, :, None])
 
-    for k in xrange(m):
-        for i in xrange(n):
-            gik = gammas[i][k]
-            corrector[i] += gik
-            new_E[i][0] += gik * xh[k]
-            new_E[i][1] += gik * (xh[k] - E[i][0])**2
 
-def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
+def _batch_alpha(probs, mask, pi, T):
     """
-    final round of the baum-welch
+    forward algorithm over an array of sequences
     """
-    ### update initial probabilities
-    n = len(T)
-    total = 0.
-    delta = 0.
-    for i in xrange(n):
-        total += new_pi[i]
-    for i in xrange(n):
-        new_pi[i] /= total
-        delta = max(delta, abs(new_pi[i] - pi[i]))
-        pi[i] = new_pi[i]
-    ### update transitions
-    for i in xrange(n):
-        total = 0.
-        for j in xrange(n):
-            total += new_T[i][j]
-        for j in xrange(n):
-            new_T[i][j] /= total
-            delta = max(delta, abs(new_T[i][j] - T[i][j]))
-            T[i][j] = new_T[i][j]
-    ### update emissions
-    for i in xrange(n):
-        # update the means
-        if corrector[i] > 0.:
-            new_E[i][0] /= corrector[i]
-            new_E[i][1] /= corrector[i]
-            # corrector[i] = 1.
-            delta = max(delta, abs(new_E[i][0] - E[i][0]))
-            E[i][0] = new_E[i][0]
-            # update the stdevs
-            delta = max(delta, abs(new_E[i][1] - E[i][1]))
-            E[i][1] = new_E[i][1]
-    return delta
+    T = asarray(T, dtype=float)
+    nseq, _, m = probs.shape
+    alphas = zeros(probs.shape)
+    scalars = ones((nseq, m))
+    alpha = asarray(pi, dtype=float)[None, :] * probs[:, :, 0]
+    scalars[:, 0] = alpha.sum(axis=1)
+    alphas[:, :, 0] = alpha / scalars[:, 0, None]
+    for k in xrange(1, m):
+        # all transition probabilities to become "i" times previous alpha,
+        # times probablity to belong to this states
+        alpha = alphas[:, :, k - 1].dot(T) * probs[:, :, k]
+        scalars[:, k] = where(mask[:, k], alpha.sum(axis=1), 1.)
+        # null after the end of each sequence
+        alphas[:, :, k] = where(mask[:, k, None],
+                                alpha / scalars[:, k, None], 0.)
+    return alphas, scalars
+
+
+def _batch_beta(probs, mask, T, scalars):
+    """
+    backward algorithm over an array of sequences
+    """
+    T = asarray(T, dtype=float)
+    m = probs.shape[2]
+    # intialize beta at 1.0 (also after the end of each sequence)
+    betas = ones(probs.shape)
+    for k in xrange(m - 2, -1, -1):
+        beta = ((betas[:, :, k + 1] * probs[:, :, k + 1]).dot(T.T)
+                / scalars[:, k + 1, None])
+        betas[:, :, k] = where(mask[:, k + 1, None], beta, 1.)
+    return betas
+
+
+def _batch_eta(probs, mask, T, alphas, betas):
+    """
+    get_eta over an array of sequences, shape of the result is
+    (sequences, states, states, observations - 1)
+    """
+    T = asarray(T, dtype=float)
+    etas = (alphas[:, :, None, :-1] * T[None, :, :, None] *
+            (probs[:, :, 1:] * betas[:, :, 1:])[:, None, :, :])
+    valid = mask[:, 1:]
+    tot = where(valid, etas.sum(axis=(1, 2)), 1.)
+    return etas / tot[:, None, None, :] * valid[:, None, None, :]
 
-def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
-    delta = float('inf')
-    for it in xrange(n_iter):
-        # reset for new iteration
-        new_pi = [0. for _ in pi]
-        new_T  = [[0. for _ in i] for i in T]
-        new_E  = [[0. for _ in i] for i in E]
-        corrector = [0. for _ in xrange(len(T))]
-        for h in xrange(len(observations)):
-            probs  = gaussian_prob(observations[h], E)
-            alphas, scalars = get_alpha(probs, pi, T)
-            betas  = get_beta(probs, T, scalars)
-            etas   = get_eta(probs, T, alphas, betas)
-            gammas = get_gamma(T, alphas, betas)
-            baum_welch_optimization(observations[h], T, E, new_pi, new_T, corrector,
-                                    new_E, etas, gammas)
-        delta = update_parameters(corrector, pi, new_pi, T, new_T, E, new_E)
-        if verbose:
-            print ("\rTraining: %03i/%04i (diff: %.8f)") % (it, n_iter, delta),
-            sys.stdout.flush()
-        if delta <= threshold:
-            break
-    if verbose:
-        print "\n"
 
 def get_eta(probs, T, alphas, betas):
     """
     for Baum-Welch: probability of being in states i and j at times t and t+1
     """
-    n = len(T)
-    m = len(probs[0])
-    etas = [[[0.  for _ in xrange(m - 1)] for _ in xrange(n)] for _ in xrange(n)]
-    for k in xrange(m - 1):
-        tot = 0.
-        for i in xrange(n):
-            for j in xrange(n):
-                etas[i][j][k] += alphas[i][k] * T[i][j] * probs[j][k+1] * betas[j][k+1]
-                tot += etas[i][j][k]
-        for i in xrange(n):
-            for j in xrange(n):
-                etas[i][j][k] /= tot
-    return etas
+    probs = asarray(probs, dtype=float)[None]
+    mask = ones(probs.shape[::2], dtype=bool)
+    return _batch_eta(probs, mask, T, asarray(alphas)[None],
+                      asarray(betas)[None])[0]
+
 
 def get_gamma(T, alphas, betas):
     """
     for Baum-Welch: probability of being in state i at time t
     """
-    n = len(T)
-    m = len(alphas[0])
-    return [[alphas[i][k] * betas[i][k]  for k in xrange(m)] for i in xrange(n)]
+    return asarray(alphas) * asarray(betas)
+
 
 def gaussian_prob(x, E):
     """
     of x to follow the gaussian with given E
     https://en.wikipedia.org/wiki/Normal_distribution
     """
-    probs = []
-    for d, (mu, sd) in enumerate(E):
-        pi2sd = (2. * pi_num * sd)**-0.5
-        inv2sd = 1. / (2. * sd)
-        probs.append([])
-        for obs in x:
-            p = pi2sd * exp(-(obs - mu)**2 * inv2sd)
-            probs[d].append(p)
-    return probs
+    return _batch_gaussian_prob(asarray(x, dtype=float)[None], E)[0]
+
 
 def get_alpha(probs, pi, T):
     """
     computes alphas using forward algorithm
     """
-    n = len(T)
-    m = len(probs[0])
-    alphas = [[0. for _ in xrange(m)] for _ in xrange(n)]
-    scalars = [0. for _ in xrange(m)]
+    probs = asarray(probs, dtype=float)[None]
+    mask = ones(probs.shape[::2], dtype=bool)
+    alphas, scalars = _batch_alpha(probs, mask, pi, T)
+    return alphas[0], scalars[0]
 
-    # initialize alpha for each state
-    for i in xrange(n):
-        alphas[i][0] = pi[i] * probs[i][0]
-        scalars[0] += alphas[i][0]
-    for i in xrange(n):
-        alphas[i][0] /= scalars[0]
-    for k in xrange(1, m):
-        for i in xrange(n):
-            for j in xrange(n):
-                # all transition probabilities to become "i" times previous alpha
-                alphas[i][k] += alphas[j][k-1] * T[j][i]
-            # times probablity to belong to this states
-            alphas[i][k] *= probs[i][k]
-            scalars[k] += alphas[i][k]
-        for i in xrange(n):
-            alphas[i][k] /= scalars[k]
-    return alphas, scalars
 
 def get_beta(probs, T, scalars):
     """
     computes betas using backward algorithm
     """
+    probs = asarray(probs, dtype=float)[None]
+    mask = ones(probs.shape[::2], dtype=bool)
+    return _batch_beta(probs, mask, T, asarray(scalars)[None])[0]
+
+
+def baum_welch_optimization(xh, T, E, new_pi, new_T, corrector,
+                            new_E, etas, gammas):
+    """
+    implementation of the baum-welch algorithm, accumulates in new_pi, new_T,
+    corrector and new_E (arrays) the estimates from one sequence of
+    observations (can also be an array of sequences, with corresponding
+    etas and gammas)
+    """
+    xh = asarray(xh, dtype=float)
+    E = asarray(E, dtype=float)
+    etas = asarray(etas)
+    gammas = asarray(gammas)
+    if xh.ndim == 1:
+        xh, etas, gammas = xh[None], etas[None], gammas[None]
+    new_pi += etas[:, :, :, 0].sum(axis=(0, 2))
+    new_T += etas.sum(axis=(0, 3))
+    corrector += gammas.sum(axis=(0, 2))
+    new_E[:, 0] += (gammas * xh[:, None, :]).sum(axis=(0, 2))
+    new_E[:, 1] += (gammas * (xh[:, None, :] - E[None, :, 0, None])**2
+                    ).sum(axis=(0, 2))
+
+
+def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
+    """
+    final round of the baum-welch (pi, T and E are updated in place)
+
+    :returns: the maximum change in a parameter
+    """
     n = len(T)
-    m = len(probs[0])
-    # intialize beta at 1.0
-    betas = [[0. for _ in xrange(m - 1)] + [1.0] for _ in xrange(n)]
-    for k in xrange(-2, -m - 1, -1):
-        for i in xrange(n):
-            for j in xrange(n):
-                betas[i][k] += betas[j][k + 1] * probs[j][k + 1] * T[i][j]
-            betas[i][k] /= scalars[k + 1]
-    return betas
+    ### update initial probabilities
+    new_pi = new_pi / new_pi.sum()
+    delta = abs(new_pi - asarray(pi, dtype=float)).max()
+    ### update transitions
+    new_T = new_T / new_T.sum(axis=1)[:, None]
+    delta = max(delta, abs(new_T - asarray(T, dtype=float)).max())
+    ### update emissions (means and stdevs)
+    for i in xrange(n):
+        pi[i] = new_pi[i]
+        for j in xrange(n):
+            T[i][j] = new_T[i, j]
+        if corrector[i] > 0.:
+            for j in xrange(2):
+                value = new_E[i, j] / corrector[i]
+                delta = max(delta, abs(value - E[i][j]))
+                E[i][j] = value
+    return float(delta)
+
+
+def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
+    """
+    Baum-Welch training of the HMM, pi, T and E are updated in place. Stops
+    when no parameter changes more than threshold.
 
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities between states
+    :param E: mean and variance of the gaussian emission of each state
+    :param observations: list of sequences of observations
+    """
+    xs, mask = _pad(observations)
+    n = len(T)
+    for it in xrange(n_iter):
+        # reset for new iteration
+        new_pi = zeros(n)
+        new_T  = zeros((n, n))
+        new_E  = zeros((n, 2))
+        corrector = zeros(n)
+        probs  = _batch_gaussian_prob(xs, E)
+        alphas, scalars = _batch_alpha(probs, mask, pi, T)
+        betas  = _batch_beta(probs, mask, T, scalars)
+        etas   = _batch_eta(probs, mask, T, alphas, betas)
+        gammas = get_gamma(T, alphas, betas) * mask[:, None, :]
+        baum_welch_optimization(xs, T, E, new_pi, new_T, corrector,
+                                new_E, etas, gammas)
+        delta = update_parameters(corrector, pi, new_pi, T, new_T, E, new_E)
+        if verbose:
+            print ("\rTraining: %03i/%04i (diff: %.8f)") % (it, n_iter, delta),
+            sys.stdout.flush()
+        if delta <= threshold:
+            break
+    if verbose:
+        print "\n"
@@ -0,0 +1,169 @@
+"""
+18 Oct 2026
+
+Reading of text files by blocks of complete lines (or of records of several
+lines, as in FASTQ files), and parallel processing of these blocks keeping
+their order.
+
+Blocks of the tab separated files of read pairs generated by
+:func:`pytadbit.mapping.get_intersection` are parsed into NumPy arrays, one
+per column, with :func:`parse_pairs`.
+"""
+
+from collections import deque
+from itertools   import imap
+from numpy       import fromstring, fromiter, int64
+import multiprocessing as mu
+
+# columns of the tab separated files of read pairs
+PAIRS_COLUMNS = ['name',
+                 'crm1', 'pos1', 'sd1', 'len1', 'rs1', 're1',
+                 'crm2', 'pos2', 'sd2', 'len2', 'rs2', 're2']
+
+
+def split_file(fnam, nchunks):
+    """
+    Splits the lines of a file, after its header (lines starting with '#'),
+    into chunks of complete lines
+
+    :param fnam: path to the file
+    :param nchunks: number of chunks
+
+    :returns: a list of (start, end) with the byte positions of each chunk
+    """
+    fhandler = open(fnam)
+    # skip the header
+    beg = 0
+    for line in iter(fhandler.readline, ''):
+        if not line.startswith('#'):
+            break
+        beg += len(line)
+    fhandler.seek(0, 2)
+    end = fhandler.tell()
+    step = max(1, (end - beg) / nchunks)
+    chunks = []
+    start = beg
+    while start < end:
+        fhandler.seek(min(start + step, end) - 1)
+        # move to the end of the current line
+        fhandler.readline()
+        stop = fhandler.tell()
+        chunks.append((start, stop))
+        start = stop
+    fhandler.close()
+    return chunks or [(beg, beg)]
+
+
+def read_blocks(fhandler, first='', nlines=1, size=8388608, end=None):
+    """
+    Reads a file by blocks of complete records
+
+    :param fhandler: file handler, at the position where to start reading
+    :param '' first: text already read from the file (e.g. the first line
+       after the header), put at the beginning of the first block
+    :param 1 nlines: number of lines of each record (e.g. 4 for FASTQ files)
+    :param 8388608 size: number of bytes read at a time
+    :param None end: byte position where to stop reading (end of the file by
+       default)
+
+    :yields: strings with complete records
+    """
+    left = None if end is None else end - fhandler.tell()
+    rest = first
+    while True:
+        if left is None:
+            block = fhandler.read(size)
+        else:
+            block = fhandler.read(min(size, left))
+            left -= len(block)
+        if not block:
+            break
+        block = rest + block
+        count = block.count('\n')
+        if count < nlines:
+            rest = block
+            continue
+        # cut after the last complete record
+        pos = len(block)
+        for _ in xrange(count % nlines + 1):
+            pos = block.rfind('\n', 0, pos)
+        yield block[:pos + 1]
+        rest = block[pos + 1:]
+    if rest:
+        yield rest
+
+
+def process_blocks(func, blocks, params, ncpus, pool=None):
+    """
+    Applies a function to blocks in parallel, yielding the results in the
+    order of the blocks. The number of blocks being processed is limited, in
+    order to keep memory usage low if results are consumed slowly.
+
+    :param func: function called with a tuple of a block and params
+    :param blocks: iterable of blocks (e.g. from :func:`read_blocks`)
+    :param params: parameters passed to func with each block
+    :param ncpus: number of processes
+    :param None pool: pool of processes (e.g. created before starting other
+       processes, so that its workers do not inherit their pipes). By default
+       the pool is created here, and terminated once the generator is
+       exhausted or closed
+
+    :yields: the result of func for each block
+    """
+    if ncpus < 2 and pool is None:
+        for block in blocks:
+            yield func((block, params))
+        return
+    own = pool is None
+    if own:
+        pool = mu.Pool(ncpus)
+    pending = deque()
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(func, ((block, params), )))
+            if len(pending) >= 2 * ncpus:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        if own:
+            pool.terminate()
+            pool.join()
+
+
+def parse_pairs(block, crm_ids, columns=None, missing=None):
+    """
+    Parses a block of lines of a tab separated file of read pairs
+
+    :param block: string with complete lines of read pairs
+    :param crm_ids: dictionary with the index of each chromosome
+    :param None columns: list of the columns to parse (see PAIRS_COLUMNS), all
+       by default
+    :param None missing: index given to the chromosomes not found in crm_ids.
+       By default these chromosomes are added to crm_ids
+
+    :returns: a dictionary with an array of integers per column (chromosomes
+       being replaced by their index), except for read names, given as a list
+    """
+    fields = block.replace('\n', '\t').split('\t')
+    if not fields[-1]:
+        fields.pop()
+    if len(fields) % 13:
+        raise Exception('ERROR: read pairs should be in 13 columns')
+    cols = {}
+    for col in columns or PAIRS_COLUMNS:
+        values = fields[PAIRS_COLUMNS.index(col)::13]
+        if col == 'name':
+            cols[col] = values
+        elif col.startswith('crm'):
+            if missing is None:
+                for crm in sorted(set(values).difference(crm_ids)):
+                    crm_ids[crm] = len(crm_ids)
+                get_id = crm_ids.__getitem__
+            else:
+                get_id = lambda crm: crm_ids.get(crm, missing)
+            cols[col] = fromiter(imap(get_id, values), dtype=int64,
+                                 count=len(values))
+        else:
+            cols[col] = fromstring(' '.join(values), dtype=int64, sep=' ')
+    return cols
@@ -51,56 +51,49 @@ matrix W of size N:
 
 """
 
-def _update_S(W):
-    S = {}
-    meanS = 0.0
-    for bin1 in W:
-        S[bin1] = sum(W[bin1].values())
-        meanS += S[bin1]
-    meanS /= len(W)
-    return S, meanS
-
-def _updateDB(S, meanS, B):
-    DB = {}
-    for bin1 in S:
-        DB[bin1] = float(S[bin1]) / meanS
-        B[bin1] *= DB[bin1]
-    return DB
-
-def _update_W(W, DB):
-    for bin1 in W:
-        DBbin1 = DB[bin1]
-        W1 = W[bin1]
-        for bin2 in W1:
-            try:
-                W1[bin2] /= DBbin1 * DB[bin2]
-            except ZeroDivisionError: # whole row is empty
-                continue
-
-def copy_matrix(hic_data, bads):
-    W = {}
-    N = len(hic_data)
-    for k, v in hic_data.iteritems():
-        i, j = divmod(k, N)
-        if i in bads or j in bads:
-            continue
-        try:
-            W[i][j] = v
-        except KeyError:
-            W[i] = {}
-            W[i][j] = v
-    return W
+from numpy        import array, ones, zeros, repeat, diff, arange
+from numpy        import bincount, concatenate, cumsum
+from scipy.sparse import csr_matrix
+from warnings     import warn
+import multiprocessing as mu
+
+# maximum number of iterations of the iterative correction when iterating until
+# convergence
+MAX_ITERATIONS = 1000
+
+
+def _to_csr(hic_data):
+    """
+    :returns: a scipy sparse matrix in Compressed Sparse Row format with the
+       values of hic_data (as float)
+    """
+    size = len(hic_data)
+    try:
+        csr = hic_data.get_hic_data_as_csr()
+    except AttributeError:
+        rows, cols = zip(*[divmod(k, size) for k in hic_data.iterkeys()]) or ((), ())
+        csr = csr_matrix((array(hic_data.values(), dtype=float), (rows, cols)),
+                         shape=(size, size))
+    # values are copied (only once) as they are going to be modified in place,
+    # indices are shared
+    return csr_matrix((csr.data.astype(float), csr.indices, csr.indptr),
+                      shape=(size, size))
+
 
 def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
               verbose=False, **kwargs):
     """
     Implementation of iterative correction Imakaev 2012
-    
+
+    Works on the sparse (CSR) representation of the matrix, with marginals
+    computed as matrix-vector products, and biases stored in arrays.
+
     :param hic_data: dictionary containing the interaction data
     :param None bads: dictionary with column not to be considered
-    :param None remove: columns not to consider
     :param 0 iterations: number of iterations to do (99 if a fully smoothed
-       matrix with no visibility differences between columns is desired)
+       matrix with no visibility differences between columns is desired). Use
+       'max' to iterate until convergence (defined by max_dev), with a limit of
+       MAX_ITERATIONS iterations
     :param 0.00001 max_dev: maximum difference allowed between a row and the
        mean value of all raws
     :returns: a vector of biases (length equal to the size of the matrix)
@@ -110,55 +103,122 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     size = len(hic_data)
     if not bads:
         bads = {}
-    remove = [i in bads for i in xrange(size)]
-    remove = remove or tuple([int(hic_data[i+i*size]==0) for i in xrange(size)])
+    converge = iterations == 'max'
+    if converge:
+        iterations = MAX_ITERATIONS
 
     if verbose:
         print "  - copying matrix"
 
-    W = copy_matrix(hic_data, bads)
-    B = dict([(b, 1.) for b in W])
-    if len(B) == 0:
+    W = _to_csr(hic_data)
+    rows = repeat(arange(size), diff(W.indptr))
+    cols = W.indices
+    remove = zeros(size, dtype=bool)
+    remove[[b for b in bads if 0 <= b < size]] = True
+    W.data[remove[rows] | remove[cols]] = 0
+    # rows with at least one value, these are the ones considered in the mean
+    valid = zeros(size, dtype=bool)
+    valid[rows[~(remove[rows] | remove[cols])]] = True
+    if not valid.any():
         raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    B = ones(size)
+    vector = ones(size)
     if verbose:
         print "  - computing baises"
-    for it in xrange(iterations + 1):
-        S, meanS = _update_S(W)
-        DB = _updateDB(S, meanS, B)
+    it = 0
+    while True:
+        S = W.dot(vector)
+        meanS = S[valid].mean()
+        DB = S / meanS
+        DB[~valid] = 1.
+        B *= DB
         if iterations == 0: # exit before, we do not need to update W
             break
-        _update_W(W, DB)
-        S = sorted(S.values())
-        dev = max(abs(S[0]  / meanS - 1), abs(S[-1] / meanS - 1))
+        # whole row empty, nothing to divide
+        DB[DB == 0] = 1.
+        W.data /= DB[rows] * DB[cols]
+        minS = S[valid].min()
+        maxS = S[valid].max()
+        dev = max(abs(minS / meanS - 1), abs(maxS / meanS - 1))
         if verbose:
-            print '   %15.3f %15.3f %15.3f %4s %9.5f' % (S[0], meanS, S[-1], it, dev)
+            print '   %15.3f %15.3f %15.3f %4s %9.5f' % (minS, meanS, maxS, it, dev)
         if dev < max_dev:
             break
-    for i in xrange(size):
-        try:
-            if B[i]:
-                B[i] *= meanS**.5
-            else:
-                B[i] = 1.
-        except KeyError:
-            B[i] = 1.
-    return B
+        if it >= iterations:
+            if converge:
+                warn('WARNING: iterative correction did not converge after %d '
+                     'iterations (maximum deviation: %f)' % (it, dev))
+            break
+        it += 1
+    B[valid] *= meanS**.5
+    B[(B == 0) | ~valid] = 1.
+    return dict(enumerate(B.tolist()))
 
 
-def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
+def _diagonal_sums(matrix, bads, size):
+    """
+    Sums and numbers of cells of each diagonal of the upper triangle of a
+    (chromosome) matrix, rows in bads being skipped.
+
+    :param matrix: scipy sparse matrix
+    :param bads: boolean array, True for rows to skip
+    :param size: length of the vectors returned
+
+    :returns: two arrays of length size, sum of the values and number of cells
+       of each diagonal
+    """
+    nrows = matrix.shape[0]
+    matrix = matrix.tocoo()
+    dists = matrix.col.astype(int) - matrix.row
+    keep = (dists >= 0) & (dists < size) & ~bads[matrix.row]
+    sums = bincount(dists[keep], weights=matrix.data[keep], minlength=size)
+    # diagonal at distance d starts in the nrows - d first rows
+    goods = concatenate(([0], cumsum(~bads)))
+    counts = zeros(size, dtype=int)
+    ndiag = min(nrows, size)
+    counts[:ndiag] = goods[nrows - arange(ndiag)]
+    return sums, counts
+
+
+def _diagonal_sums_star(args):
+    """
+    to be used with multiprocessing map
+    """
+    return _diagonal_sums(*args)
+
+
+def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False,
+             ncpus=1, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
-    
+
+    Values of each diagonal are summed in a single pass over the sparse
+    matrix, chromosome by chromosome.
+
+    When computed with the filtered columns of a HiC_data object, the result
+    is cached in its 'expected' attribute, and returned without computing it
+    again on the next calls with the same parameters.
+
     :param hic_data: dictionary containing the interaction data
     :param None bads: dictionary with column not to be considered
     :param 0.05 signal_to_noise: to calculate expected interaction counts,
        if not enough reads are observed at a given distance the observations
        of the distance+1 are summed. a signal to noise ratio of < 0.05
        corresponds to > 400 reads.
-    
+    :param 1 ncpus: number of chromosomes processed in parallel
+
     :returns: a vector of biases (length equal to the size of the matrix)
     """
+    bads = bads or {}
+    cache = None
+    if (hasattr(hic_data, 'expected') and
+        frozenset(bads) == frozenset(hic_data.bads or {})):
+        cache = (frozenset(bads), signal_to_noise, inter_chrom)
+        if (hic_data.expected and
+            getattr(hic_data, '_expected_key', None) == cache):
+            return hic_data.expected
+
     min_n = signal_to_noise ** -2. # equals 400 when default
 
     size = len(hic_data)
@@ -168,38 +228,48 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
     except AttributeError:
         pass
 
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
+    if getattr(hic_data, 'section_pos', None):
+        sections = hic_data.section_pos.values()
+    else:
+        sections = [(0, size)]
+    matrix = _to_csr(hic_data)
+    is_bad = zeros(len(hic_data), dtype=bool)
+    is_bad[[b for b in bads if 0 <= b < len(hic_data)]] = True
+    jobs = [(matrix[beg:end, beg:end], is_bad[beg:end], size)
+            for beg, end in sections]
+    if ncpus > 1 and len(jobs) > 1:
+        pool = mu.Pool(min(ncpus, len(jobs)))
+        try:
+            results = pool.map(_diagonal_sums_star, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_diagonal_sums(*job) for job in jobs]
+    sums = reduce(lambda x, y: x + y, [r[0] for r in results]).tolist()
+    counts = reduce(lambda x, y: x + y, [r[1] for r in results]).tolist()
 
+    # pool diagonals until having enough signal
     expc = {}
     dist = 0
     while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
-        for dist in range(dist, new_dist + 1):
+        sum_diag = 0
+        len_diag = 0
+        end = dist
+        while True:
+            if end < size:
+                sum_diag += sums[end]
+                len_diag += counts[end]
+            if len_diag == 0:
+                val = 0.
+                break
+            if sum_diag > min_n or end >= size:
+                val = float(sum_diag) / len_diag
+                break
+            end += 1
+        for dist in range(dist, end + 2):
             expc[dist] = val
+    if cache:
+        hic_data.expected = expc
+        hic_data._expected_key = cache
     return expc
-
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
-    if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in xrange(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in xrange(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if len(diag) == 0:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    elif dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
-    else:
-        return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
@@ -29,6 +29,8 @@ into compressed BAM format.
 # dependencies
 
 from argparse                     import ArgumentParser
+from pytadbit.mapping.filter      import _FILTERS
+from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic
 import sys
 import os
 import collections
@@ -76,6 +78,12 @@ def map2sam (line, flag):
 def main():
     opts = get_options()
     infile = os.path.realpath(opts.inbed)
+
+    # sorted and indexed BAM written directly
+    if opts.outbam:
+        masked = None if opts.valid else get_masked(infile)
+        bed2D_to_BAMhic(infile, opts.outbam, masked, ncpus=opts.cpus)
+        return
     
     # define filter codes
     filter_keys = collections.OrderedDict()
@@ -173,6 +181,20 @@ def get_filters(infile):
     return filter_line, filter_handler
 
 
+def get_masked(infile):
+    """
+    get all filters, as returned by pytadbit.mapping.filter.filter_reads
+    """
+    masked = {}
+    sys.stderr.write('Using filter files:\n')
+    for k, name in _FILTERS.iteritems():
+        fname = infile + '_' + name.replace(' ', '_') + '.tsv'
+        if os.path.exists(fname):
+            masked[k] = {'name': name, 'fnam': fname}
+            sys.stderr.write('   - %-20s %s\n' %(name, os.path.basename(fname)))
+    return masked
+
+
 def get_options():
     parser = ArgumentParser(usage="%(prog)s -i PATH -r INT [options]")
 
@@ -181,6 +203,12 @@ def get_options():
                         help="input TADbit's 2D bed.")
     parser.add_argument('--valid', dest='valid', action='store_true',
                         default=False, help='input already filtered')    
+    parser.add_argument('-o', '--output', dest='outbam', metavar='',
+                        default=None, help='''write a sorted and indexed BAM
+                        file, instead of SAM to standard output''')
+    parser.add_argument('-C', '--cpu', dest='cpus', metavar='', type=int,
+                        default=1, help='''[%(default)s] number of threads to
+                        sort and compress the BAM file''')
     opts = parser.parse_args()
     
     return opts
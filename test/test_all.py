@@ -23,7 +23,7 @@ from pytadbit.mapping.analyze             import correlate_matrices, eig_correla
 from pytadbit.mapping.filter              import filter_reads, apply_filter
 
 from random                               import random, seed
-from os                                   import system, path, chdir
+from os                                   import system, path, chdir, environ
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
 from distutils.spawn                      import find_executable
@@ -341,6 +341,53 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(len(hic_data.compartments[None]), 39)
         # self.assertEqual(round(hic_data.compartments[None][24]['dens'], 5),
         #                  0.75434)
+        # tadbit segment on a single chromosome loads the genome-wide matrix to
+        # search compartments, and finds the eigenvector of a genome-wide run
+        from collections import OrderedDict
+        from argparse import ArgumentParser
+        from pytadbit import HiC_data
+        from pytadbit.tools.tadbit_segment import populate_args, region_to_load
+        parser = ArgumentParser()
+        populate_args(parser)
+        opts = parser.parse_args(['-w', '.', '-r', '20000', '-c', 'chrA'])
+        self.assertEqual(region_to_load(opts), None)
+        opts = parser.parse_args(['-w', '.', '-r', '20000', '-c', 'chrA',
+                                  '--only_tads'])
+        self.assertEqual(region_to_load(opts), 'chrA')
+        size = len(hic_data)
+        genome = HiC_data([], size * 2, resolution=20000,
+                          chromosomes=OrderedDict([('chrA', size),
+                                                   ('chrB', size)]))
+        for shift, fnam in ((0, 'chrT_A'), (size, 'chrT_B')):
+            chrom = read_matrix(PATH + '/20Kb/chrT/%s.tsv' % fnam,
+                                resolution=20000)
+            for pos, val in chrom.iteritems():
+                genome[pos / size + shift, pos % size + shift] = val
+        firsts1 = genome.find_compartments(label_compartments=None)
+        firsts2 = genome.find_compartments(crms=['chrA'],
+                                           label_compartments=None)
+        self.assertEqual([round(v, 5) for v in firsts1['chrA'][0] if v == v],
+                         [round(v, 5) for v in firsts2['chrA'][0] if v == v])
+        # HMM training on sequences of different lengths, and Viterbi path
+        # (values from the former pure python implementation)
+        from pytadbit.utils.hmm import train, best_path, gaussian_prob
+        obs = [[-0.9, -0.4, -0.7, 0.2, 0.8, 1.1, 0.5, 0.9, -0.2, -0.6, -1.0, 0.4],
+               [0.7, 0.3, -0.5, -0.8, -0.3, 0.6, 1.2]]
+        pi = [0.5, 0.5]
+        T = [[0.8, 0.2], [0.3, 0.7]]
+        E = [[-0.5, 0.3], [0.6, 0.4]]
+        train(pi, T, E, obs, n_iter=50)
+        self.assertEqual([round(v, 6) for v in pi], [0.499998, 0.500002])
+        self.assertEqual([[round(v, 6) for v in row] for row in T],
+                         [[0.663722, 0.336278], [0.247627, 0.752373]])
+        self.assertEqual([[round(v, 6) for v in row] for row in E],
+                         [[-0.601598, 0.068044], [0.661406, 0.10766]])
+        paths = [best_path(gaussian_prob(o, E), pi, T) for o in obs]
+        self.assertEqual([states for states, _ in paths],
+                         [[0, 0, 0, 1, 1, 1, 1, 1, 0, 0, 0, 1],
+                          [1, 1, 0, 0, 0, 1, 1]])
+        self.assertEqual([round(prob, 6) for _, prob in paths],
+                         [-9.374057, -5.522989])
         if CHKTIME:
             print '10', time() - t0
         
@@ -674,6 +721,34 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(len(frags['chr2L']), 231)
         self.assertEqual(len(frags['chr2L'][230]), 3)
         self.assertEqual(frags['chr4'][10][5], 1017223)
+        # genome store, with stretches of N and IUPAC codes
+        from collections import OrderedDict
+        from pytadbit.parsers.genome_store import write_genome_store
+        from pytadbit.parsers.genome_store import load_genome_store
+        from pytadbit.parsers.genome_store import is_genome_store
+        from pytadbit.parsers.genome_store import chromosome_lengths
+        from pytadbit.parsers.genome_store import genome_checksum
+        genome = OrderedDict([
+            ('chrA', 'NNNNACGTRYACGTTTNNNGATCN'),
+            ('chrB', 'ACG'),
+            ('chrC', 'GATCGATCWWSACGTNN' + ref_genome['chr4'][:1000])])
+        for twobit in (True, False):
+            write_genome_store(genome, 'lala-genome.tdg~', twobit=twobit)
+            self.assertEqual(is_genome_store('lala-genome.tdg~'), True)
+            store = load_genome_store('lala-genome.tdg~')
+            self.assertEqual(store.keys(), genome.keys())
+            for crm in genome:
+                self.assertEqual(store[crm], genome[crm])
+            self.assertEqual(chromosome_lengths(store),
+                             chromosome_lengths(genome))
+            self.assertEqual(chromosome_lengths(store)['chrB'], 3)
+            self.assertEqual(genome_checksum(store), genome_checksum(genome))
+            self.assertEqual(genome_checksum(load_genome_store(
+                'lala-genome.tdg~', mmap=False)), genome_checksum(genome))
+        genome['chrB'] = 'ACT'
+        self.assertEqual(genome_checksum(store) == genome_checksum(genome),
+                         False)
+        system('rm -rf lala-genome.tdg~')
         if CHKTIME:
             self.assertEqual(True, True)
             print '17', time() - t0
@@ -683,6 +758,7 @@ class TestTadbit(unittest.TestCase):
             return
         if CHKTIME:
             t0 = time()
+        masks = {}
         for ali in ['map', 'sam']:
             seed(1)
             if 13436 == int(random()*100000):
@@ -706,14 +782,36 @@ class TestTadbit(unittest.TestCase):
             parser(['test_read1.%s~' % (ali)], ['test_read2.%s~' % (ali)],
                    './lala1-%s~' % (ali), './lala2-%s~' % (ali), genome,
                    re_name='DPNII', mapper='GEM')
+            if ali == 'map':
+                # same reads parsed with the genome loaded from a genome store
+                from pytadbit.parsers.genome_store import write_genome_store
+                from pytadbit.parsers.genome_store import load_genome_store
+                from pytadbit.parsers.genome_store import is_genome_store
+                write_genome_store(genome, 'lala-genome.tdg~')
+                parser(['test_read1.map~'], ['test_read2.map~'],
+                       './lala1-store~', './lala2-store~',
+                       load_genome_store('lala-genome.tdg~'),
+                       re_name='DPNII', mapper='GEM')
+                for read in (1, 2):
+                    self.assertEqual(open('lala%d-map~' % read).read(),
+                                     open('lala%d-store~' % read).read())
+                self.assertEqual(is_genome_store('lala-genome.tdg~'), True)
 
             # GET INTERSECTION
             from pytadbit.mapping import get_intersection
             get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
                              'lala-%s~' % (ali))
+            # same with several sorted runs, sorted in parallel or not
+            for ncpus in (0, 1, 3):
+                get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
+                                 'lala-runs-%s~' % (ali), max_size=1000,
+                                 ncpus=ncpus)
+                self.assertEqual(open('lala-%s~' % (ali)).read(),
+                                 open('lala-runs-%s~' % (ali)).read())
             # FILTER
             masked = filter_reads('lala-%s~' % (ali), verbose=False,
                                   fast=(ali=='map'))
+            masks[ali] = masked
             self.assertEqual(masked[1]['reads'], 1000)
             self.assertEqual(masked[2]['reads'], 1000)
             self.assertEqual(masked[3]['reads'], 1000)
@@ -727,12 +825,184 @@ class TestTadbit(unittest.TestCase):
             else:
                 self.assertTrue (masked[5]['reads'] > 1000)
             self.assertEqual(masked[9]['reads'], 1000)
-        apply_filter('lala-map~', 'lala-map-filt~', masked, filters=[1],
+            # read ends per RE fragment, saved by the over-represented filter
+            from pytadbit.mapping.restriction_enzymes import count_re_fragments
+            from pytadbit.mapping.restriction_enzymes import load_re_fragment_counts
+            _, frags, counts = load_re_fragment_counts(
+                'lala-%s~_fragment_counts.npz' % (ali))
+            frag_count = count_re_fragments('lala-%s~' % (ali))
+            self.assertEqual(len(frags), len(frag_count))
+            self.assertEqual(counts.sum(), sum(frag_count.values()))
+        apply_filter('lala-map~', 'lala-map-filt~', masks['map'], filters=[1],
                      reverse=True, verbose=False)
         self.assertEqual(len([True for l in open('lala-map-filt~')
                               if not l.startswith('#')]), 1000)
+        # flags of another file are not applied
+        self.assertRaises(Exception, apply_filter, 'lala-map~',
+                          'lala-map-filt~', masked, filters=[1], verbose=False)
+        # an error in a chunk leaves no temporary file behind
+        from glob import glob
+        out = open('lala-bad~', 'w')
+        out.write(''.join(open('lala-map~').readlines()[:2000]) + 'bad\n')
+        out.close()
+        self.assertRaises(Exception, filter_reads, 'lala-bad~', verbose=False,
+                          fast=True, ncpus=2)
+        self.assertEqual(glob('lala-bad~_*~'), [])
+        # same from the files of read IDs, without the column of flags
+        ids_only = dict((k, {'fnam': masked[k]['fnam']}) for k in masked)
+        for filters in [[1], [8, 9]]:
+            self.assertEqual(
+                apply_filter('lala-sam~', 'lala-sam-filt~', masked,
+                             filters=filters, verbose=False),
+                apply_filter('lala-sam~', 'lala-sam-ids~', ids_only,
+                             filters=filters, verbose=False))
+            self.assertEqual(open('lala-sam-filt~').read(),
+                             open('lala-sam-ids~').read())
+        # valid pairs also written to a pairs store, with their filters
+        from pytadbit.parsers.pairs_store import load_pairs_store
+        from pytadbit.parsers.pairs_store import export_pairs_tsv
+        from numpy import load as np_load
+        nvalid = apply_filter('lala-sam~', 'lala-sam-filt~', masked,
+                              filters=[1, 2, 3], verbose=False,
+                              pairs_store='lala-sam-filt.tdp~')
+        store = load_pairs_store('lala-sam-filt.tdp~')
+        self.assertEqual(len(store), nvalid)
+        self.assertNotEqual(store.block_size, None)
+        export_pairs_tsv('lala-sam-filt.tdp~', 'lala-sam-exp~')
+        self.assertEqual(open('lala-sam-filt~').read(),
+                         open('lala-sam-exp~').read())
+        flags = np_load(masked[1]['flags'])
+        self.assertEqual(store.column('filters').tolist(),
+                         flags[(flags & 7) == 0].tolist())
+        hic_data1 = load_hic_data_from_reads('lala-sam-filt~', 10000,
+                                             region1='chr2')
+        self.assertTrue(sum(hic_data1.values()) > 0)
+        self.assertEqual(load_hic_data_from_reads('lala-sam-filt.tdp~', 10000,
+                                                  region1='chr2'), hic_data1)
+        # duplicates need not be consecutive, all but the first copy are
+        # removed (also with partitions and blocks of lines smaller than the
+        # file)
+        import pytadbit.mapping.filter as filter_module
+        pairs = [('A', 100, 500), ('B', 200, 700), ('A', 100, 500),
+                 ('C', 300, 900), ('A', 100, 500), ('B', 200, 700)]
+        out = open('lala-dup~', 'w')
+        out.write('# CRM chr1\t10000\n')
+        for i, (_, ps1, ps2) in enumerate(pairs):
+            out.write('%d\tchr1\t%d\t1\t50\t0\t5000\tchr1\t%d\t0\t50\t0\t5000\n'
+                      % (i, ps1, ps2))
+        out.close()
+        block_lines = filter_module._BLOCK_LINES
+        filter_module._BLOCK_LINES = 2
+        for ncpus in (1, 2):
+            dups = filter_reads('lala-dup~', verbose=False, ncpus=ncpus,
+                                max_size=2)
+            self.assertEqual(open(dups[9]['fnam']).read().split(),
+                             ['2', '4', '5'])
+        filter_module._BLOCK_LINES = block_lines
+        # blocks of complete records, also when smaller than a record
+        from pytadbit.utils.line_blocks import read_blocks
+        from StringIO import StringIO
+        text = ''.join('@r%d\nACGT\n+\nIIII\n' % i for i in xrange(10))
+        for size in (7, 40, 1000):
+            blocks = list(read_blocks(StringIO(text), nlines=4, size=size))
+            self.assertEqual(''.join(blocks), text)
+            self.assertEqual([b.count('\n') % 4 for b in blocks],
+                             [0] * len(blocks))
+        # all read pairs in BAM format, flagged with their filters
+        try:
+            from pytadbit.parsers.hic_bam_parser import bed2D_to_BAMhic
+            import pysam
+            self.assertEqual(bed2D_to_BAMhic('lala-sam~', 'lala-sam.bam~',
+                                             masked, ncpus=2),
+                             len([True for l in open('lala-sam~')
+                                  if not l.startswith('#')]))
+            bam = pysam.AlignmentFile('lala-sam.bam~')
+            flags = [r.flag for r in bam.fetch(until_eof=True)]
+            # the index gives all the read-ends of each chromosome
+            ends = {}
+            for l in open('lala-sam~'):
+                if not l.startswith('#'):
+                    l = l.split('\t')
+                    ends[l[1]] = ends.get(l[1], 0) + 1
+                    ends[l[7]] = ends.get(l[7], 0) + 1
+            for crm in bam.references:
+                self.assertEqual(bam.count(crm), ends.get(crm, 0))
+            for k in masked:
+                self.assertEqual(sum(1 for f in flags if f & 2**(k - 1)),
+                                 2 * masked[k]['reads'])
+            # matrices at several resolutions from a single pass over the BAM,
+            # against one pass per resolution
+            from pytadbit.parsers.hic_bam_parser import bam_to_hic_data
+            resolutions = [10000, 20000, 100000]
+            hic_datas, bin_list = bam_to_hic_data('lala-sam.bam~', resolutions,
+                                                  1, ncpus=2)
+            for reso, hic_data, bins in zip(resolutions, hic_datas, bin_list):
+                (hic_data1, ), (bins1, ) = bam_to_hic_data(
+                    'lala-sam.bam~', [reso], 1, ncpus=2)
+                self.assertEqual(hic_data.resolution, reso)
+                self.assertEqual(hic_data, hic_data1)
+                self.assertEqual(bins, bins1)
+                self.assertEqual(hic_data.sections, bins)
+            self.assertEqual(sum(hic_datas[0].values()),
+                             sum(hic_datas[-1].values()))
+            # reads are counted once, in the chunk where they start, with more
+            # chunks than bins or with a single chunk
+            from pytadbit.parsers.hic_bam_parser import read_bam
+            dico1 = read_bam('lala-sam.bam~', 1, 100000, {}, ncpus=1,
+                             nchunks=1)
+            dico2 = read_bam('lala-sam.bam~', 1, 100000, {}, ncpus=2,
+                             nchunks=100000)
+            self.assertEqual(dico1, dico2)
+            self.assertEqual(sum(dico1.values()), sum(hic_datas[-1].values()))
+            crm = bam.references[0]
+            dico1 = read_bam('lala-sam.bam~', 1, 10000, {}, ncpus=1,
+                             region1=crm, nchunks=1)
+            dico2 = read_bam('lala-sam.bam~', 1, 10000, {}, ncpus=2,
+                             region1=crm, nchunks=100000)
+            self.assertEqual(dico1, dico2)
+            self.assertEqual(sum(dico1.values()) > 0, True)
+            # same flags from the files of read IDs, without the column of
+            # flags (alignments at the same position may be sorted
+            # differently)
+            bed2D_to_BAMhic('lala-sam~', 'lala-sam-ids.bam~', ids_only,
+                            filters=[1, 9])
+            self.assertTrue(
+                sorted((r.query_name, r.reference_start, r.flag & 257)
+                       for r in pysam.AlignmentFile(
+                           'lala-sam.bam~').fetch(until_eof=True)) ==
+                sorted((r.query_name, r.reference_start, r.flag & 257)
+                       for r in pysam.AlignmentFile(
+                           'lala-sam-ids.bam~').fetch(until_eof=True)))
+        except ImportError:
+            print 'ERROR: PYSAM not found, skipping test\n'
         d = plot_iterative_mapping('lala1-map~', 'lala2-map~')
         self.assertEqual(d[0][1], 6000)
+        # iterative and fragment-based mapping, with a fake GEM mapper
+        from pytadbit.mapping.full_mapper import full_mapping
+        nreads = write_fake_gem('lala-gem~', 'lala-reads.fastq')
+        environ['PATH'] = path.abspath('lala-gem~') + ':' + environ['PATH']
+        outputs = []
+        for nthreads in (1, 3):
+            outfiles = full_mapping('index.gem', 'lala-reads.fastq',
+                                    'lala-maps-%d~' % nthreads, r_enz='DpnII',
+                                    windows=((1, 20), (1, 35), (1, 50)),
+                                    nthreads=nthreads, temp_dir='lala-tmp~',
+                                    get_nread=True)
+            self.assertEqual(outfiles[0][1], nreads)
+            mapped = [len(open(fnam).readlines()) for fnam, _ in outfiles]
+            for (_, count), (_, count_next), nmap in zip(
+                outfiles, outfiles[1:], mapped):
+                self.assertEqual(count - nmap, count_next)
+            outputs.append([open(fnam).read() for fnam, _ in outfiles])
+        self.assertEqual(outputs[0], outputs[1])
+        # GEM failing in the middle of the input
+        environ['FAKE_GEM_FAIL'] = '1'
+        self.assertRaises(Exception, full_mapping, 'index.gem',
+                          'lala-reads.fastq', 'lala-maps-fail~', r_enz='DpnII',
+                          windows=((1, 20), (1, 50)), nthreads=3,
+                          temp_dir='lala-tmp~')
+        del environ['FAKE_GEM_FAIL']
+        environ['PATH'] = environ['PATH'].split(':', 1)[1]
 
         if CHKTIME:
             self.assertEqual(True, True)
@@ -744,9 +1014,116 @@ class TestTadbit(unittest.TestCase):
         if CHKTIME:
             t0 = time()
         hic_data1 = load_hic_data_from_reads('lala-map~', resolution=10000)
+        hic_data3 = load_hic_data_from_reads('lala-map~', resolution=10000,
+                                             sparse=True)
+        self.assertEqual(hic_data1, hic_data3)
+        self.assertEqual(hic_data1.get_matrix(focus='chr1'),
+                         hic_data3.get_matrix(focus='chr1'))
+        # non-integer values are not truncated, and cells can be removed
+        hic_data2 = hic_data3.copy()
+        hic_data2[0, 1] = 2.5
+        hic_data2._flush()
+        self.assertEqual(hic_data2[0, 1], 2.5)
+        del hic_data2[0, 1]
+        self.assertEqual(1 in hic_data2, False)
+        self.assertEqual(hic_data1, hic_data3)
+        # values are kept when pickled, copied or converted to HiC_data
+        from cPickle import dumps, loads
+        from copy import deepcopy
+        from pytadbit import HiC_data
+        hic_data2[0, 1] = 2.5  # still in the buffer
+        for protocol in (0, 2):
+            hic_data4 = loads(dumps(hic_data2, protocol))
+            self.assertEqual(hic_data4, hic_data2)
+            self.assertEqual(hic_data4[0, 1], 2.5)
+            self.assertEqual(hic_data4.chromosomes, hic_data2.chromosomes)
+        self.assertEqual(deepcopy(hic_data2), hic_data2)
+        self.assertEqual(dict(hic_data2.viewitems()), dict(hic_data2.iteritems()))
+        self.assertEqual(sorted(hic_data2.viewkeys()), sorted(hic_data2.keys()))
+        self.assertEqual(sorted(hic_data2.viewvalues()),
+                         sorted(hic_data2.values()))
+        self.assertEqual(hic_data2[0, 1] in hic_data2.viewvalues(), True)
+        self.assertEqual(HiC_data(hic_data3, len(hic_data3)), hic_data1)
+        # normalized matrix written to a matrix store, and memory-mapped back
+        from pytadbit.parsers.hic_store import write_hic_store, load_hic_store
+        from pytadbit.utils.normalize_hic import expected
+        hic_data2 = load_hic_data_from_reads('lala-map~', resolution=10000)
+        size = len(hic_data2)
+        hic_data2.bads = dict((i, True) for i in xrange(size)
+                              if not any(hic_data2[i, j] for j in xrange(size)))
+        hic_data2.normalize_hic(iterations=5, silent=True)
+        expected(hic_data2, bads=hic_data2.bads)
+        write_hic_store(hic_data2, 'lala-map.tds~')
+        hic_data4 = load_hic_store('lala-map.tds~')
+        # matrix and pairs stores are not taken for genome stores
+        from pytadbit.parsers.genome_store import is_genome_store
+        self.assertEqual(is_genome_store('lala-map.tds~'), False)
+        self.assertEqual(hic_data4, hic_data2)
+        self.assertEqual(hic_data4.chromosomes, hic_data2.chromosomes)
+        self.assertEqual(hic_data4.bads, hic_data2.bads)
+        self.assertEqual(dict((k, round(v, 8)) for k, v in hic_data4.bias.iteritems()),
+                         dict((k, round(v, 8)) for k, v in hic_data2.bias.iteritems()
+                              if v == v))
+        self.assertEqual(hic_data4.expected, hic_data2.expected)
+        # cached expected counts are reused
+        self.assertEqual(expected(hic_data4, bads=hic_data4.bads)
+                         is hic_data4.expected, True)
+        crm = hic_data2.chromosomes.keys()[-1]
+        self.assertEqual(hic_data4.get_matrix(focus=crm),
+                         hic_data2.get_matrix(focus=crm))
+        self.assertEqual(
+            [[round(v, 8) for v in row]
+             for row in hic_data4.get_matrix(focus=crm, normalized=True)],
+            [[round(v, 8) for v in row]
+             for row in hic_data2.get_matrix(focus=crm, normalized=True)])
+        # experiment of a window of the chromosome, from the store, against
+        # the experiment of the whole chromosome
+        from pytadbit.experiment import load_experiment_from_hic_data
+        crm = max(hic_data2.chromosomes, key=hic_data2.chromosomes.get)
+        start, end = 3, hic_data2.chromosomes[crm] - 2
+        exp_win = load_experiment_from_hic_data('win', hic_data4, crm,
+                                                start=start, end=end)
+        exp_crm = load_experiment_from_hic_data('crm', hic_data2, crm)
+        self.assertEqual(exp_win.size, end - start + 1)
+        self.assertEqual(exp_win._offset, start - 1)
+        self.assertEqual(exp_crm._offset, 0)
+        size1, size2 = exp_win.size, exp_crm.size
+        self.assertEqual(
+            [round(exp_win.norm[0][i + j * size1], 8)
+             for i in xrange(size1) for j in xrange(size1)],
+            [round(exp_crm.norm[0][i + start - 1 + (j + start - 1) * size2], 8)
+             for i in xrange(size1) for j in xrange(size1)])
+        zsc1, values1, zeros1 = exp_win._sub_experiment_zscore(start + 1, end - 1)
+        zsc2, values2, zeros2 = exp_crm._sub_experiment_zscore(start + 1, end - 1)
+        self.assertEqual(zsc1, zsc2)
+        self.assertEqual(zeros1, zeros2)
+        self.assertEqual([[v for v in row if v == v] for row in values1],
+                         [[v for v in row if v == v] for row in values2])
+        self.assertRaises(ValueError, exp_win._sub_experiment_zscore, 1, end)
+        hic_data3 = load_hic_data_from_reads('lala-map~', resolution=10000,
+                                             ncpus=2)
+        self.assertEqual(hic_data1, hic_data3)
         hic_map(hic_data1, savedata='lala-map.tsv~', savefig='lala.pdf~')
         hic_map(hic_data1, by_chrom='intra', savedata='lala-maps~', savefig='lalalo~')
         hic_map(hic_data1, by_chrom='inter', savedata='lala-maps~', savefig='lalala~')
+        # drawn from tiles summing interactions in blocks of bins
+        from pytadbit.utils.hic_tiles import HiCTiles
+        hic_map(hic_data1, savefig='lala-tiled.pdf~', max_pixels=50)
+        tiles = HiCTiles(hic_data1, tile_size=8, max_tiles=4)
+        matrix = tiles.region(0, len(hic_data1), 0, len(hic_data1), 2)
+        self.assertEqual(matrix.sum(), sum(hic_data1.values()))
+        self.assertEqual(matrix[1, 3], sum(hic_data1[i, j] for i in xrange(4, 8)
+                                           for j in xrange(12, 16)))
+        self.assertEqual(len(tiles._tiles), 4)
+        # tiles without interactions, with masked bins
+        from scipy.sparse import coo_matrix
+        from numpy import isnan
+        tiles = HiCTiles(coo_matrix(([1.], ([0], [0])), shape=(40, 40)),
+                         masked=[39], tile_size=8)
+        matrix = tiles.region(0, 40, 0, 40, 0)
+        self.assertEqual(matrix[0, 0], 1)
+        self.assertEqual(isnan(matrix[:, 39]).all(), True)
+        self.assertEqual(matrix[8:39, :39].sum(), 0)
         # slowest part of the all test:
         hic_data2 = read_matrix('lala-map.tsv~', resolution=10000)
         self.assertEqual(hic_data1, hic_data2)
@@ -758,6 +1135,47 @@ class TestTadbit(unittest.TestCase):
         
         a, b = insert_sizes('lala-map~')
         self.assertEqual([int(a),int(b)], [43, 1033])
+        # same from statistics computed in a single pass
+        from pytadbit.mapping.read_stats import read_stats
+        stats = read_stats('lala-map~', ncpus=2)
+        a, b = insert_sizes(stats)
+        self.assertEqual([int(a),int(b)], [43, 1033])
+        # same from a pairs store, and back to the tab separated format
+        from pytadbit.parsers.pairs_store import write_pairs_store
+        from pytadbit.parsers.pairs_store import export_pairs_tsv
+        npairs = write_pairs_store('lala-map~', 'lala-map.tdp~',
+                                   chunk_size=1000)
+        self.assertEqual(npairs, export_pairs_tsv('lala-map.tdp~',
+                                                  'lala-map-exp~'))
+        self.assertEqual(is_genome_store('lala-map.tdp~'), False)
+        self.assertEqual(open('lala-map~').read(),
+                         open('lala-map-exp~').read())
+        a, b = insert_sizes('lala-map.tdp~')
+        self.assertEqual([int(a),int(b)], [43, 1033])
+        # same statistics from the columns of the store
+        stats2 = read_stats('lala-map.tdp~', ncpus=2)
+        self.assertEqual(stats2.nreads, stats.nreads)
+        self.assertEqual(stats2.chromosomes, stats.chromosomes)
+        for attr in ('dangling_ends', 'strands', 'rsite', 'diagonal'):
+            self.assertEqual(getattr(stats2, attr).tolist(),
+                             getattr(stats, attr).tolist())
+        for i in xrange(2):
+            self.assertEqual(stats2.lengths[i].tolist(),
+                             stats.lengths[i].tolist())
+            self.assertEqual(sorted(stats2.genomic[i]),
+                             sorted(stats.genomic[i]))
+            for crm in stats.genomic[i]:
+                self.assertEqual(stats2.genomic[i][crm].tolist(),
+                                 stats.genomic[i][crm].tolist())
+        # region queries, through the index of the store or scanning the file
+        crm = hic_data1.chromosomes.keys()[0]
+        region = (crm, 100000, 300000)
+        hic_data2 = load_hic_data_from_reads('lala-map.tdp~', resolution=10000,
+                                             region1=region)
+        hic_data3 = load_hic_data_from_reads('lala-map~', resolution=10000,
+                                             region1=region)
+        self.assertEqual(hic_data2, hic_data3)
+        self.assertEqual(True, 0 < sum(hic_data2.values()) < sum(hic_data1.values()))
 
         hic_data1 = read_matrix('20Kb/chrT/chrT_A.tsv', resolution=20000)
         hic_data2 = read_matrix('20Kb/chrT/chrT_B.tsv', resolution=20000)
@@ -775,6 +1193,31 @@ class TestTadbit(unittest.TestCase):
                                  0.006, 0.029, 0.974, 0.076, 0.03, 0.219, 0.013,
                                  0.031, 0.08, 0.974, 0.018, 0.028, 0.004, 0.0,
                                  0.028, 0.034, 0.89])
+        # expected counts are cached for the filtered columns of the matrix
+        from pytadbit.utils.normalize_hic import expected
+        expc = expected(hic_data1, bads=hic_data1.bads)
+        self.assertEqual(hic_data1.expected is expc, True)
+        self.assertEqual(expected(hic_data1, bads=hic_data1.bads) is expc, True)
+        self.assertEqual(expected(hic_data1, bads={3: 1}) is expc, False)
+        self.assertEqual(hic_data1.expected is expc, True)
+        # iterative correction
+        from pytadbit.utils.normalize_hic import iterative
+        bias = iterative(hic_data1, iterations=5, bads={3: 1})
+        self.assertEqual([round(bias[i], 4) for i in (0, 10, 50)],
+                         [39.7506, 39.0901, 56.0981])
+        bias = iterative(hic_data1, iterations='max', max_dev=0.001,
+                         bads={3: 1})
+        sums = [sum(hic_data1[i, j] / bias[i] / bias[j]
+                    for j in xrange(len(hic_data1)) if j != 3)
+                for i in xrange(len(hic_data1)) if i != 3]
+        self.assertEqual(max(sums) / min(sums) < 1.002, True)
+        from argparse import ArgumentParser
+        from pytadbit.tools.tadbit_normalize import populate_args
+        parser = ArgumentParser()
+        populate_args(parser)
+        opts = parser.parse_args(['-w', '.', '-r', '20000',
+                                  '--iterations', 'max'])
+        self.assertEqual(opts.iterations, 'max')
         system('rm -rf lala*')
         if CHKTIME:
             self.assertEqual(True, True)
@@ -1046,6 +1489,47 @@ def generate_random_ali(ali='map'):
     return genome
 
 
+def write_fake_gem(dirname, fastq, nreads=2000):
+    """
+    Writes a deterministic fake GEM mapper (reads map depending on their
+    sequence) in dirname, and a FASTQ file with random reads, some with DpnII
+    ligation sites.
+
+    :returns: the number of reads written
+    """
+    system('mkdir -p ' + dirname)
+    out = open(path.join(dirname, 'gem-mapper'), 'w')
+    out.write("""#!/usr/bin/env python
+import os, sys
+fail = 'FAKE_GEM_FAIL' in os.environ
+lines = iter(sys.stdin)
+for num, head in enumerate(lines):
+    seq = next(lines).strip()
+    next(lines)
+    qal = next(lines).strip()
+    if fail and num > 10:
+        sys.exit(1)
+    code = sum(ord(c) * (i + 1) for i, c in enumerate(seq))
+    if code % 3:
+        sys.stdout.write('%s\\t%s\\t%s\\t0\\t-\\n' % (head[1:-1], seq, qal))
+    else:
+        sys.stdout.write('%s\\t%s\\t%s\\t1\\tchrT:+:%d:%d\\n' % (
+            head[1:-1], seq, qal, code % 10000 + 1, len(seq)))
+""")
+    out.close()
+    system('chmod +x ' + path.join(dirname, 'gem-mapper'))
+    seed(2)
+    out = open(fastq, 'w')
+    for i in xrange(nreads):
+        seq = ''.join('ACGT'[int(random() * 4)] for _ in xrange(50))
+        if random() < 0.3:
+            pos = 15 + int(random() * 20)
+            seq = seq[:pos] + 'GATCGATC' + seq[pos + 8:]
+        out.write('@read%d\n%s\n+\n%s\n' % (i, seq, 'H' * len(seq)))
+    out.close()
+    return nreads
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         CHKTIME = bool(int(sys.argv.pop()))